@@ -16,6 +16,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import time
 import datetime
 import traceback
@@ -23,42 +24,171 @@ try:
     import httplib as httplibs
 except ImportError:
     import http.client as httplibs
+import select
 import shlex
+import socket
 import subprocess
 import sys
+import threading
 from common import CommonVariables
 from subprocess import *
 from Utils.WAAgentUtil import waagent
 import sys
 
+class BufferedHttpResponse(object):
+    """Http response whose body was fully read so that its connection could go back to the pool"""
+    def __init__(self, resp, body):
+        self.status = resp.status
+        self.reason = resp.reason
+        self.will_close = resp.will_close
+        self.headers = resp.getheaders()
+        self.header_dict = {}
+        for key, value in self.headers:
+            self.header_dict[key.lower()] = value
+        self.body = body
+
+    def getheaders(self):
+        return self.headers
+
+    def getheader(self, name, default = None):
+        return self.header_dict.get(name.lower(), default)
+
+    def read(self):
+        return self.body
+
+class PooledConnection(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.last_used = time.time()
+
+class HttpConnectionPool(object):
+    """
+    Keep-alive connections shared by all HttpUtil callers, keyed per target host.
+    Connections are never shared across processes: a forked child (parallel snapshot) starts with an empty pool.
+    """
+    MaxIdleConnectionsPerHost = 8
+    MaxIdleSeconds = 30
+    MaxDrainBytes = 64 * 1024
+    ConnectionDroppedErrors = (httplibs.BadStatusLine, httplibs.CannotSendRequest, httplibs.ResponseNotReady, socket.error)
+    # requests that can be sent again when a reused connection drops after they were sent
+    IdempotentMethods = ('GET', 'HEAD')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.idle_connections = {}
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+
+    def check_process(self):
+        # sockets inherited over fork are shared with the parent, so the child must not touch them
+        if(self.pid != os.getpid()):
+            self.reset()
+
+    def acquire(self, key, connection_factory):
+        self.check_process()
+        while True:
+            pooled = None
+            with self.lock:
+                connections = self.idle_connections.get(key)
+                if(connections):
+                    pooled = connections.pop()
+            if(pooled is None):
+                with self.lock:
+                    self.misses += 1
+                return connection_factory(), False
+            if(self.is_stale(pooled)):
+                pooled.connection.close()
+                self.record_reconnect()
+                continue
+            with self.lock:
+                self.hits += 1
+            return pooled.connection, True
+
+    def release(self, key, connection):
+        if(self.pid == os.getpid()):
+            with self.lock:
+                connections = self.idle_connections.setdefault(key, [])
+                if(len(connections) < self.MaxIdleConnectionsPerHost):
+                    connections.append(PooledConnection(connection))
+                    return
+        connection.close()
+
+    def has_idle_connection(self, key):
+        self.check_process()
+        with self.lock:
+            connections = list(self.idle_connections.get(key, []))
+        for pooled in connections:
+            if(not self.is_stale(pooled)):
+                return True
+        return False
+
+    def is_stale(self, pooled):
+        if(time.time() - pooled.last_used > self.MaxIdleSeconds):
+            return True
+        sock = pooled.connection.sock
+        if(sock is None):
+            return True
+        try:
+            # an idle keep-alive socket only turns readable when the peer has closed it
+            readable, writable, errored = select.select([sock], [], [], 0)
+            return len(readable) > 0
+        except Exception:
+            return True
+
+    def record_reconnect(self):
+        with self.lock:
+            self.reconnects += 1
+
+    def get_stats(self):
+        with self.lock:
+            idle = 0
+            for connections in self.idle_connections.values():
+                idle += len(connections)
+            return {'hits' : self.hits, 'misses' : self.misses, 'reconnects' : self.reconnects, 'idle' : idle}
+
 class HttpUtil(object):
     """description of class"""
     __instance = None
+    __instance_lock = threading.Lock()
     """Singleton class initialization"""
     def __new__(cls, hutil):
         if(cls.__instance is None):
-            hutil.log("Creating HttpUtil")
-            cls.__instance = super(HttpUtil, cls).__new__(cls)
-            Config = None
-            cls.__instance.proxyHost = None
-            cls.__instance.proxyPort = None
-            try:
-                waagent.MyDistro = waagent.GetMyDistro()
-                Config = waagent.ConfigurationProvider(None)
-            except Exception as e:
-                errorMsg = "Failed to construct ConfigurationProvider, which may due to the old wala code with error: %s, stack trace: %s" % (str(e), traceback.format_exc())
-                hutil.log(errorMsg)
-                Config = None
-            cls.__instance.logger = hutil
-            if Config != None:
-                cls.__instance.proxyHost = Config.get("HttpProxy.Host")
-                cls.__instance.proxyPort = Config.get("HttpProxy.Port")
-            cls.__instance.tmpFile = './tmp_file_FD76C85E-406F-4CFA-8EB0-CF18B123365C'
-        else:
-            cls.__instance.logger = hutil
-            cls.__instance.logger.log("Returning HttpUtil")
+            with cls.__instance_lock:
+                if(cls.__instance is None):
+                    # publish the instance only once it is fully initialized, snapshot threads may construct it concurrently
+                    cls.__instance = cls.create_instance(hutil)
+                    return cls.__instance
+        cls.__instance.logger = hutil
+        cls.__instance.logger.log("Returning HttpUtil")
         return cls.__instance
 
+    @classmethod
+    def create_instance(cls, hutil):
+        hutil.log("Creating HttpUtil")
+        instance = super(HttpUtil, cls).__new__(cls)
+        Config = None
+        instance.proxyHost = None
+        instance.proxyPort = None
+        try:
+            waagent.MyDistro = waagent.GetMyDistro()
+            Config = waagent.ConfigurationProvider(None)
+        except Exception as e:
+            errorMsg = "Failed to construct ConfigurationProvider, which may due to the old wala code with error: %s, stack trace: %s" % (str(e), traceback.format_exc())
+            hutil.log(errorMsg)
+            Config = None
+        instance.logger = hutil
+        if Config != None:
+            instance.proxyHost = Config.get("HttpProxy.Host")
+            instance.proxyPort = Config.get("HttpProxy.Port")
+        instance.tmpFile = './tmp_file_FD76C85E-406F-4CFA-8EB0-CF18B123365C'
+        instance.connection_pool = HttpConnectionPool()
+        return instance
+
     """
     snapshot also called this. so we should not write the file/read the file in this method.
     """
@@ -73,6 +203,8 @@ class HttpUtil(object):
             commandToExecute = 'curl --request PUT --connect-timeout 10 --data-binary @-' + ' ' + header_str + ' "' + sasuri_obj.scheme + '://' + sasuri_obj.hostname + sasuri_obj.path + '?' + sasuri_obj.query + '"'\
                 + '--proxy ' + self.proxyHost + ':' + self.proxyPort + ' -v'
         args = shlex.split(commandToExecute.encode('ascii'))
+        if(isinstance(data, memoryview)):
+            data = data.tobytes()
         proc = Popen(args,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
         proc.stdin.write(data)
         curlResult,err = proc.communicate()
@@ -123,24 +255,23 @@ class HttpUtil(object):
             self.logger.log("Entered HttpCallGetResponse, isHostCall: " + str(isHostCall))
 
             if(isHostCall or self.proxyHost == None or self.proxyPort != None):
+                hostname = sasuri_obj.hostname
                 if(isHostCall):
-                    connection = httplibs.HTTPConnection(sasuri_obj.hostname, timeout = 10) # making call with port 80 to make it http call
+                    pool_key = ('http', hostname)
+                    connection_factory = lambda: self.create_host_connection(hostname)
                 else:
-                    connection = httplibs.HTTPSConnection(sasuri_obj.hostname, timeout = 10)
+                    pool_key = ('https', hostname)
+                    connection_factory = lambda: httplibs.HTTPSConnection(hostname, timeout = 10)
                 self.logger.log("Details of sas uri object  hostname: " + str(sasuri_obj.hostname) + " path: " + str(sasuri_obj.path))
-                connection.request(method=method, url=(sasuri_obj.path + '?' + sasuri_obj.query), body=data, headers = headers)
-                resp = connection.getresponse()
-                if(responseBodyRequired):
-                    responeBody = resp.read().decode('utf-8-sig')
-                connection.close()
+                resp = self.send_pooled_request(pool_key, connection_factory, method, (sasuri_obj.path + '?' + sasuri_obj.query), data, headers)
             else:
-                connection = httplibs.HTTPSConnection(self.proxyHost, self.proxyPort, timeout = 10)
-                connection.set_tunnel(sasuri_obj.hostname, 443)
+                pool_key = ('https-tunnel', sasuri_obj.hostname, self.proxyHost, self.proxyPort)
+                connection_factory = lambda: self.create_tunnel_connection(sasuri_obj.hostname)
                 # If proxy is used, full url is needed.
                 path = "https://{0}:{1}{2}".format(sasuri_obj.hostname, 443, (sasuri_obj.path + '?' + sasuri_obj.query))
-                connection.request(method=method, url=(path), body=data, headers=headers)
-                resp = connection.getresponse()
-                connection.close()
+                resp = self.send_pooled_request(pool_key, connection_factory, method, path, data, headers)
+            if(responseBodyRequired):
+                responeBody = resp.read().decode('utf-8-sig')
             result = CommonVariables.success
         except Exception as e:
             errorMsg = str(datetime.datetime.now()) +  " Failed to call http with error: %s, stack trace: %s" % (str(e), traceback.format_exc())
@@ -151,3 +282,73 @@ class HttpUtil(object):
             return result, resp, errorMsg, responeBody
         else:
             return result, resp, errorMsg
+
+    def create_host_connection(self, hostname):
+        return httplibs.HTTPConnection(hostname, timeout = 10) # making call with port 80 to make it http call
+
+    def warm_host_connection(self, hostname):
+        """
+        Connects to the host ahead of a latency sensitive call (dosnapshot while frozen) unless the pool already has a live connection to it.
+        Returns True if a new connection was opened.
+        """
+        pool_key = ('http', hostname)
+        if(self.connection_pool.has_idle_connection(pool_key)):
+            return False
+        connection = self.create_host_connection(hostname)
+        try:
+            connection.connect()
+        except Exception:
+            connection.close()
+            raise
+        self.connection_pool.release(pool_key, connection)
+        return True
+
+    def create_tunnel_connection(self, hostname):
+        connection = httplibs.HTTPSConnection(self.proxyHost, self.proxyPort, timeout = 10)
+        connection.set_tunnel(hostname, 443)
+        return connection
+
+    def send_pooled_request(self, pool_key, connection_factory, method, url, data, headers):
+        connection, reused = self.connection_pool.acquire(pool_key, connection_factory)
+        sent = False
+        try:
+            self.send_request(connection, method, url, data, headers)
+            sent = True
+            resp, reusable = self.get_response(connection)
+        except HttpConnectionPool.ConnectionDroppedErrors as e:
+            connection.close()
+            if(not reused or isinstance(e, socket.timeout)):
+                raise
+            if(sent and method not in HttpConnectionPool.IdempotentMethods):
+                # the server may have processed the request before the connection dropped, a snapshot or host call must not be repeated
+                raise
+            self.logger.log("Pooled connection to " + str(pool_key[1]) + " was dropped by the server (" + str(e) + "), reconnecting")
+            self.connection_pool.record_reconnect()
+            connection = connection_factory()
+            try:
+                self.send_request(connection, method, url, data, headers)
+                resp, reusable = self.get_response(connection)
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            connection.close()
+            raise
+        if(reusable):
+            self.connection_pool.release(pool_key, connection)
+        # a non reusable connection stays referenced by its response until the caller is done reading it
+        return resp
+
+    def send_request(self, connection, method, url, data, headers):
+        connection.request(method=method, url=url, body=data, headers = headers)
+
+    def get_response(self, connection):
+        resp = connection.getresponse()
+        if(resp.length is not None and resp.length > HttpConnectionPool.MaxDrainBytes):
+            # large bodies (e.g. GET on a page blob) are left to the caller, the connection can not be reused
+            return resp, False
+        body = resp.read()
+        return BufferedHttpResponse(resp, body), not resp.will_close
+
+    def get_connection_pool_stats(self):
+        return self.connection_pool.get_stats()
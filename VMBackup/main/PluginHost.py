@@ -1,13 +1,13 @@
-import time
 import sys
 import os
-import threading
 import platform
 try:
     import ConfigParser as ConfigParsers
 except ImportError:
     import configparser as ConfigParsers
 from common import CommonVariables
+from ScriptScheduler import ScriptScheduler
+from Utils import HandlerUtil
 from pwd import getpwuid
 from stat import *
 import traceback
@@ -193,26 +193,36 @@ class PluginHost(object):
         return permissions
 
 
+    def add_script_telemetry(self, key, scriptResults):
+        durations = []
+        for j in range(0,self.noOfPlugins):
+            if scriptResults[j] is not None and getattr(scriptResults[j], 'durationInMs', None) is not None:
+                durations.append(self.pluginName[j] + ':' + str(scriptResults[j].durationInMs))
+        if len(durations) > 0:
+            HandlerUtil.HandlerUtility.add_to_telemetery_data(key, ','.join(durations))
+
     def pre_script(self):
 
             # Runs pre_script() for all plugins and maintains a timer
 
 
         result = PluginHostResult()
+        scheduler = ScriptScheduler(self.logger)
         curr = 0
         for plugin in self.plugins:
-            t1 = threading.Thread(target=plugin.pre_script, args=(curr, self.preScriptCompleted, self.preScriptResult))
-            t1.start()
+            plugin.pre_script(curr, self.preScriptCompleted, self.preScriptResult, scheduler)
             curr = curr + 1
 
+        # returns as soon as the last script exits or timed out on the plugin side
+        scheduler.run(self.timeoutInSeconds + 10) #waiting 10 more seconds to escape race condition between Host and script timing out
+        scheduler.close()
+
         flag = True
-        for i in range(0, int(self.timeoutInSeconds/self.pollTime) + 2): #waiting 10 more seconds to escape race condition between Host and script timing out
-            time.sleep(self.pollTime)
-            flag = True
-            for j in range(0,self.noOfPlugins):
-                flag = flag & self.preScriptCompleted[j]
-            if flag:
+        for j in range(0,self.noOfPlugins):
+            if not self.preScriptCompleted[j]:
+                flag = False
                 break
+        self.add_script_telemetry('preScriptDurationInMs', self.preScriptResult)
 
 
         continueBackup = True
@@ -246,20 +256,22 @@ class PluginHost(object):
             return result
 
         self.logger.log('Starting postscript for all modules.',True,'Info')
+        scheduler = ScriptScheduler(self.logger)
         curr = 0
         for plugin in self.plugins:
-            t1 = threading.Thread(target=plugin.post_script, args=(curr, self.postScriptCompleted, self.postScriptResult))
-            t1.start()
+            plugin.post_script(curr, self.postScriptCompleted, self.postScriptResult, scheduler)
             curr = curr + 1
 
+        # returns as soon as the last script exits or timed out on the plugin side
+        scheduler.run(self.timeoutInSeconds + 10) #waiting 10 more seconds to escape race condition between Host and script timing out
+        scheduler.close()
+
         flag = True
-        for i in range(0, int(self.timeoutInSeconds/self.pollTime) + 2): #waiting 10 more seconds to escape race condition between Host and script timing out
-            time.sleep(self.pollTime)
-            flag = True
-            for j in range(0,self.noOfPlugins):
-                flag = flag & self.postScriptCompleted[j]
-            if flag:
+        for j in range(0,self.noOfPlugins):
+            if not self.postScriptCompleted[j]:
+                flag = False
                 break
+        self.add_script_telemetry('postScriptDurationInMs', self.postScriptResult)
 
         continueBackup = True
 
@@ -7,6 +7,8 @@ from stat import *
 from common import CommonVariables
 import traceback
 from Utils import HandlerUtil
+from Utils.SpanTracer import monotonic_now
+from ScriptScheduler import ScriptScheduler
 
     # config.json --------structure---------
     # {
@@ -44,6 +46,9 @@ class ScriptRunnerResult(object):
         self.requiredNoOfRetries = 0
         self.fileCode = []
         self.filePath = []
+        self.startTime = None
+        self.finishTime = None
+        self.durationInMs = None
 
     def __str__(self):
         errorStr =  'ErrorCode :- ' + str(self.errorCode) + '\n'
@@ -190,110 +195,97 @@ class ScriptRunner(object):
 
         return errorCode,dobackup,self.fsFreeze_on, self.pollSleepTime
 
-    def pre_script(self, pluginIndex, preScriptCompleted, preScriptResult):
+    def pre_script(self, pluginIndex, preScriptCompleted, preScriptResult, scheduler = None):
 
             # Generates a system call to run the prescript
             # -- pluginIndex is the index for the current plugin assigned by pluginHost
             # -- preScriptCompleted is a bool array, upon completion of script, true will be assigned at pluginIndex
             # -- preScriptResult is an array and it stores the result at pluginIndex
+            # -- scheduler is the ScriptScheduler pluginHost runs all scripts on, without one the script is run to completion here
 
+        self.run_script('Prescript', self.preScriptLocation, self.preScriptParams, self.preScriptNoOfRetries, pluginIndex, preScriptCompleted, preScriptResult, scheduler)
 
-        result = ScriptRunnerResult()
-        result.requiredNoOfRetries = self.preScriptNoOfRetries
-
-        paramsStr = ['sh',str(self.preScriptLocation)]
-        for param in self.preScriptParams:
-            paramsStr.append(str(param))
-
-        self.logger.log('Running prescript for '+self.pluginName+' module...',True,'Info')
-        process = subprocess.Popen(paramsStr, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        flag_timeout = False
-        curr = 0
-        cnt = 0
-        while True:
-            while process.poll() is None:
-                if curr >= self.pollTotalCount:
-                    self.logger.log('Prescript for '+self.pluginName+' timed out.',True,'Error')
-                    flag_timeout = True
-                    break
-                curr = curr + 1
-                time.sleep(self.pollSleepTime)
-            if process.returncode is CommonVariables.PrePost_ScriptStatus_Success:
-                break
-            if flag_timeout:
-                break
-            if cnt >= self.preScriptNoOfRetries:
-                break
-            self.logger.log('Prescript for '+self.pluginName+' failed. Retrying...',True,'Info')
-            cnt = cnt + 1
-
-
-        result.noOfRetries = cnt
-        if not flag_timeout:
-            result.errorCode = process.returncode
-            if result.errorCode != CommonVariables.PrePost_ScriptStatus_Success:
-                self.logger.log('Prescript for '+self.pluginName+' failed with error code: '+str(result.errorCode)+' .',True,'Error')
-                result.continueBackup = self.continueBackupOnFailure
-                result.errorCode = CommonVariables.FailedPrepostPreScriptFailed
-            else:
-                self.PreScriptCompletedSuccessfully = True
-                self.logger.log('Prescript for '+self.pluginName+' successfully executed.',True,'Info')
-        else:
-            result.errorCode =  CommonVariables.FailedPrepostPreScriptTimeout
-            result.continueBackup = self.continueBackupOnFailure
-        preScriptCompleted[pluginIndex] = True
-        preScriptResult[pluginIndex] = result
-
-    def post_script(self, pluginIndex, postScriptCompleted, postScriptResult):
+    def post_script(self, pluginIndex, postScriptCompleted, postScriptResult, scheduler = None):
 
             # Generates a system call to run the postscript
             # -- pluginIndex is the index for the current plugin assigned by pluginHost
             # -- postScriptCompleted is a bool array, upon completion of script, true will be assigned at pluginIndex
             # -- postScriptResult is an array and it stores the result at pluginIndex
+            # -- scheduler is the ScriptScheduler pluginHost runs all scripts on, without one the script is run to completion here
 
-        result = ScriptRunnerResult()
+        self.run_script('Postscript', self.postScriptLocation, self.postScriptParams, self.postScriptNoOfRetries, pluginIndex, postScriptCompleted, postScriptResult, scheduler)
+
+    def run_script(self, scriptType, scriptLocation, scriptParams, noOfRetries, pluginIndex, scriptCompleted, scriptResult, scheduler):
 
-        result.requiredNoOfRetries = self.postScriptNoOfRetries
+            # Starts the script on the scheduler, retries it when it fails and fills in the result
+            # as soon as it exits or when timeoutInSeconds since the first run passed
 
-        paramsStr = ['sh',str(self.postScriptLocation)]
-        for param in self.postScriptParams:
+        result = ScriptRunnerResult()
+        result.requiredNoOfRetries = noOfRetries
+
+        paramsStr = ['sh',str(scriptLocation)]
+        for param in scriptParams:
             paramsStr.append(str(param))
 
-        self.logger.log('Running postscript for '+self.pluginName+' module...',True,'Info')
-        process = subprocess.Popen(paramsStr, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        flag_timeout = False
-        curr = 0
-        cnt = 0
-        while True:
-            while process.poll() is None:
-                if curr >= self.pollTotalCount:
-                    self.logger.log('Postscript for '+self.pluginName+' timed out.',True,'Error')
-                    flag_timeout = True
-                    break
-                curr = curr + 1
-                time.sleep(self.pollSleepTime)
-            if process.returncode is CommonVariables.PrePost_ScriptStatus_Success:
-                break
-            if flag_timeout:
-                break
-            if cnt >= self.postScriptNoOfRetries:
-                break
-            self.logger.log('Postscript for '+self.pluginName+' failed. Retrying...',True,'Info')
-            cnt = cnt + 1
-
-        result.noOfRetries = cnt
-        if not flag_timeout:
-            result.errorCode = process.returncode
+        ownScheduler = scheduler is None
+        if ownScheduler:
+            scheduler = ScriptScheduler(self.logger)
+        # the running task and its timeout timer, updated from the callbacks
+        state = {'task' : None, 'timer' : None, 'startTime' : monotonic_now()}
+
+        def complete():
+            result.durationInMs = int((monotonic_now() - state['startTime']) * 1000)
+            result.finishTime = time.time()
+            self.logger.log(scriptType + ' for ' + self.pluginName + ' ran for ' + str(result.durationInMs) + ' ms, retries: ' + str(result.noOfRetries), True, 'Info')
+            scriptResult[pluginIndex] = result
+            scriptCompleted[pluginIndex] = True
+
+        def start():
+            try:
+                state['task'] = scheduler.start(self.pluginName + ' ' + scriptType, paramsStr, on_exit)
+                return True
+            except Exception as err:
+                errMsg = 'Error in starting ' + scriptType + ' for ' + self.pluginName + ': %s, stack trace: %s' % (str(err), traceback.format_exc())
+                self.logger.log(errMsg, True, 'Error')
+                return False
+
+        def on_exit(task):
+            if task.returnCode != CommonVariables.PrePost_ScriptStatus_Success and result.noOfRetries < noOfRetries:
+                self.logger.log(scriptType + ' for ' + self.pluginName + ' failed. Retrying...', True, 'Info')
+                result.noOfRetries = result.noOfRetries + 1
+                if start():
+                    return
+            state['timer'].cancel()
+            result.errorCode = task.returnCode
             if result.errorCode != CommonVariables.PrePost_ScriptStatus_Success:
-                self.logger.log('Postscript for '+self.pluginName+' failed with error code: '+str(result.errorCode)+' .',True,'Error')
-                result.errorCode = CommonVariables.FailedPrepostPostScriptFailed
+                self.logger.log(scriptType + ' for ' + self.pluginName + ' failed with error code: ' + str(result.errorCode) + ' .', True, 'Error')
+                if len(task.outputTail) > 0:
+                    self.logger.log(scriptType + ' for ' + self.pluginName + ' output: ' + task.outputTail.decode('utf-8', 'replace').rstrip(), True, 'Info')
                 result.continueBackup = self.continueBackupOnFailure
+                result.errorCode = CommonVariables.FailedPrepostPreScriptFailed if scriptType == 'Prescript' else CommonVariables.FailedPrepostPostScriptFailed
             else:
-                self.logger.log('Postscript for '+self.pluginName+' successfully executed.',True,'Info')
+                if scriptType == 'Prescript':
+                    self.PreScriptCompletedSuccessfully = True
+                self.logger.log(scriptType + ' for ' + self.pluginName + ' successfully executed.', True, 'Info')
+            complete()
+
+        def on_timeout():
+            # the script is left running as before, only its result is given up on
+            self.logger.log(scriptType + ' for ' + self.pluginName + ' timed out.', True, 'Error')
+            scheduler.abandon(state['task'])
+            result.errorCode = CommonVariables.FailedPrepostPreScriptTimeout if scriptType == 'Prescript' else CommonVariables.FailedPrepostPostScriptTimeout
+            result.continueBackup = self.continueBackupOnFailure
+            complete()
+
+        self.logger.log('Running ' + scriptType.lower() + ' for ' + self.pluginName + ' module...', True, 'Info')
+        result.startTime = time.time()
+        if start():
+            state['timer'] = scheduler.schedule_timeout(state['startTime'] + self.timeoutInSeconds, on_timeout)
+            if ownScheduler:
+                scheduler.run()
         else:
-            result.errorCode =  CommonVariables.FailedPrepostPostScriptTimeout
+            result.errorCode = CommonVariables.FailedPrepostPreScriptFailed if scriptType == 'Prescript' else CommonVariables.FailedPrepostPostScriptFailed
             result.continueBackup = self.continueBackupOnFailure
-        postScriptCompleted[pluginIndex] = True
-        postScriptResult[pluginIndex] = result
+            complete()
+        if ownScheduler:
+            scheduler.close()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import select
+import subprocess
+import threading
+import traceback
+from Utils.SpanTracer import monotonic_now
+
+class TimerEntry(object):
+    def __init__(self, tick, deadline, callback):
+        self.tick = tick
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel on the monotonic clock, a timer fires on the first advance() at or after its deadline.
+    """
+    def __init__(self, tickInSeconds = 0.1, slotCount = 256):
+        self.tickInSeconds = tickInSeconds
+        self.slots = [[] for i in range(slotCount)]
+        self.origin = monotonic_now()
+        self.currentTick = 0
+
+    def get_tick(self, deadline):
+        return int((deadline - self.origin) / self.tickInSeconds)
+
+    def schedule(self, deadline, callback):
+        entry = TimerEntry(max(self.get_tick(deadline), self.currentTick), deadline, callback)
+        self.slots[entry.tick % len(self.slots)].append(entry)
+        return entry
+
+    def next_deadline(self):
+        deadlines = [entry.deadline for slot in self.slots for entry in slot if not entry.cancelled]
+        if len(deadlines) == 0:
+            return None
+        return min(deadlines)
+
+    def advance(self, now):
+        expired = []
+        nowTick = self.get_tick(now)
+        # every slot is visited at most once, whatever the time since the last advance
+        firstTick = max(self.currentTick, nowTick - len(self.slots) + 1)
+        for tick in range(firstTick, nowTick + 1):
+            pending = []
+            for entry in self.slots[tick % len(self.slots)]:
+                if entry.cancelled:
+                    continue
+                elif entry.deadline <= now:
+                    expired.append(entry)
+                else:
+                    pending.append(entry)
+            self.slots[tick % len(self.slots)] = pending
+        self.currentTick = max(self.currentTick, nowTick)
+        for entry in expired:
+            entry.callback()
+        return len(expired)
+
+class ScriptTask(object):
+    """ one run of a script, startTime and finishTime are monotonic """
+    OutputTailBytes = 4096
+
+    def __init__(self, name, args, onExit):
+        self.name = name
+        self.args = args
+        self.onExit = onExit
+        self.process = None
+        self.startTime = None
+        self.finishTime = None
+        self.returnCode = None
+        self.outputTail = b''
+
+    def duration_in_ms(self):
+        if self.finishTime is None:
+            return None
+        return int((self.finishTime - self.startTime) * 1000)
+
+class ScriptScheduler(object):
+    """
+    Runs scripts concurrently and calls onExit as soon as each one exits, instead of polling them.
+    A waiter thread per script blocks in waitpid and wakes run() through a pipe, output of the scripts
+    is drained from their pipes by the same select and timeouts are kept on a TimerWheel.
+    """
+    MaxReadsAfterExit = 16
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.timerWheel = TimerWheel()
+        self.lock = threading.Lock()
+        self.running = set()
+        self.exited = []
+        self.outputPipes = {}
+        self.waiterCount = 0
+        self.closed = False
+        self.wakeupReadFd, self.wakeupWriteFd = os.pipe()
+
+    def start(self, name, args, onExit):
+        """
+        Starts a script, onExit(task) is called from run() once it exited, unless it was abandoned before.
+        """
+        task = ScriptTask(name, args, onExit)
+        task.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        task.startTime = monotonic_now()
+        self.running.add(task)
+        self.outputPipes[task.process.stdout.fileno()] = (task, task.process.stdout)
+        self.outputPipes[task.process.stderr.fileno()] = (task, task.process.stderr)
+        with self.lock:
+            self.waiterCount = self.waiterCount + 1
+        waiter = threading.Thread(target=self.wait_for_exit, args=(task,))
+        waiter.daemon = True
+        waiter.start()
+        return task
+
+    def wait_for_exit(self, task):
+        try:
+            task.process.wait()
+        except Exception as e:
+            errMsg = 'Failed to wait for script ' + task.name + ' with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+            self.logger.log(errMsg, True, 'Error')
+        with self.lock:
+            task.finishTime = monotonic_now()
+            task.returnCode = task.process.returncode
+            self.exited.append(task)
+            self.waiterCount = self.waiterCount - 1
+            if self.closed:
+                if self.waiterCount == 0:
+                    self.close_wakeup_pipe()
+            else:
+                os.write(self.wakeupWriteFd, b'x')
+
+    def schedule_timeout(self, deadline, callback):
+        """ deadline is on the monotonic clock, the returned entry can be cancelled """
+        return self.timerWheel.schedule(deadline, callback)
+
+    def abandon(self, task):
+        """ stops tracking a script that is left running, its onExit will not be called """
+        self.running.discard(task)
+        for fd in [fd for fd, (pipeTask, pipe) in self.outputPipes.items() if pipeTask is task]:
+            del self.outputPipes[fd]
+
+    def read_output(self, fd):
+        task, pipe = self.outputPipes[fd]
+        data = os.read(fd, 65536)
+        if len(data) == 0:
+            del self.outputPipes[fd]
+            pipe.close()
+        else:
+            task.outputTail = (task.outputTail + data)[-ScriptTask.OutputTailBytes:]
+
+    def dispatch_exits(self):
+        with self.lock:
+            exited = self.exited
+            self.exited = []
+        for task in exited:
+            if task not in self.running:
+                continue
+            # whatever the script wrote before exiting is still in its pipes
+            for fd in [fd for fd, (pipeTask, pipe) in self.outputPipes.items() if pipeTask is task]:
+                for i in range(ScriptScheduler.MaxReadsAfterExit):
+                    if fd not in self.outputPipes or len(select.select([fd], [], [], 0)[0]) == 0:
+                        break
+                    self.read_output(fd)
+                if fd in self.outputPipes:
+                    # a background child of the script still holds the pipe
+                    self.outputPipes.pop(fd)[1].close()
+            self.running.discard(task)
+            task.onExit(task)
+
+    def run(self, timeoutInSeconds = None):
+        """
+        Dispatches script exits, output and timers until no script is running or timeoutInSeconds passed.
+        Returns True if every script was done with.
+        """
+        deadline = None
+        if timeoutInSeconds is not None:
+            deadline = monotonic_now() + timeoutInSeconds
+        while len(self.running) > 0:
+            now = monotonic_now()
+            if deadline is not None and now >= deadline:
+                break
+            self.timerWheel.advance(now)
+            self.dispatch_exits()
+            if len(self.running) == 0:
+                break
+            waitUntil = self.timerWheel.next_deadline()
+            if deadline is not None and (waitUntil is None or deadline < waitUntil):
+                waitUntil = deadline
+            waitTime = None
+            if waitUntil is not None:
+                waitTime = max(waitUntil - now, 0)
+            try:
+                readable, writable, exceptional = select.select([self.wakeupReadFd] + list(self.outputPipes.keys()), [], [], waitTime)
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                if fd == self.wakeupReadFd:
+                    os.read(fd, 4096)
+                elif fd in self.outputPipes:
+                    self.read_output(fd)
+        return len(self.running) == 0
+
+    def close(self):
+        """ abandoned scripts may still be running, the wakeup pipe is closed once their waiters are done """
+        for fd, (task, pipe) in list(self.outputPipes.items()):
+            pipe.close()
+        self.outputPipes = {}
+        with self.lock:
+            self.closed = True
+            if self.waiterCount == 0:
+                self.close_wakeup_pipe()
+
+    def close_wakeup_pipe(self):
+        os.close(self.wakeupReadFd)
+        os.close(self.wakeupWriteFd)
@@ -19,6 +19,7 @@
 import subprocess
 import os
 import os.path
+import re
 import shlex
 import sys
 from subprocess import *
@@ -29,104 +30,208 @@ from common import DeviceItem
 import Utils.HandlerUtil
 import traceback
 
+class DeviceTable(object):
+    """
+    Indexed snapshot of the block devices, taken once per run and shared by Mounts, FsFreezer and SizeCalculation.
+    """
+    def __init__(self, device_items):
+        self.device_items = device_items
+        self.by_name = {}
+        self.by_kname = {}
+        self.by_mount_point = {}
+        for device_item in device_items:
+            # keep the first device like list.index did
+            if(device_item.name is not None and device_item.name not in self.by_name):
+                self.by_name[device_item.name] = device_item
+            if(device_item.kname is not None and device_item.kname not in self.by_kname):
+                self.by_kname[device_item.kname] = device_item
+            if(DeviceTable.is_mounted(device_item) and device_item.mount_point not in self.by_mount_point):
+                self.by_mount_point[device_item.mount_point] = device_item
+
+    @staticmethod
+    def is_mounted(device_item):
+        return device_item.mount_point is not None and device_item.mount_point != "" and device_item.mount_point != " "
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+    def get_by_kname(self, kname):
+        return self.by_kname.get(kname)
+
+    def get_by_mount_point(self, mount_point):
+        return self.by_mount_point.get(mount_point)
+
+    def get_mounted_device_items(self):
+        return [device_item for device_item in self.device_items if DeviceTable.is_mounted(device_item)]
+
 class DiskUtil(object):
     def __init__(self, patching, logger):
         self.patching = patching
         self.logger = logger
 
-    def get_device_items_property(self, lsblk_path, dev_name, property_name):
-        get_property_cmd = lsblk_path + " /dev/" + dev_name + " -b -nl -o NAME," + property_name
-        get_property_cmd_args = shlex.split(get_property_cmd)
-        get_property_cmd_p = Popen(get_property_cmd_args,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        output,err = get_property_cmd_p.communicate()
-        output= str(output)
-        lines = output.splitlines()
-        for i in range(0,len(lines)):
-            item_value_str = lines[i].strip()
-            if(item_value_str != ""):
-                disk_info_item_array = item_value_str.split()
-                if(dev_name == disk_info_item_array[0]):
-                    if(len(disk_info_item_array) > 1):
-                        return disk_info_item_array[1]
-        return None
+    lsblk_columns = 'NAME,KNAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE'
+    lsblk_pair_pattern = re.compile(r'([A-Z:\-]+)="((?:[^"\\]|\\.)*)"')
+    lsblk_escape_pattern = re.compile(r'\\x([0-9a-fA-F]{2})')
+    mount_escape_pattern = re.compile(r'\\([0-7]{3})')
+    device_table = None
 
-    def get_device_items_sles(self,dev_path):
-        self.logger.log("get_device_items_sles : getting the blk info from " + str(dev_path), True)
+    def get_device_table(self):
+        if(DiskUtil.device_table is None):
+            DiskUtil.device_table = DeviceTable(self.get_all_device_items())
+            self.logger.log("device table built with " + str(len(DiskUtil.device_table.device_items)) + " devices", True)
+        return DiskUtil.device_table
+
+    @staticmethod
+    def invalidate_device_table():
+        DiskUtil.device_table = None
+
+    @staticmethod
+    def read_sys_file(file_path):
+        try:
+            with open(file_path, 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def get_disk_links(self, links_folder):
+        # /dev/disk/by-uuid and /dev/disk/by-label hold one symlink per device, keyed by the kernel name they resolve to
+        links = {}
+        if(os.path.isdir(links_folder)):
+            for link_name in os.listdir(links_folder):
+                kname = os.path.basename(os.path.realpath(os.path.join(links_folder, link_name)))
+                links[kname] = DiskUtil.unescape_lsblk_value(link_name)
+        return links
+
+    @staticmethod
+    def unescape_mount_value(value):
+        # /proc/self/mounts octal escapes space, tab, newline and backslash, e.g. a space is \040
+        return DiskUtil.mount_escape_pattern.sub(lambda match: chr(int(match.group(1), 8)), value)
+
+    def get_mount_table(self):
+        """
+        (file_system, fs_type, mount_point) of every mount from /proc/self/mounts, in the format of get_mount_file_systems.
+        Falls back to the mount command where there is no /proc.
+        """
+        if(not os.path.isfile('/proc/self/mounts')):
+            return self.get_mount_file_systems()
+        file_systems_info = []
+        index_by_mount_point = {}
+        with open('/proc/self/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if(len(fields) < 3):
+                    continue
+                file_system_info = (DiskUtil.unescape_mount_value(fields[0]), fields[2], DiskUtil.unescape_mount_value(fields[1]))
+                # a later mount on the same mount point hides the earlier one
+                if(file_system_info[2] in index_by_mount_point):
+                    file_systems_info[index_by_mount_point[file_system_info[2]]] = file_system_info
+                else:
+                    index_by_mount_point[file_system_info[2]] = len(file_systems_info)
+                    file_systems_info.append(file_system_info)
+        return file_systems_info
+
+    def get_mounts_by_kname(self):
+        mounts_by_kname = {}
+        with open('/proc/self/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if(len(fields) > 2 and fields[0].startswith('/dev/')):
+                    kname = os.path.basename(os.path.realpath(fields[0]))
+                    if(kname not in mounts_by_kname):
+                        mount_point = DiskUtil.unescape_mount_value(fields[1])
+                        mounts_by_kname[kname] = (mount_point, fields[2])
+        return mounts_by_kname
+
+    def get_device_items_from_sys_block(self):
+        """
+        Builds the device items from /sys/block and /proc/self/mounts, for lsblk builds without the -P option.
+        """
+        self.logger.log("get_device_items_from_sys_block : getting the blk info from /sys/block", True)
         device_items = []
-        #first get all the device names
-        if(dev_path is None):
-            get_device_cmd = self.patching.lsblk_path + " -b -nl -o NAME"
-        else:
-            get_device_cmd = self.patching.lsblk_path + " -b -nl -o NAME " + dev_path
-        get_device_cmd_args = shlex.split(get_device_cmd)
-        p = Popen(get_device_cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out_lsblk_output, err = p.communicate()
-        out_lsblk_output = str(out_lsblk_output)
-        lines = out_lsblk_output.splitlines()
-        for i in range(0,len(lines)):
-            item_value_str = lines[i].strip()
-            if(item_value_str != ""):
-                disk_info_item_array = item_value_str.split()
+        mounts_by_kname = self.get_mounts_by_kname()
+        uuids = self.get_disk_links('/dev/disk/by-uuid')
+        labels = self.get_disk_links('/dev/disk/by-label')
+        for disk_kname in sorted(os.listdir('/sys/block')):
+            disk_folder = os.path.join('/sys/block', disk_kname)
+            knames = [(disk_kname, disk_folder)]
+            for entry in sorted(os.listdir(disk_folder)):
+                if(os.path.exists(os.path.join(disk_folder, entry, 'partition'))):
+                    knames.append((entry, os.path.join(disk_folder, entry)))
+            for kname, folder in knames:
                 device_item = DeviceItem()
-                device_item.name = disk_info_item_array[0]
+                device_item.kname = kname
+                device_item.name = kname
+                if(kname != disk_kname):
+                    device_item.type = 'part'
+                elif(kname.startswith('loop')):
+                    device_item.type = 'loop'
+                elif(os.path.exists(os.path.join(folder, 'dm'))):
+                    device_item.name = DiskUtil.read_sys_file(os.path.join(folder, 'dm', 'name')) or kname
+                    dm_uuid = DiskUtil.read_sys_file(os.path.join(folder, 'dm', 'uuid')) or ''
+                    if(dm_uuid.startswith('LVM-')):
+                        device_item.type = 'lvm'
+                    elif(dm_uuid.startswith('CRYPT-')):
+                        device_item.type = 'crypt'
+                    else:
+                        device_item.type = 'dm'
+                else:
+                    device_item.type = 'disk'
+                    device_item.model = DiskUtil.read_sys_file(os.path.join(folder, 'device', 'model'))
+                sectors = DiskUtil.read_sys_file(os.path.join(folder, 'size'))
+                if(sectors is not None and sectors.isdigit()):
+                    device_item.size = int(sectors) * 512
+                if(kname in mounts_by_kname):
+                    device_item.mount_point, device_item.file_system = mounts_by_kname[kname]
+                device_item.uuid = uuids.get(kname)
+                device_item.label = labels.get(kname)
                 device_items.append(device_item)
+                self.logger.log("sysfs MOUNTPOINT=" + str(device_item.mount_point) + ", NAME=" + str(device_item.name) + ", TYPE=" + str(device_item.type) + ", FSTYPE=" + str(device_item.file_system) + ", LABEL=" + str(device_item.label) + ", UUID=" + str(device_item.uuid) + ", MODEL=" + str(device_item.model), True)
+        return device_items
 
-        for i in range(0,len(device_items)):
-            device_item = device_items[i]
-            device_item.file_system = self.get_device_items_property(lsblk_path=self.patching.lsblk_path,dev_name=device_item.name,property_name='FSTYPE')
-            device_item.mount_point = self.get_device_items_property(lsblk_path=self.patching.lsblk_path,dev_name=device_item.name,property_name='MOUNTPOINT')
-            device_item.label = self.get_device_items_property(lsblk_path=self.patching.lsblk_path,dev_name=device_item.name,property_name='LABEL')
-            device_item.uuid = self.get_device_items_property(lsblk_path=self.patching.lsblk_path,dev_name=device_item.name,property_name='UUID')
-            #get the type of device
-            model_file_path = '/sys/block/' + device_item.name + '/device/model'
-            if(os.path.exists(model_file_path)):
-                with open(model_file_path,'r') as f:
-                    device_item.model = f.read().strip()
+    def get_device_items_sles(self,dev_path):
+        self.logger.log("get_device_items_sles : getting the blk info from " + str(dev_path), True)
+        device_items = self.get_device_items_from_sys_block()
+        if(dev_path is not None):
+            kname = os.path.basename(os.path.realpath(dev_path))
+            device_items = [device_item for device_item in device_items if device_item.kname == kname]
+        for device_item in device_items:
             if(device_item.model == 'Virtual Disk'):
                 self.logger.log("model is virtual disk", True)
                 device_item.type = 'disk'
-            if(device_item.type != 'disk'):
-                partition_files = glob.glob('/sys/block/*/' + device_item.name + '/partition')
-                if(partition_files is not None and len(partition_files) > 0):
-                    self.logger.log("partition files exists", True)
-                    device_item.type = 'part'
         return device_items
 
     def get_device_items_from_lsblk_list(self, lsblk_path, dev_path):
         self.logger.log("get_device_items_from_lsblk_list : getting the blk info from " + str(dev_path), True)
-        device_items = []
-        #first get all the device names
-        if(dev_path is None):
-            get_device_cmd = lsblk_path + " -b -nl -o NAME"
-        else:
-            get_device_cmd = lsblk_path + " -b -nl -o NAME " + dev_path
-        get_device_cmd_args = shlex.split(get_device_cmd)
-        p = Popen(get_device_cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out_lsblk_output, err = p.communicate()
-        if sys.version_info > (3,):
-            out_lsblk_output =str(out_lsblk_output, encoding='utf-8', errors="backslashreplace")
-        else:
-            out_lsblk_output =str(out_lsblk_output)
-        lines = out_lsblk_output.splitlines()
-        device_items_temp = []
-        for i in range(0,len(lines)):
-            item_value_str = lines[i].strip()
-            if(item_value_str != ""):
-                disk_info_item_array = item_value_str.split()
-                device_item = DeviceItem()
-                device_item.name = disk_info_item_array[0]
-                device_items_temp.append(device_item)
+        device_items = self.get_device_items_from_sys_block()
+        if(dev_path is not None):
+            kname = os.path.basename(os.path.realpath(dev_path))
+            device_items = [device_item for device_item in device_items if device_item.kname == kname]
+        return device_items
 
-        for i in range(0,len(device_items_temp)):
-            device_item = device_items_temp[i]
-            device_item.mount_point = self.get_device_items_property(lsblk_path=lsblk_path,dev_name=device_item.name,property_name='MOUNTPOINT')
-            if (device_item.mount_point is not None):
-                device_item.file_system = self.get_device_items_property(lsblk_path=lsblk_path,dev_name=device_item.name,property_name='FSTYPE')
-                device_item.label = self.get_device_items_property(lsblk_path=lsblk_path,dev_name=device_item.name,property_name='LABEL')
-                device_item.uuid = self.get_device_items_property(lsblk_path=lsblk_path,dev_name=device_item.name,property_name='UUID')
-                device_item.type = self.get_device_items_property(lsblk_path=lsblk_path,dev_name=device_item.name,property_name='TYPE')
-                device_items.append(device_item)
-                self.logger.log("lsblk MOUNTPOINT=" + str(device_item.mount_point) + ", NAME=" + str(device_item.name) + ", TYPE=" + str(device_item.type) + ", FSTYPE=" + str(device_item.file_system) + ", LABEL=" + str(device_item.label) + ", UUID=" + str(device_item.uuid) + ", MODEL=" + str(device_item.model), True)
+    @staticmethod
+    def unescape_lsblk_value(value):
+        # lsblk and udev hex escape unsafe characters, e.g. a space in a mount point is \x20
+        return DiskUtil.lsblk_escape_pattern.sub(lambda match: chr(int(match.group(1), 16)), value)
+
+    def parse_lsblk_pairs(self, out_lsblk_output):
+        device_items = []
+        for line in out_lsblk_output.splitlines():
+            pairs = dict(DiskUtil.lsblk_pair_pattern.findall(line))
+            if(len(pairs) == 0):
+                continue
+            device_item = DeviceItem()
+            device_item.name = DiskUtil.unescape_lsblk_value(pairs.get('NAME', ''))
+            device_item.kname = DiskUtil.unescape_lsblk_value(pairs.get('KNAME', '')) or device_item.name
+            device_item.type = pairs.get('TYPE')
+            device_item.file_system = pairs.get('FSTYPE')
+            device_item.mount_point = DiskUtil.unescape_lsblk_value(pairs.get('MOUNTPOINT', ''))
+            device_item.label = DiskUtil.unescape_lsblk_value(pairs.get('LABEL', ''))
+            device_item.uuid = pairs.get('UUID')
+            device_item.model = DiskUtil.unescape_lsblk_value(pairs.get('MODEL', '')).strip()
+            if(pairs.get('SIZE', '').isdigit()):
+                device_item.size = int(pairs['SIZE'])
+            device_items.append(device_item)
+            self.logger.log("lsblk MOUNTPOINT=" + str(device_item.mount_point) + ", NAME=" + str(device_item.name) + ", TYPE=" + str(device_item.type) + ", FSTYPE=" + str(device_item.file_system) + ", LABEL=" + str(device_item.label) + ", UUID=" + str(device_item.uuid) + ", MODEL=" + str(device_item.model), True)
         return device_items
 
     def get_lsblk_pairs_output(self, lsblk_path, dev_path):
@@ -136,9 +241,9 @@ class DiskUtil(object):
         is_lsblk_path_wrong = False
         try:
             if(dev_path is None):
-                p = Popen([str(lsblk_path), '-b', '-n','-P','-o','NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                p = Popen([str(lsblk_path), '-b', '-n','-P','-o',DiskUtil.lsblk_columns], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             else:
-                p = Popen([str(lsblk_path), '-b', '-n','-P','-o','NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE',dev_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                p = Popen([str(lsblk_path), '-b', '-n','-P','-o',DiskUtil.lsblk_columns,dev_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         except Exception as e:
             errMsg = 'Exception in lsblk command, error: %s, stack trace: %s' % (str(e), traceback.format_exc())
             self.logger.log(errMsg, True, 'Error')
@@ -177,6 +282,11 @@ class DiskUtil(object):
         return out_which_output, error_msg
 
     def get_device_items(self, dev_path):
+        if(dev_path is None):
+            return self.get_device_table().get_mounted_device_items()
+        return [device_item for device_item in self.get_all_device_items(dev_path) if DeviceTable.is_mounted(device_item)]
+
+    def get_all_device_items(self, dev_path = None):
         if(self.patching.distro_info[0].lower() == 'suse' and self.patching.distro_info[1] == '11'):
             return self.get_device_items_sles(dev_path)
         else:
@@ -202,47 +312,12 @@ class DiskUtil(object):
                 if (out_which_output is not None):
                      lsblk_path = str(out_which_output)
                      is_lsblk_path_wrong, out_lsblk_output, error_msg = self.get_lsblk_pairs_output(lsblk_path, dev_path)
-            # if error_msg contains "invalid option" or "P" (rely on only "-P" optiont in error to handle non-English locales), then get device_items using method get_device_items_from_lsblk_list
-            if (error_msg is not None and error_msg.strip() != "" and ('invalid option' in error_msg or 'P' in error_msg)):
+            # if error_msg contains "invalid option" or "P" (rely on only "-P" optiont in error to handle non-English locales), or lsblk could not be run at all, then get device_items from /sys/block
+            if ((error_msg is not None and error_msg.strip() != "" and ('invalid option' in error_msg or 'P' in error_msg)) or out_lsblk_output is None):
                 device_items = self.get_device_items_from_lsblk_list(lsblk_path, dev_path)
             # else get device_items from parsing the lsblk command output
-            elif (out_lsblk_output is not None):
-                lines = out_lsblk_output.splitlines()
-                for i in range(0,len(lines)):
-                    item_value_str = lines[i].strip()
-                    if(item_value_str != ""):
-                        disk_info_item_array = item_value_str.split()
-                        device_item = DeviceItem()
-                        disk_info_item_array_length = len(disk_info_item_array)
-                        for j in range(0, disk_info_item_array_length):
-                            disk_info_property = disk_info_item_array[j]
-                            property_item_pair = disk_info_property.split('=')
-
-                            if(property_item_pair[0] == 'NAME'):
-                                device_item.name = property_item_pair[1].strip('"')
-
-                            if(property_item_pair[0] == 'TYPE'):
-                                device_item.type = property_item_pair[1].strip('"')
-
-                            if(property_item_pair[0] == 'FSTYPE'):
-                                device_item.file_system = property_item_pair[1].strip('"')
-                        
-                            if(property_item_pair[0] == 'MOUNTPOINT'):
-                                device_item.mount_point = property_item_pair[1].strip('"')
-
-                            if(property_item_pair[0] == 'LABEL'):
-                                device_item.label = property_item_pair[1].strip('"')
-
-                            if(property_item_pair[0] == 'UUID'):
-                                device_item.uuid = property_item_pair[1].strip('"')
-
-                            if(property_item_pair[0] == 'MODEL'):
-                                device_item.model = property_item_pair[1].strip('"')
-
-                        self.logger.log("lsblk MOUNTPOINT=" + str(device_item.mount_point) + ", NAME=" + str(device_item.name) + ", TYPE=" + str(device_item.type) + ", FSTYPE=" + str(device_item.file_system) + ", LABEL=" + str(device_item.label) + ", UUID=" + str(device_item.uuid) + ", MODEL=" + str(device_item.model), True)
-                        
-                        if(device_item.mount_point is not None and device_item.mount_point != "" and device_item.mount_point != " "):
-                            device_items.append(device_item)
+            else:
+                device_items = self.parse_lsblk_pairs(out_lsblk_output)
             return device_items
 
     def get_mount_command_output(self, mount_path):
@@ -80,9 +80,76 @@ import Utils.Status
 from MachineIdentity import MachineIdentity
 import ExtensionErrorCodeHelper
 import traceback
+import threading
+from Utils.LogTail import LogTail
 
 DateTimeFormat = "%Y-%m-%dT%H:%M:%SZ"
 
+class ConfigFileCache:
+    """
+    Process wide cache of the parsed [SnapshotThread] section of the config file.
+    The file is parsed again only when its inode, mtime or size changed, the file is stat'ed at most once per CheckIntervalInSeconds.
+    """
+    ConfigFile = '/etc/azure/vmbackup.conf'
+    Section = 'SnapshotThread'
+    CheckIntervalInSeconds = 1
+    lock = threading.Lock()
+    values = None
+    file_signature = None
+    last_checked = None
+    read_count = 0
+
+    @staticmethod
+    def get_file_signature():
+        try:
+            st = os.stat(ConfigFileCache.ConfigFile)
+            return (st.st_ino, st.st_mtime, st.st_size)
+        except OSError:
+            return None
+
+    @staticmethod
+    def parse():
+        values = {}
+        signature = ConfigFileCache.get_file_signature()
+        if signature is not None:
+            config = ConfigParsers.ConfigParser()
+            config.read(ConfigFileCache.ConfigFile)
+            ConfigFileCache.read_count += 1
+            if config.has_section(ConfigFileCache.Section):
+                for option in config.options(ConfigFileCache.Section):
+                    try:
+                        values[option] = config.get(ConfigFileCache.Section, option)
+                    except Exception as e:
+                        pass
+        return values, signature
+
+    @staticmethod
+    def get_values():
+        now = time.time()
+        with ConfigFileCache.lock:
+            if ConfigFileCache.values is not None and ConfigFileCache.last_checked is not None and 0 <= now - ConfigFileCache.last_checked < ConfigFileCache.CheckIntervalInSeconds:
+                return ConfigFileCache.values
+            ConfigFileCache.last_checked = now
+            if ConfigFileCache.values is None or ConfigFileCache.get_file_signature() != ConfigFileCache.file_signature:
+                ConfigFileCache.values, ConfigFileCache.file_signature = ConfigFileCache.parse()
+            return ConfigFileCache.values
+
+    @staticmethod
+    def get(key):
+        # ConfigParser lower cases option names
+        return ConfigFileCache.get_values().get(key.lower())
+
+    @staticmethod
+    def invalidate():
+        with ConfigFileCache.lock:
+            ConfigFileCache.values = None
+            ConfigFileCache.file_signature = None
+            ConfigFileCache.last_checked = None
+
+    @staticmethod
+    def get_read_count():
+        return ConfigFileCache.read_count
+
 class HandlerContext:
     def __init__(self,name):
         self._name = name
@@ -95,6 +162,12 @@ class HandlerUtility:
     ExtErrorCode = ExtensionErrorCodeHelper.ExtensionErrorCodeEnum.success
     SnapshotConsistency = Utils.Status.SnapshotConsistencyType.none
     HealthStatusCode = -1
+    StaticTelemetryFileName = 'StaticTelemetry.json'
+    StaticTelemetryTTLInSeconds = 24 * 60 * 60
+    WorkloadScanIntervalInSeconds = 60
+    static_telemetry = None
+    workloads = None
+    workload_scan_thread = None
     def __init__(self, log, error, short_name):
         self._log = log
         self._error = error
@@ -105,6 +178,7 @@ class HandlerUtility:
         self.partitioncount = 0
         self.logging_file = None
         self.pre_post_enabled = False
+        self.machine_id = None
 
     def _get_log_prefix(self):
         return '[%s-%s]' % (self._context._name, self._context._version)
@@ -324,15 +398,9 @@ class HandlerUtility:
     '''
 
     def get_value_from_configfile(self, key):
-        global backup_logger
         value = None
-        configfile = '/etc/azure/vmbackup.conf'
         try :
-            if os.path.exists(configfile):
-                config = ConfigParsers.ConfigParser()
-                config.read(configfile)
-                if config.has_option('SnapshotThread',key):
-                    value = config.get('SnapshotThread',key)
+            value = ConfigFileCache.get(key)
         except Exception as e:
             pass
 
@@ -368,7 +436,7 @@ class HandlerUtility:
         return int(value)
  
     def set_value_to_configfile(self, key, value):
-        configfile = '/etc/azure/vmbackup.conf'
+        configfile = ConfigFileCache.ConfigFile
         try :
             self.log('setting ' + str(key)  + 'in config file to ' + str(value) , 'Info')
             if not os.path.exists(os.path.dirname(configfile)):
@@ -389,9 +457,12 @@ class HandlerUtility:
         except Exception as e:
             errorMsg = " Unable to set config file.key is "+ key +"with error: %s, stack trace: %s" % (str(e), traceback.format_exc())
             self.log(errorMsg, 'Warning')
+        ConfigFileCache.invalidate()
         return value
 
     def get_machine_id(self):
+        if self.machine_id is not None:
+            return self.machine_id
         machine_id_file = "/etc/azure/machine_identity_FD76C85E-406F-4CFA-8EB0-CF18B123358B"
         machine_id = ""
         try:
@@ -413,6 +484,8 @@ class HandlerUtility:
             self.log(errMsg, 'Error')
  
         self.log("Unique Machine Id  : {0}".format(machine_id))
+        if machine_id != "":
+            self.machine_id = machine_id
         return machine_id
 
     def get_total_used_size(self):
@@ -600,18 +673,80 @@ class HandlerUtility:
         else:
             return delta.total_seconds()
 
+    @staticmethod
+    def get_config_read_count():
+        return ConfigFileCache.get_read_count()
+
     @staticmethod
     def add_to_telemetery_data(key,value):
         HandlerUtility.telemetry_data[key]=value
 
-    def add_telemetry_data(self):
+    def get_static_telemetry_file(self):
+        return os.path.join(self._context._log_dir, HandlerUtility.StaticTelemetryFileName)
+
+    def load_static_telemetry(self):
+        """
+        Agent version, distro and kernel do not change during a run, they are collected once and cached on disk
+        for StaticTelemetryTTLInSeconds, or until the VM boots a different kernel.
+        """
+        static_telemetry_file = self.get_static_telemetry_file()
+        try:
+            if os.path.exists(static_telemetry_file):
+                age = time.time() - os.path.getmtime(static_telemetry_file)
+                if 0 <= age < HandlerUtility.StaticTelemetryTTLInSeconds:
+                    with open(static_telemetry_file, 'r') as f:
+                        static_telemetry = json.load(f)
+                    if static_telemetry.get("kernelRelease") == platform.release():
+                        return static_telemetry
+        except Exception as e:
+            errMsg = 'Failed to read the static telemetry cache with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+            self.log(errMsg, 'Warning')
+
         os_version,kernel_version = self.get_dist_info()
-        workloads = self.get_workload_running()
-        HandlerUtility.add_to_telemetery_data("guestAgentVersion",self.get_wala_version_from_command())
+        static_telemetry = {"guestAgentVersion" : self.get_wala_version_from_command(), "osVersion" : os_version, "kernelVersion" : kernel_version, "kernelRelease" : platform.release()}
+        # failed lookups are retried by the next run instead of being cached
+        if static_telemetry["guestAgentVersion"] != "Unknown" and static_telemetry["osVersion"] != "Unkonwn":
+            try:
+                with open(static_telemetry_file, 'w') as f:
+                    json.dump(static_telemetry, f)
+            except Exception as e:
+                errMsg = 'Failed to write the static telemetry cache with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+                self.log(errMsg, 'Warning')
+        return static_telemetry
+
+    def get_static_telemetry(self):
+        if HandlerUtility.static_telemetry is None:
+            HandlerUtility.static_telemetry = self.load_static_telemetry()
+        return HandlerUtility.static_telemetry
+
+    def start_workload_scan(self):
+        """
+        Scans /proc for running workloads right away and then every WorkloadScanIntervalInSeconds on a daemon thread,
+        so that status reports only read the last result.
+        """
+        if HandlerUtility.workload_scan_thread is None:
+            HandlerUtility.workload_scan_thread = threading.Thread(target = self.workload_scan_loop)
+            HandlerUtility.workload_scan_thread.daemon = True
+            HandlerUtility.workload_scan_thread.start()
+
+    def workload_scan_loop(self):
+        while True:
+            HandlerUtility.workloads = self.get_workload_running(HandlerUtility.workloads is None)
+            time.sleep(HandlerUtility.WorkloadScanIntervalInSeconds)
+
+    def get_workloads(self):
+        if HandlerUtility.workloads is None:
+            # no scan finished yet in this process
+            HandlerUtility.workloads = self.get_workload_running()
+        return HandlerUtility.workloads
+
+    def add_telemetry_data(self):
+        static_telemetry = self.get_static_telemetry()
+        HandlerUtility.add_to_telemetery_data("guestAgentVersion",static_telemetry["guestAgentVersion"])
         HandlerUtility.add_to_telemetery_data("extensionVersion",self.get_extension_version())
-        HandlerUtility.add_to_telemetery_data("osVersion",os_version)
-        HandlerUtility.add_to_telemetery_data("kernelVersion",kernel_version)
-        HandlerUtility.add_to_telemetery_data("workloads",str(workloads))
+        HandlerUtility.add_to_telemetery_data("osVersion",static_telemetry["osVersion"])
+        HandlerUtility.add_to_telemetery_data("kernelVersion",static_telemetry["kernelVersion"])
+        HandlerUtility.add_to_telemetery_data("workloads",str(self.get_workloads()))
         HandlerUtility.add_to_telemetery_data("prePostEnabled", str(self.pre_post_enabled))
     
     def convert_telemetery_data_to_bcm_serializable_format(self):
@@ -754,21 +889,14 @@ class HandlerUtility:
         return False
 
     def get_prev_log(self):
-        with open(self._context._log_file, "r") as f:
-            lines = f.readlines()
-        if(len(lines) > 300):
-            lines = lines[-300:]
-            return ''.join(str(x) for x in lines)
-        else:
-            return ''.join(str(x) for x in lines)
+        # read backwards from the end, the extension log is never loaded whole
+        lines = LogTail(self._context._log_file).read_lines(300)
+        return ''.join(str(x) for x in lines)
     
     def get_shell_script_log(self):
         lines = "" 
         try:
-            with open(self._context._shell_log_file, "r") as f:
-                lines = f.readlines()
-            if(len(lines) > 10):
-                lines = lines[-10:]
+            lines = LogTail(self._context._shell_log_file).read_lines(10)
             return ''.join(str(x) for x in lines)
         except Exception as e:
             self.log("Can't receive shell log file: " + str(e))
@@ -792,17 +920,23 @@ class HandlerUtility:
 
         return uriHasSpecialCharacters
 
-    def get_workload_running(self):
+    def get_workload_running(self, log_found = True):
         workloads = []
         try:
             dblist= ["mysqld","postgresql","oracle","cassandra",",mongo"] ## add all workload process name in lower case
             if os.path.isdir("/proc"):
                 pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
                 for pid in pids:
-                    pname = open(os.path.join('/proc', pid, 'cmdline'), 'rb').read()
+                    try:
+                        with open(os.path.join('/proc', pid, 'cmdline'), 'rb') as f:
+                            pname = f.read()
+                    except (IOError, OSError):
+                        # the process exited while scanning
+                        continue
                     for db in dblist :
                         if db in str(pname).lower() and db not in workloads :
-                            self.log("workload running found with name : " + str(db))
+                            if log_found:
+                                self.log("workload running found with name : " + str(db))
                             workloads.append(db)
             return workloads
         except Exception as e:
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import traceback
+
+class LatencyHistogram(object):
+    """
+    Latencies of calls per call name, counted in exponential buckets and kept on disk across backup runs.
+    Once a call name has more than MaxSamples samples its counts are halved, so older runs weigh less.
+    """
+    BucketBoundsInMs = [50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 30000, 45000, 60000, 90000, 120000]
+    MaxSamples = 64
+    MinSamples = 3
+
+    def __init__(self, logger, path = None):
+        self.logger = logger
+        self.path = path
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def get_bucket(self, latency_in_ms):
+        for index, bound in enumerate(LatencyHistogram.BucketBoundsInMs):
+            if latency_in_ms <= bound:
+                return index
+        return len(LatencyHistogram.BucketBoundsInMs)
+
+    def get_bucket_bound(self, index):
+        """ the last bucket has no bound, twice the previous one is reported for it """
+        if index < len(LatencyHistogram.BucketBoundsInMs):
+            return LatencyHistogram.BucketBoundsInMs[index]
+        return LatencyHistogram.BucketBoundsInMs[-1] * 2
+
+    def record(self, name, latency_in_ms):
+        with self.lock:
+            counts = self.counts.get(name)
+            if counts is None:
+                counts = [0] * (len(LatencyHistogram.BucketBoundsInMs) + 1)
+                self.counts[name] = counts
+            counts[self.get_bucket(latency_in_ms)] += 1
+            if sum(counts) > LatencyHistogram.MaxSamples:
+                self.counts[name] = [count // 2 for count in counts]
+
+    def decay(self, name):
+        """ halves the counts of name, for a call skipped because of its history """
+        with self.lock:
+            if name in self.counts:
+                self.counts[name] = [count // 2 for count in self.counts[name]]
+
+    def get_sample_count(self, name):
+        with self.lock:
+            return sum(self.counts.get(name, []))
+
+    def get_percentile(self, name, percentile):
+        """ upper bound in ms of the bucket holding the percentile, None until MinSamples were recorded """
+        with self.lock:
+            counts = self.counts.get(name)
+            if counts is None or sum(counts) < LatencyHistogram.MinSamples:
+                return None
+            wanted = sum(counts) * percentile / 100.0
+            seen = 0
+            for index, count in enumerate(counts):
+                seen = seen + count
+                if count > 0 and seen >= wanted:
+                    return self.get_bucket_bound(index)
+            return self.get_bucket_bound(len(counts) - 1)
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                counts = json.load(f)
+            bucket_count = len(LatencyHistogram.BucketBoundsInMs) + 1
+            with self.lock:
+                # a file written with other bucket bounds is dropped rather than misread
+                self.counts = dict((str(name), [int(count) for count in value]) for name, value in counts.items() if len(value) == bucket_count)
+        except Exception as e:
+            errMsg = 'Failed to read the latency histogram with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+            self.logger.log(errMsg, True, 'Warning')
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            with self.lock:
+                content = json.dumps(self.counts)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(content)
+            os.rename(temp_path, self.path)
+        except Exception as e:
+            errMsg = 'Failed to write the latency histogram with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+            self.logger.log(errMsg, True, 'Warning')
+
+    def get_summary(self):
+        """ sample count and p50/p90 per call name, for telemetry """
+        summary = {}
+        with self.lock:
+            names = sorted(self.counts.keys())
+        for name in names:
+            summary[name] = {'samples' : self.get_sample_count(name), 'p50' : self.get_percentile(name, 50), 'p90' : self.get_percentile(name, 90)}
+        return summary
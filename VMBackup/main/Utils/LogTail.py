@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+class LogTail(object):
+    """
+    Reads the end of a log file by seeking from its end, so the cost depends on the size asked for and not on the size of the log.
+    Every read goes through one open descriptor, a log rotated in the middle of a read is not mixed with its successor.
+    When the log is shorter than asked for and was rotated, the rest comes from the end of the rotated file,
+    which is told apart from the current log by its inode (copytruncate and hard links leave the same inode).
+    """
+    BlockSizeBytes = 65536
+
+    def __init__(self, path, rotated_paths = None):
+        self.path = path
+        if rotated_paths is None:
+            rotated_paths = [path + '.1']
+        self.rotated_paths = rotated_paths
+
+    def get_size(self, max_bytes):
+        """ number of bytes read_into() will write for max_bytes, an upper bound if the log grows in between """
+        size = 0
+        for path in self.get_sources():
+            try:
+                size = size + os.stat(path).st_size
+            except OSError:
+                pass
+            if size >= max_bytes:
+                return max_bytes
+        return size
+
+    def get_sources(self):
+        """ the current log first, then its rotated predecessor """
+        sources = [self.path]
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return sources
+        for rotated_path in self.rotated_paths:
+            try:
+                if os.stat(rotated_path).st_ino != inode:
+                    sources.append(rotated_path)
+                    break
+            except OSError:
+                pass
+        return sources
+
+    def read_into(self, buffer, align_to_line = True):
+        """
+        Fills the end of buffer (a writable memoryview or bytearray) with the last bytes of the log, oldest first.
+        With align_to_line a partial first line is dropped and the rest moved to the start of buffer.
+        Returns the number of bytes written at the start of buffer.
+        """
+        view = memoryview(buffer)
+        remaining = len(view)
+        read_from_start_of_log = False
+        for path in self.get_sources():
+            if remaining == 0:
+                break
+            try:
+                with open(path, 'rb') as log_file:
+                    stat = os.fstat(log_file.fileno())
+                    wanted = min(remaining, stat.st_size)
+                    log_file.seek(stat.st_size - wanted, os.SEEK_SET)
+                    length = self.read_fully(log_file, view[remaining - wanted:remaining])
+                    if length < wanted:
+                        # the log was truncated while reading, what was read goes next to the newer bytes
+                        view[remaining - length:remaining] = view[remaining - wanted:remaining - wanted + length].tobytes()
+                    read_from_start_of_log = (length == stat.st_size)
+                    remaining = remaining - length
+            except (IOError, OSError):
+                continue
+        written = len(view) - remaining
+        start = remaining
+        if align_to_line and written > 0 and not read_from_start_of_log:
+            newline = view[start:start + min(written, LogTail.BlockSizeBytes)].tobytes().find(b'\n')
+            if newline >= 0:
+                start = start + newline + 1
+            else:
+                start = len(view)
+        written = len(view) - start
+        if start > 0 and written > 0:
+            view[0:written] = view[start:start + written].tobytes()
+        return written
+
+    def read_fully(self, log_file, view):
+        # the log may shrink under us, read until the view is full or the file ends
+        total = 0
+        while total < len(view):
+            count = log_file.readinto(view[total:])
+            if not count:
+                break
+            total = total + count
+        return total
+
+    def read(self, max_bytes, align_to_line = True):
+        buffer = bytearray(self.get_size(max_bytes))
+        written = self.read_into(buffer, align_to_line)
+        del buffer[written:]
+        return buffer
+
+    def read_lines(self, max_lines):
+        """ the last max_lines lines as a list of str, reading blocks backwards from the end """
+        with open(self.path, 'rb') as log_file:
+            log_file.seek(0, os.SEEK_END)
+            position = log_file.tell()
+            blocks = []
+            newlines = 0
+            while position > 0 and newlines <= max_lines:
+                length = min(LogTail.BlockSizeBytes, position)
+                position = position - length
+                log_file.seek(position, os.SEEK_SET)
+                block = log_file.read(length)
+                newlines = newlines + block.count(b'\n')
+                blocks.insert(0, block)
+        data = b''.join(blocks)
+        if sys.version_info > (3,):
+            data = data.decode('utf-8', 'replace')
+        lines = [line + '\n' for line in data.split('\n')]
+        # the text after the last newline is a line without one, empty if the log ends with a newline
+        lines[-1] = lines[-1][:-1]
+        if len(lines[-1]) == 0:
+            lines.pop()
+        if position > 0:
+            # the first line read is partial unless the block started right after a newline
+            lines = lines[1:]
+        if max_lines <= 0:
+            return []
+        return lines[-max_lines:]
@@ -140,6 +140,15 @@ class ResourceDiskUtil(object):
 			if(option==0):
 				return partition
 
+			# look the partition up in the device table first, so no mount process is spawned
+			if device is not None:
+				device_table = self.disk_util.get_device_table()
+				for name in [partition, device]:
+					device_item = device_table.get_by_kname(name)
+					if device_item is not None and device_item.mount_point:
+						self.logger.log(("Resource disk [{0}] is mounted [{1}]",partition,device_item.mount_point),True)
+						return device_item.mount_point
+
 			#p = Popen("mount", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 			#mount_list, err = p.communicate()
 			mount_list = self.disk_util.get_mount_output()
@@ -14,8 +14,63 @@ from Utils.ResourceDiskUtil import ResourceDiskUtil
 import Utils.HandlerUtil
 import traceback
 import subprocess
+import threading
+try:
+    import Queue as queues
+except ImportError:
+    import queue as queues
+
+class MountStatWorker(object):
+    """
+    Runs os.stat and os.statvfs of mount points on a worker thread, so a mount that does not answer
+    (e.g. a stalled remote or fuse file system) costs at most timeoutInSeconds.
+    The worker stuck on such a mount is left behind and a new one takes the remaining mounts.
+    """
+    def __init__(self, timeoutInSeconds):
+        self.timeoutInSeconds = timeoutInSeconds
+        self.requests = None
+        self.responses = None
+
+    def start(self):
+        self.requests = queues.Queue()
+        self.responses = queues.Queue()
+        worker = threading.Thread(target=self.worker, args=(self.requests, self.responses))
+        worker.daemon = True
+        worker.start()
+
+    def worker(self, requests, responses):
+        while True:
+            mount_point = requests.get()
+            if mount_point is None:
+                return
+            try:
+                responses.put((mount_point, os.stat(mount_point).st_dev, os.statvfs(mount_point), None))
+            except Exception as e:
+                responses.put((mount_point, None, None, e))
+
+    def stat(self, mount_point):
+        """ returns (st_dev, statvfs result), None on timeout, raises what stat or statvfs raised """
+        if self.requests is None:
+            self.start()
+        self.requests.put(mount_point)
+        try:
+            response_mount_point, st_dev, statvfs, error = self.responses.get(True, self.timeoutInSeconds)
+        except queues.Empty:
+            self.requests = None
+            self.responses = None
+            return None
+        if error is not None:
+            raise error
+        return st_dev, statvfs
+
+    def stop(self):
+        if self.requests is not None:
+            self.requests.put(None)
+            self.requests = None
+            self.responses = None
 
 class SizeCalculation(object):
+    StatvfsTimeoutInSeconds = 10
 
     def __init__(self,patching,logger,para_parser):
         self.patching=patching
@@ -23,6 +78,8 @@ class SizeCalculation(object):
         self.file_systems_info = []
         self.non_physical_file_systems = ['fuse', 'nfs', 'cifs', 'overlay', 'aufs', 'lustre', 'secfs2', 'zfs', 'btrfs', 'iso']
         self.known_fs = ['ext3', 'ext4', 'jfs', 'xfs', 'reiserfs', 'devtmpfs', 'tmpfs', 'rootfs', 'fuse', 'nfs', 'cifs', 'overlay', 'aufs', 'lustre', 'secfs2', 'zfs', 'btrfs', 'iso']
+        # never statvfs'ed, a stalled server would hang the call
+        self.network_file_systems = ['nfs', 'cifs', 'smb', 'glusterfs', 'ceph', 'lustre', 'sshfs', '9p', 'afs', 'gpfs', 'beegfs', 'davfs', 'blobfuse', 's3fs', 'rclone']
         self.isOnlyOSDiskBackupEnabled = False
         try:
             if(para_parser.customSettings != None and para_parser.customSettings != ''):
@@ -44,7 +101,7 @@ class SizeCalculation(object):
         global disk_util
         disk_util = DiskUtil(patching = self.patching,logger = self.logger)
         if len(self.file_systems_info) == 0 :
-            self.file_systems_info = disk_util.get_mount_file_systems()
+            self.file_systems_info = disk_util.get_mount_table()
         self.logger.log("file_systems list : ",True)
         self.logger.log(str(self.file_systems_info),True)
         disk_loop_devices_file_systems = []
@@ -64,43 +121,133 @@ class SizeCalculation(object):
         self.logger.log("exiting device_list_for_billing",True)
         return devices_to_bill
 
+    def is_network_file_system(self, device, fstype):
+        if device.startswith('\\\\') or device.startswith('//'):
+            return True
+        for network_fs in self.network_file_systems:
+            if network_fs in fstype.lower():
+                return True
+        return False
+
+    def get_file_system_usage(self):
+        """
+        The rows df -k reports, as (device, fstype, size, used, available, mountpoint) in KB, from os.statvfs of the mount table.
+        Like df, file systems without blocks (proc, sysfs, ..) are left out and a file system mounted more than once
+        is only reported for its shortest mount point. Network file systems are not queried, their used size is 0.
+        """
+        if len(self.file_systems_info) == 0 :
+            self.file_systems_info = DiskUtil(patching = self.patching,logger = self.logger).get_mount_table()
+        rows = []
+        row_index_by_st_dev = {}
+        timed_out_mounts = []
+        mount_stat_worker = MountStatWorker(SizeCalculation.StatvfsTimeoutInSeconds)
+        try:
+            for device, fstype, mountpoint in self.file_systems_info:
+                if self.is_network_file_system(device, fstype):
+                    self.logger.log("Not querying network file system, Device name : {0} fstype : {1} mountpoint : {2}".format(device,fstype,mountpoint),True)
+                    rows.append((device, fstype, 0, 0, 0, mountpoint))
+                    continue
+                try:
+                    mount_stat = mount_stat_worker.stat(mountpoint)
+                except Exception as e:
+                    self.logger.log("statvfs failed for mountpoint : {0} with error: {1}".format(mountpoint, str(e)),True)
+                    continue
+                if mount_stat is None:
+                    self.logger.log("statvfs timed out after {0} seconds for mountpoint : {1}".format(SizeCalculation.StatvfsTimeoutInSeconds, mountpoint),True,'Warning')
+                    timed_out_mounts.append(mountpoint)
+                    continue
+                st_dev, statvfs = mount_stat
+                if statvfs.f_blocks == 0:
+                    continue
+                block_size = statvfs.f_frsize or statvfs.f_bsize
+                # rounded up to whole KB like df does
+                size = (statvfs.f_blocks * block_size + 1023) // 1024
+                used = ((statvfs.f_blocks - statvfs.f_bfree) * block_size + 1023) // 1024
+                available = (statvfs.f_bavail * block_size + 1023) // 1024
+                row = (device, fstype, size, used, available, mountpoint)
+                if st_dev in row_index_by_st_dev:
+                    row_index = row_index_by_st_dev[st_dev]
+                    if len(mountpoint) < len(rows[row_index][5]):
+                        rows[row_index] = row
+                    continue
+                row_index_by_st_dev[st_dev] = len(rows)
+                rows.append(row)
+        finally:
+            mount_stat_worker.stop()
+        if len(timed_out_mounts) > 0:
+            Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("statvfsTimedOutMounts",str(timed_out_mounts))
+        return rows
+
+    def get_file_system_usage_from_df(self):
+        """ the rows of get_file_system_usage parsed from df -k, where there is no /proc/self/mounts to statvfs """
+        df = subprocess.Popen(["df" , "-k"], stdout=subprocess.PIPE)
+        '''
+        Sample output of the df command
+
+        Filesystem                                              Type     1K-blocks    Used    Avail Use% Mounted on
+        /dev/sda2                                               xfs       52155392 3487652 48667740   7% /
+        devtmpfs                                                devtmpfs   7170976       0  7170976   0% /dev
+        tmpfs                                                   tmpfs      7180624       0  7180624   0% /dev/shm
+        tmpfs                                                   tmpfs      7180624  760496  6420128  11% /run
+        tmpfs                                                   tmpfs      7180624       0  7180624   0% /sys/fs/cgroup
+        /dev/sda1                                               ext4        245679  151545    76931  67% /boot
+        /dev/sdb1                                               ext4      28767204 2142240 25140628   8% /mnt/resource
+        /dev/mapper/mygroup-thinv1                              xfs        1041644   33520  1008124   4% /bricks/brick1
+        /dev/mapper/mygroup-85197c258a54493da7880206251f5e37_0  xfs        1041644   33520  1008124   4% /run/gluster/snaps/85197c258a54493da7880206251f5e37/brick2
+        /dev/mapper/mygroup2-thinv2                             xfs       15717376 5276944 10440432  34% /tmp/test
+        /dev/mapper/mygroup2-63a858543baf4e40a3480a38a2f232a0_0 xfs       15717376 5276944 10440432  34% /run/gluster/snaps/63a858543baf4e40a3480a38a2f232a0/brick2
+        tmpfs                                                   tmpfs      1436128       0  1436128   0% /run/user/1000
+        //Centos72test/cifs_test                                cifs      52155392 4884620 47270772  10% /mnt/cifs_test2
+
+        '''
+        output = ""
+        process_wait_time = 300
+        while(df is not None and process_wait_time >0 and df.poll() is None):
+            time.sleep(1)
+            process_wait_time -= 1
+        self.logger.log("df command executed for process wait time value" + str(process_wait_time), True)
+        if(df is not None and df.poll() is not None):
+            self.logger.log("df return code"+str(df.returncode), True)
+            output = df.stdout.read()
+        if sys.version_info > (3,):
+            output = str(output, encoding='utf-8', errors="backslashreplace")
+        else:
+            output = str(output)
+        output = output.strip().split("\n")
+        if len(self.file_systems_info) == 0 :
+            self.file_systems_info = DiskUtil(patching = self.patching,logger = self.logger).get_mount_file_systems()
+
+        rows = []
+        size_calc_failed = False
+        output_length = len(output)
+        index = 1
+        while index < output_length:
+            if(len(output[index].split()) < 6 ): #when a row is divided in 2 lines
+                index = index+1
+                if(index < output_length and len(output[index-1].split()) + len(output[index].split()) == 6):
+                    output[index] = output[index-1] + output[index]
+                else:
+                    self.logger.log("Output of df command is not in desired format",True)
+                    size_calc_failed = True
+                    break
+            device, size, used, available, percent, mountpoint = output[index].split()
+            fstype = ''
+            for file_system_info in self.file_systems_info:
+                if device == file_system_info[0] and mountpoint == file_system_info[2]:
+                    fstype = file_system_info[1]
+            rows.append((device, fstype, int(size), int(used), int(available), mountpoint))
+            index = index + 1
+        return rows, size_calc_failed
+
     def get_total_used_size(self):
         try:
             size_calc_failed = False
-            df = subprocess.Popen(["df" , "-k"], stdout=subprocess.PIPE)
-            '''
-            Sample output of the df command
-
-            Filesystem                                              Type     1K-blocks    Used    Avail Use% Mounted on
-            /dev/sda2                                               xfs       52155392 3487652 48667740   7% /
-            devtmpfs                                                devtmpfs   7170976       0  7170976   0% /dev
-            tmpfs                                                   tmpfs      7180624       0  7180624   0% /dev/shm
-            tmpfs                                                   tmpfs      7180624  760496  6420128  11% /run
-            tmpfs                                                   tmpfs      7180624       0  7180624   0% /sys/fs/cgroup
-            /dev/sda1                                               ext4        245679  151545    76931  67% /boot
-            /dev/sdb1                                               ext4      28767204 2142240 25140628   8% /mnt/resource
-            /dev/mapper/mygroup-thinv1                              xfs        1041644   33520  1008124   4% /bricks/brick1
-            /dev/mapper/mygroup-85197c258a54493da7880206251f5e37_0  xfs        1041644   33520  1008124   4% /run/gluster/snaps/85197c258a54493da7880206251f5e37/brick2
-            /dev/mapper/mygroup2-thinv2                             xfs       15717376 5276944 10440432  34% /tmp/test
-            /dev/mapper/mygroup2-63a858543baf4e40a3480a38a2f232a0_0 xfs       15717376 5276944 10440432  34% /run/gluster/snaps/63a858543baf4e40a3480a38a2f232a0/brick2
-            tmpfs                                                   tmpfs      1436128       0  1436128   0% /run/user/1000
-            //Centos72test/cifs_test                                cifs      52155392 4884620 47270772  10% /mnt/cifs_test2
-
-            '''
-            output = ""
-            process_wait_time = 300
-            while(df is not None and process_wait_time >0 and df.poll() is None):
-                time.sleep(1)
-                process_wait_time -= 1
-            self.logger.log("df command executed for process wait time value" + str(process_wait_time), True)
-            if(df is not None and df.poll() is not None):
-                self.logger.log("df return code"+str(df.returncode), True)
-                output = df.stdout.read()
-            if sys.version_info > (3,):
-                output = str(output, encoding='utf-8', errors="backslashreplace")
+            if os.path.isfile('/proc/self/mounts'):
+                file_system_usage = self.get_file_system_usage()
             else:
-                output = str(output)
-            output = output.strip().split("\n")
+                file_system_usage, size_calc_failed = self.get_file_system_usage_from_df()
+                if size_calc_failed:
+                    return 0, size_calc_failed
             disk_loop_devices_file_systems = self.get_loop_devices()
             self.logger.log("outside loop device", True)
             total_used = 0
@@ -114,36 +261,16 @@ class SizeCalculation(object):
             total_sd_size=0
             network_fs_types = []
             unknown_fs_types = []
-      
-            if len(self.file_systems_info) == 0 :
-                self.file_systems_info = disk_util.get_mount_file_systems()
 
-            output_length = len(output)
-            index = 1
             self.resource_disk= ResourceDiskUtil(patching = self.patching, logger = self.logger)
             resource_disk_device= self.resource_disk.get_resource_disk_mount_point(0)
             resource_disk_device= "/dev/{0}".format(resource_disk_device)
             device_list=self.device_list_for_billing() #new logic: calculate the disk size for billing
 
-            while index < output_length:
-                if(len(output[index].split()) < 6 ): #when a row is divided in 2 lines
-                    index = index+1
-                    if(index < output_length and len(output[index-1].split()) + len(output[index].split()) == 6):
-                        output[index] = output[index-1] + output[index]
-                    else:
-                        self.logger.log("Output of df command is not in desired format",True)
-                        total_used = 0
-                        size_calc_failed = True
-                        break
-                device, size, used, available, percent, mountpoint = output[index].split()
-                fstype = ''
+            for device, fstype, size, used, available, mountpoint in file_system_usage:
                 isNetworkFs = False
                 isKnownFs = False
 
-
-                for file_system_info in self.file_systems_info:
-                    if device == file_system_info[0] and mountpoint == file_system_info[2]:
-                        fstype = file_system_info[1]
                 self.logger.log("Device name : {0} fstype : {1} size : {2} used space in KB : {3} available space : {4} mountpoint : {5}".format(device,fstype,size,used,available,mountpoint),True)
 
                 for nonPhysicaFsType in self.non_physical_file_systems:
@@ -204,8 +331,6 @@ class SizeCalculation(object):
                         total_used = total_used + int(used) #return in KB
                     if not (isKnownFs or fstype == '' or fstype == None):
                         total_used_unknown_fs = total_used_unknown_fs + int(used)
-
-                index = index + 1
                 
             if not len(unknown_fs_types) == 0:
                 Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("unknownFSTypeInDf",str(unknown_fs_types))
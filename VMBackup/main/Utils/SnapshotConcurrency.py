@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import traceback
+
+class SnapshotConcurrencyController(object):
+    """
+    Number of blob snapshot requests allowed in flight, learned from the responses (additive increase, multiplicative decrease).
+    Every successful request grows the limit by 1/limit, about one more request per round. A throttled request (429/503)
+    halves it and a request much slower than the fastest one seen this run takes one off, once per round: only requests
+    started since the last decrease can decrease it again.
+    The number of requests in flight that got throttled is remembered as a ceiling the limit stays below, raised by one
+    after CleanRunsBeforeProbe runs without throttling. Limit and ceiling are kept in the log folder for the next run.
+    """
+    ThrottledStatusCodes = [429, 503]
+    LatencyToleranceFactor = 2.0
+    MinBaselineLatencyInMs = 50
+    CleanRunsBeforeProbe = 4
+
+    def __init__(self, logger, max_concurrency, initial_concurrency, path = None):
+        self.logger = logger
+        self.path = path
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(min(max(1, initial_concurrency), self.max_concurrency))
+        self.initial_limit = self.limit
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.epoch = 0
+        self.baseline_latency_in_ms = None
+        self.ceiling = None
+        self.clean_runs = 0
+        self.throttled = 0
+        self.slow = 0
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            self.limit = float(min(max(1, state['concurrency']), self.max_concurrency))
+            if state.get('ceiling') is not None and state['ceiling'] <= self.max_concurrency:
+                self.ceiling = max(2, int(state['ceiling']))
+                self.limit = min(self.limit, self.ceiling - 1)
+                self.clean_runs = int(state.get('cleanRuns', 0))
+            self.initial_limit = self.limit
+        except Exception as e:
+            errMsg = 'Failed to read the learned snapshot concurrency with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+            self.logger.log(errMsg, True, 'Warning')
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            with self.condition:
+                ceiling = self.ceiling
+                clean_runs = self.clean_runs
+                if ceiling is not None and self.throttled == 0:
+                    clean_runs += 1
+                    if clean_runs >= SnapshotConcurrencyController.CleanRunsBeforeProbe:
+                        ceiling += 1
+                        clean_runs = 0
+                content = json.dumps({'concurrency' : round(self.limit, 2), 'ceiling' : ceiling, 'cleanRuns' : clean_runs})
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(content)
+            os.rename(temp_path, self.path)
+        except Exception as e:
+            errMsg = 'Failed to write the learned snapshot concurrency with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+            self.logger.log(errMsg, True, 'Warning')
+
+    def get_concurrency(self, blob_count):
+        with self.condition:
+            return max(1, min(int(self.limit), blob_count))
+
+    def acquire(self):
+        """ blocks until a request may be sent, returns the ticket to pass to release() """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return (self.epoch, self.in_flight)
+
+    def release(self, ticket, status_code, latency_in_ms):
+        with self.condition:
+            self.on_response(ticket, status_code, latency_in_ms)
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    @staticmethod
+    def is_throttled(status_code):
+        return status_code in SnapshotConcurrencyController.ThrottledStatusCodes
+
+    def on_response(self, ticket, status_code, latency_in_ms):
+        epoch, in_flight = ticket
+        if SnapshotConcurrencyController.is_throttled(status_code):
+            self.throttled += 1
+            # storage throttled on arrival, when neither count is exact: requests sent just before may have arrived after
+            # this one, and the response may come back after others completed
+            in_flight = max(in_flight, self.in_flight)
+            if epoch == self.epoch:
+                self.ceiling = max(2, min(self.ceiling or in_flight, in_flight))
+            self.decrease(epoch, self.limit / 2)
+        elif status_code == 200 or status_code == 201:
+            if self.baseline_latency_in_ms is None or latency_in_ms < self.baseline_latency_in_ms:
+                self.baseline_latency_in_ms = latency_in_ms
+            if latency_in_ms > max(self.baseline_latency_in_ms, SnapshotConcurrencyController.MinBaselineLatencyInMs) * SnapshotConcurrencyController.LatencyToleranceFactor:
+                self.slow += 1
+                self.decrease(epoch, self.limit - 1)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                if self.ceiling is not None:
+                    self.limit = min(self.limit, self.ceiling - 1)
+        # other failures say nothing about the load on storage
+
+    def decrease(self, epoch, limit):
+        if epoch == self.epoch:
+            self.limit = max(1.0, limit)
+            self.epoch += 1
+
+    def get_summary(self):
+        with self.condition:
+            return {'initial' : round(self.initial_limit, 2), 'final' : round(self.limit, 2), 'ceiling' : self.ceiling, 'throttled' : self.throttled, 'slow' : self.slow}
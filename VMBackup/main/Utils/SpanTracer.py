@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import ctypes.util
+import datetime
+import json
+import threading
+import time
+
+class SpanName():
+    """phases traced around the freeze window"""
+    preScript = 'preScript'
+    httpUtilWarmup = 'httpUtilWarmup'
+    freeze = 'freeze'
+    freezeMount = 'freezeMount'
+    snapshot = 'snapshot'
+    hostPreSnapshot = 'hostPreSnapshot'
+    hostSnapshot = 'hostSnapshot'
+    thaw = 'thaw'
+    thawMount = 'thawMount'
+    postScript = 'postScript'
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+CLOCK_MONOTONIC = 1
+
+def load_clock_gettime():
+    """clock_gettime from libc for python 2, which has no time.monotonic. None if it can not be loaded"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_gettime.restype = ctypes.c_int
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) != 0:
+            return None
+        return clock_gettime
+    except (OSError, AttributeError):
+        return None
+
+clock_gettime = None if hasattr(time, 'monotonic') else load_clock_gettime()
+
+def monotonic_now():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic()
+    if clock_gettime is not None:
+        now = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)) == 0:
+            return now.tv_sec + now.tv_nsec / 1000000000.0
+    # only without clock_gettime, durations then follow changes to the wall clock
+    return time.time()
+
+class Span(object):
+    def __init__(self, name, attributes = None, start = None):
+        self.name = name
+        self.attributes = attributes or {}
+        self.start = start if start is not None else monotonic_now()
+        self.end = None
+
+    def finish(self, **attributes):
+        self.end = monotonic_now()
+        self.attributes.update(attributes)
+        SpanTracer.add_span(self)
+        return self
+
+    def duration_in_ms(self):
+        if self.end is None:
+            return None
+        return int((self.end - self.start) * 1000)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.finish()
+        return False
+
+    def convertToDictionary(self):
+        return dict(name = self.name, startInMs = int((self.start - SpanTracer.origin) * 1000), durationInMs = self.duration_in_ms(), attributes = self.attributes)
+
+class SpanTracer(object):
+    """
+    Process wide recorder of monotonic span timings for one backup run.
+    Spans are cheap to record from any thread, nothing is written out until publish time.
+    """
+    clock_is_monotonic = hasattr(time, 'monotonic') or clock_gettime is not None
+    lock = threading.Lock()
+    spans = []
+    origin = monotonic_now()
+    origin_utc = datetime.datetime.utcnow()
+
+    @staticmethod
+    def start_span(name, **attributes):
+        return Span(name, attributes)
+
+    @staticmethod
+    def add_span(span):
+        with SpanTracer.lock:
+            SpanTracer.spans.append(span)
+
+    @staticmethod
+    def add_completed_span(name, start, duration, **attributes):
+        span = Span(name, attributes, start)
+        span.end = start + duration
+        SpanTracer.add_span(span)
+        return span
+
+    @staticmethod
+    def get_spans():
+        with SpanTracer.lock:
+            return list(SpanTracer.spans)
+
+    @staticmethod
+    def get_breakdown():
+        """total milliseconds per span name, plus the freeze window from the first freeze to the last thaw"""
+        breakdown = {}
+        freeze_start = None
+        thaw_end = None
+        for span in SpanTracer.get_spans():
+            breakdown[span.name] = breakdown.get(span.name, 0) + span.duration_in_ms()
+            if span.name == SpanName.freeze and (freeze_start is None or span.start < freeze_start):
+                freeze_start = span.start
+            if span.name == SpanName.thaw and (thaw_end is None or span.end > thaw_end):
+                thaw_end = span.end
+        if freeze_start is not None and thaw_end is not None:
+            breakdown['freezeWindow'] = int((thaw_end - freeze_start) * 1000)
+        return breakdown
+
+    @staticmethod
+    def write_trace_file(trace_file):
+        trace = dict(startTimeUTC = SpanTracer.origin_utc.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                     breakdownInMs = SpanTracer.get_breakdown(),
+                     spans = [span.convertToDictionary() for span in SpanTracer.get_spans()])
+        with open(trace_file, 'w') as f:
+            json.dump(trace, f, indent = 1)
+
+    @staticmethod
+    def reset():
+        with SpanTracer.lock:
+            SpanTracer.spans = []
+        SpanTracer.origin = monotonic_now()
+        SpanTracer.origin_utc = datetime.datetime.utcnow()
@@ -23,14 +23,8 @@
 # http://msdn.microsoft.com/en-us/library/cc227259%28PROT.13%29.aspx
 #
 
-import crypt
 import random
 import base64
-
-try:
-    import httplib as httplibs
-except ImportError:
-    import http.client as httplibs
 import os
 import os.path
 import platform
@@ -51,12 +45,41 @@ import threading
 import time
 import traceback
 import xml.dom.minidom
-import inspect
-import zipfile
 import json
 import datetime
-import xml.sax.saxutils
-from distutils.version import LooseVersion
+
+class LazyModule(object):
+    """
+    Module imported on first attribute access. The handlers load this file on every command
+    but only a few code paths use these modules, they are not imported up front.
+    The first of names that can be imported is used.
+    """
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            for name in self._names:
+                try:
+                    __import__(name)
+                    self._module = sys.modules[name]
+                    break
+                except ImportError:
+                    if name == self._names[-1]:
+                        raise
+        return getattr(self._module, attr)
+
+crypt = LazyModule('crypt')
+httplibs = LazyModule('httplib', 'http.client')
+inspect = LazyModule('inspect')
+zipfile = LazyModule('zipfile')
+saxutils = LazyModule('xml.sax.saxutils')
+
+def LooseVersion(vstring):
+    # distutils is only needed to compare plugin versions, importing it costs more than the rest of this module
+    from distutils.version import LooseVersion as DistutilsLooseVersion
+    return DistutilsLooseVersion(vstring)
 
 if not hasattr(subprocess, 'check_output'):
     def check_output(*popenargs, **kwargs):
@@ -4091,11 +4114,11 @@ class WALAEvent(object):
                 strEventsData += strRecordFormat.format(attName, attValue, strMtUInt64)
                 continue
             if type(attValue) is str:
-                attValue = xml.sax.saxutils.quoteattr(attValue)
+                attValue = saxutils.quoteattr(attValue)
                 strEventsData += strRecordNoQuoteFormat.format(attName, attValue, strMtStr)
                 continue
             if str(type(attValue)).count("'unicode'") > 0:
-                attValue = xml.sax.saxutils.quoteattr(attValue)
+                attValue = saxutils.quoteattr(attValue)
                 strEventsData += strRecordNoQuoteFormat.format(attName, attValue, strMtStr)
                 continue
             if type(attValue) is bool:
@@ -4281,7 +4304,7 @@ class WALAEventMonitor(WALAEvent):
             if node.tagName == "Param":
                 name = node.getAttribute("Name")
                 if self.sysInfo.get(name):
-                    node.setAttribute("Value", xml.sax.saxutils.escape(str(self.sysInfo[name])))
+                    node.setAttribute("Value", saxutils.escape(str(self.sysInfo[name])))
 
         return eventObject.toxml()
 
@@ -16,33 +16,144 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import collections
 import datetime
 import os
 import string
+import threading
 import time
 import traceback
-from blobwriter import BlobWriter
 from Utils.WAAgentUtil import waagent
+from Utils.LogTail import LogTail
 import sys
+try:
+    import Queue as queues
+except ImportError:
+    import queue as queues
+
+class ConsoleSink(object):
+    """
+    Writes log lines to the console from a background thread, callers only queue them.
+    Once MaxQueuedLines are waiting further lines are dropped instead of blocking the caller.
+    What is still queued at exit is written out by stop().
+    """
+    MaxQueuedLines = 10000
+    MaxLinesPerWrite = 1000
+
+    def __init__(self, con_path):
+        self.con_path = con_path
+        self.queue = queues.Queue(ConsoleSink.MaxQueuedLines)
+        self.dropped_count = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def write(self, line):
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(line)
+        except queues.Full:
+            self.dropped_count += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.flush_loop)
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def stop(self, timeout = 1):
+        try:
+            self.queue.put(None, True, timeout)
+        except queues.Full:
+            return
+        self.thread.join(timeout)
+
+    def flush_loop(self):
+        console = None
+        stopped = False
+        while not stopped:
+            lines = [self.queue.get()]
+            while len(lines) < ConsoleSink.MaxLinesPerWrite:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queues.Empty:
+                    break
+            stop_count = lines.count(None)
+            if stop_count > 0:
+                stopped = True
+                lines = [line for line in lines if line is not None]
+            try:
+                if console is None:
+                    console = open(self.con_path, "wb")
+                message = "".join(lines)
+                if sys.version_info < (3,):
+                    message = "".join(list(filter(lambda x : x in string.printable, message)))
+                console.write(message.encode('ascii','ignore'))
+                console.flush()
+            except Exception:
+                # the console may be gone, it is reopened for the next lines
+                if console is not None:
+                    try:
+                        console.close()
+                    except Exception:
+                        pass
+                console = None
+            for i in range(len(lines) + stop_count):
+                self.queue.task_done()
+        if console is not None:
+            console.close()
+
+    def wait_until_written(self):
+        if self.thread is not None:
+            self.queue.join()
 
 class Backuplogger(object):
+    """
+    Logs go to the extension log and the console, except while the file systems are frozen:
+    then each log() only appends a (time, level, message) record to a bounded in-memory ring,
+    which is formatted and written out in one pass when the freeze ends.
+    """
+    LogRingBufferSizeDefault = 100000
+    WalaLogPath = "/var/log/waagent.log"
+    WalaLogTailBytes = 1024 * 10
+
     def __init__(self, hutil):
-        self.msg = ''
         self.con_path = '/dev/console'
         self.enforced_local_flag_value = True
         self.hutil = hutil
         self.prev_log = ''
         self.logging_off = False
+        self.records_lock = threading.Lock()
+        self.records = collections.deque(maxlen = max(self.hutil.get_intvalue_from_configfile('LogRingBufferSize', Backuplogger.LogRingBufferSizeDefault), 1))
+        self.dropped_records = 0
+        self.write_log = True
+        self.console_sink = None
+        self.read_logging_config()
+
+    def read_logging_config(self):
+        # read once per freeze transition instead of on every line
+        WriteLog = self.hutil.get_strvalue_from_configfile('WriteLog','True')
+        self.write_log = (WriteLog == None or WriteLog == 'True')
+        LogToConsole = self.hutil.get_strvalue_from_configfile('LogToConsole','True')
+        if (LogToConsole == None or LogToConsole == 'True'):
+            if self.console_sink is None:
+                self.console_sink = ConsoleSink(self.con_path)
+        else:
+            self.console_sink = None
 
     def enforce_local_flag(self, enforced_local):
         if (self.hutil.get_intvalue_from_configfile('LoggingOff', 0) == 1):
             self.logging_off = True
+        self.read_logging_config()
         if (self.enforced_local_flag_value != False and enforced_local == False and self.logging_off == True):
             pass
         elif (self.enforced_local_flag_value != False and enforced_local == False):
-            self.msg = self.msg + "================== Logs during Freeze Start ==============" + "\n"
+            self.add_record((None, None, "================== Logs during Freeze Start ==============" + "\n"))
         elif (self.enforced_local_flag_value == False and enforced_local == True):
-            self.msg = self.msg + "================== Logs during Freeze End ==============" + "\n"
+            self.add_record((None, None, "================== Logs during Freeze End ==============" + "\n"))
             self.commit_to_local()
         self.enforced_local_flag_value = enforced_local
 
@@ -50,53 +161,54 @@ class Backuplogger(object):
     def log(self, msg, local=False, level='Info'):
         if(self.enforced_local_flag_value == False and self.logging_off == True):
             return
-        WriteLog = self.hutil.get_strvalue_from_configfile('WriteLog','True')
-        if (WriteLog == None or WriteLog == 'True'):
-            log_msg = ""
-            if sys.version_info > (3,):
-                log_msg = self.log_to_con_py3(msg, level)
-            else:
-                log_msg = "{0}  {1}  {2} \n".format(str(datetime.datetime.now()) , level , msg)
-                if(self.enforced_local_flag_value != False):
-                    self.log_to_con(log_msg)
+        if (self.write_log):
             if(self.enforced_local_flag_value == False):
-                self.msg += log_msg
+                # nothing but memory is touched while frozen, the record is formatted when it is committed
+                self.add_record((datetime.datetime.now(), level, msg))
             else:
+                if(self.console_sink is not None):
+                    self.console_sink.write(self.format_record((datetime.datetime.now(), level, msg)))
                 self.hutil.log(str(msg),level)
 
-    def log_to_con(self, msg):
-        try:
-            with open(self.con_path, "wb") as C :
-                message = "".join(list(filter(lambda x : x in string.printable, msg)))
-                C.write(message.encode('ascii','ignore'))
-        except IOError as e:
-            pass
-        except Exception as e:
-            pass
+    def add_record(self, record):
+        with self.records_lock:
+            if len(self.records) == self.records.maxlen:
+                self.dropped_records += 1
+            self.records.append(record)
 
-    def log_to_con_py3(self, msg, level='Info'):
-        log_msg = ""
+    def format_record(self, record):
+        timestamp, level, msg = record
+        if timestamp is None:
+            return msg
         try:
-            if type(msg) is not str:
-                msg = str(msg, errors="backslashreplace")
-            time = datetime.datetime.now().strftime(u'%Y/%m/%d %H:%M:%S.%f')
-            log_msg = u"{0}  {1}  {2} \n".format(time , level , msg)
-            log_msg= str(log_msg.encode('ascii', "backslashreplace"), 
-                         encoding="ascii")
-            if(self.enforced_local_flag_value != False):
-                with open(self.con_path, "w") as C :
-                    C.write(log_msg)
-        except IOError:
-            pass
+            if sys.version_info > (3,):
+                if type(msg) is not str:
+                    msg = str(msg, errors="backslashreplace")
+                log_msg = u"{0}  {1}  {2} \n".format(timestamp.strftime(u'%Y/%m/%d %H:%M:%S.%f'), level, msg)
+                return str(log_msg.encode('ascii', "backslashreplace"), encoding="ascii")
+            try:
+                return "{0}  {1}  {2} \n".format(str(timestamp), level, msg)
+            except UnicodeError:
+                return "{0}  {1}  {2} \n".format(str(timestamp), level, msg.encode('ascii', 'backslashreplace'))
         except Exception as e:
-            log_msg = "###### Exception in log_to_con_py3"
-        return log_msg
+            return "###### Exception in format_record\n"
+
+    def serialize_records(self):
+        """ formats and clears the ring """
+        with self.records_lock:
+            records = self.records
+            dropped_records = self.dropped_records
+            self.records = collections.deque(maxlen = records.maxlen)
+            self.dropped_records = 0
+        lines = [self.format_record(record) for record in records]
+        if dropped_records > 0:
+            lines.insert(0, "###### " + str(dropped_records) + " older log lines dropped from the log ring\n")
+        return "".join(lines)
 
     def commit(self, logbloburi):
         #commit to local file system first, then commit to the network.
         try:
-            self.hutil.log(self.msg)
-            self.msg = ''
+            self.commit_to_local()
         except Exception as e:
             pass 
         try:
@@ -105,13 +217,17 @@ class Backuplogger(object):
             self.hutil.log('commit to blob failed')
 
     def commit_to_local(self):
-        self.hutil.log(self.msg)
-        self.msg = ''
+        message = self.serialize_records()
+        if len(message) > 0:
+            self.hutil.log(message)
 
     def commit_to_blob(self, logbloburi):
         UploadStatusAndLog = self.hutil.get_strvalue_from_configfile('UploadStatusAndLog','True')
         if (UploadStatusAndLog == None or UploadStatusAndLog == 'True'):
-            log_to_blob = ""
+            log_to_blob = bytearray()
+            header = ""
+            # the http stack is only loaded by the commands that upload their log
+            from blobwriter import BlobWriter
             blobWriter = BlobWriter(self.hutil)
             # append the wala log at the end.
             try:
@@ -122,21 +238,30 @@ class Backuplogger(object):
                         distro_str = self.hutil.patching.distro_info[0] + " " + self.hutil.patching.distro_info[1]
                     else:
                         distro_str = self.hutil.patching.distro_info[0]
-                    self.msg = "Distro Info:" + distro_str + "\n" + self.msg
-                self.msg = "Guest Agent Version is :" + waagent.GuestAgentVersion + "\n" + self.msg
-                with open("/var/log/waagent.log", 'rb') as file:
-                    file.seek(0, os.SEEK_END)
-                    length = file.tell()
-                    seek_len_abs = 1024 * 10
-                    if(length < seek_len_abs):
-                        seek_len_abs = length
-                    file.seek(0 - seek_len_abs, os.SEEK_END)
-                    tail_wala_log = file.read()
-                    log_to_blob = str(self.hutil.fetch_log_message()) + "Tail of previous logs:" + str(self.prev_log) + "Tail of WALA Log:" + str(tail_wala_log) + "Tail of shell script log:" + str(self.hutil.get_shell_script_log())
+                    header = "Distro Info:" + distro_str + "\n"
+                header = "Guest Agent Version is :" + waagent.GuestAgentVersion + "\n" + header
+                before_wala_log = self.to_bytes(header + self.serialize_records() + str(self.hutil.fetch_log_message()) + "Tail of previous logs:" + str(self.prev_log) + "Tail of WALA Log:")
+                after_wala_log = self.to_bytes("Tail of shell script log:" + str(self.hutil.get_shell_script_log()))
+                # the tail of the wala log is read from its end straight into the upload buffer, whatever the size of the log
+                wala_log = LogTail(Backuplogger.WalaLogPath)
+                wala_log_size = wala_log.get_size(Backuplogger.WalaLogTailBytes)
+                log_to_blob = bytearray(len(before_wala_log) + wala_log_size + len(after_wala_log))
+                view = memoryview(log_to_blob)
+                view[0:len(before_wala_log)] = before_wala_log
+                wala_log_size = wala_log.read_into(view[len(before_wala_log):len(before_wala_log) + wala_log_size])
+                end = len(before_wala_log) + wala_log_size + len(after_wala_log)
+                view[len(before_wala_log) + wala_log_size:end] = after_wala_log
+                del view
+                del log_to_blob[end:]
             except Exception as e:
                 errMsg = 'Failed to get the waagent log with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
                 self.hutil.log(errMsg)
             blobWriter.WriteBlob(log_to_blob, logbloburi)
 
+    def to_bytes(self, message):
+        if isinstance(message, bytes) or isinstance(message, bytearray):
+            return message
+        return message.encode('utf-8', 'backslashreplace')
+
     def set_prev_log(self):
         self.prev_log = self.hutil.get_prev_log()
@@ -18,6 +18,8 @@
 
 import time
 import datetime
+import random
+import threading
 import traceback
 try:
     import urlparse
@@ -28,11 +30,134 @@ from HttpUtil import HttpUtil
 from Utils import HandlerUtil
 
 class BlobProperties():
-    def __init__(self, blobType, contentLength):
+    def __init__(self, blobType, contentLength, etag = None):
         self.blobType = blobType
         self.contentLength = contentLength
+        self.etag = etag
     def __str__(self):
-        return ' blobType: ' + str(self.blobType) + ' contentLength: ' + str(self.contentLength)
+        return ' blobType: ' + str(self.blobType) + ' contentLength: ' + str(self.contentLength) + ' etag: ' + str(self.etag)
+
+class BlobPropertiesCache(object):
+    """
+    Short lived cache of blob properties keyed by sas uri, so that a single blob write
+    (type check, clear and page writes) needs only one metadata request.
+    """
+    TimeToLiveInSeconds = 60
+    lock = threading.Lock()
+    entries = {}
+
+    @staticmethod
+    def get(blobUri):
+        with BlobPropertiesCache.lock:
+            entry = BlobPropertiesCache.entries.get(blobUri)
+            if(entry is None):
+                return None
+            blobProperties, cached_time = entry
+            if(time.time() - cached_time > BlobPropertiesCache.TimeToLiveInSeconds):
+                del BlobPropertiesCache.entries[blobUri]
+                return None
+            return blobProperties
+
+    @staticmethod
+    def put(blobUri, blobProperties):
+        with BlobPropertiesCache.lock:
+            BlobPropertiesCache.entries[blobUri] = (blobProperties, time.time())
+
+    @staticmethod
+    def invalidate(blobUri):
+        with BlobPropertiesCache.lock:
+            BlobPropertiesCache.entries.pop(blobUri, None)
+
+    @staticmethod
+    def forget_etag(blobUri):
+        # a successful write changes the etag, but not the type or length of the blob
+        with BlobPropertiesCache.lock:
+            entry = BlobPropertiesCache.entries.get(blobUri)
+            if(entry is not None):
+                entry[0].etag = None
+
+class PageUploadStats():
+    def __init__(self, pageBlobIndex, length):
+        self.pageBlobIndex = pageBlobIndex
+        self.length = length
+        self.attempts = 0
+        self.latency = None
+        self.result = CommonVariables.error
+    def __str__(self):
+        return ' offset: ' + str(self.pageBlobIndex) + ' length: ' + str(self.length) + ' attempts: ' + str(self.attempts) + ' latencyInMs: ' + str(self.latency) + ' result: ' + str(self.result)
+
+class PageUploader(object):
+    """
+    Uploads the pages of a page-blob write with a bounded number of put page requests in flight.
+    Every page is retried on its own with jittered exponential backoff.
+    """
+    def __init__(self, blobWriter, blobUri, maxConcurrency, maxAttempts = 3, baseBackoffInSeconds = 0.5, maxBackoffInSeconds = 8):
+        self.blobWriter = blobWriter
+        self.hutil = blobWriter.hutil
+        self.blobUri = blobUri
+        self.maxConcurrency = max(1, maxConcurrency)
+        self.maxAttempts = maxAttempts
+        self.baseBackoffInSeconds = baseBackoffInSeconds
+        self.maxBackoffInSeconds = maxBackoffInSeconds
+        self.lock = threading.Lock()
+        self.pending = []
+        self.failed = False
+
+    def get_backoff(self, attempt):
+        backoff = min(self.maxBackoffInSeconds, self.baseBackoffInSeconds * (2 ** (attempt - 1)))
+        return backoff * random.uniform(0.5, 1.5)
+
+    def next_page(self):
+        with self.lock:
+            if(self.failed or len(self.pending) == 0):
+                return None
+            return self.pending.pop(0)
+
+    def upload_page(self, pageContent, stats):
+        while(stats.attempts < self.maxAttempts):
+            stats.attempts = stats.attempts + 1
+            start_time = time.time()
+            try:
+                stats.result = self.blobWriter.put_page_update(pageContent, self.blobUri, stats.pageBlobIndex)
+            except Exception as e:
+                stats.result = CommonVariables.error
+                self.hutil.log("PageUploader: put page at offset " + str(stats.pageBlobIndex) + " failed with error: %s, stack trace: %s" % (str(e), traceback.format_exc()))
+            stats.latency = int((time.time() - start_time) * 1000)
+            if(stats.result == CommonVariables.success):
+                return
+            if(stats.attempts < self.maxAttempts):
+                time.sleep(self.get_backoff(stats.attempts))
+        with self.lock:
+            self.failed = True
+
+    def worker(self):
+        while True:
+            page = self.next_page()
+            if(page is None):
+                return
+            pageContent, stats = page
+            self.upload_page(pageContent, stats)
+
+    def upload(self, pages):
+        """pages is a list of (pageBlobIndex, pageContent), returns the overall result and the per-page stats"""
+        page_stats = []
+        for pageBlobIndex, pageContent in pages:
+            stats = PageUploadStats(pageBlobIndex, len(pageContent))
+            page_stats.append(stats)
+            self.pending.append((pageContent, stats))
+        workers = []
+        for i in range(min(self.maxConcurrency, len(pages))):
+            workers.append(threading.Thread(target = self.worker))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        for stats in page_stats:
+            self.hutil.log("PageUploader:" + str(stats))
+        result = CommonVariables.success
+        if(self.failed or any(stats.result != CommonVariables.success for stats in page_stats)):
+            result = CommonVariables.error
+        return result, page_stats
 
 class BlobWriter(object):
     """description of class"""
@@ -70,6 +195,7 @@ class BlobWriter(object):
                     headers["x-ms-blob-type"] = 'BlockBlob'
                     self.hutil.log(str(headers))
                     result = http_util.Call(method = 'PUT', sasuri_obj = sasuri_obj, data = msg, headers = headers, fallback_to_curl = True)
+                    BlobPropertiesCache.invalidate(blobUri)
                     if(result == CommonVariables.success):
                         self.hutil.log("blob written succesfully")
                         retry_times = 0
@@ -89,14 +215,14 @@ class BlobWriter(object):
     def WritePageBlob(self, message, blobUri):
         if(blobUri is not None):
             retry_times = 3
+            # pages are sliced out of a single bytes buffer through memoryviews instead of copying the message per page
+            messageBytes = self.to_bytes(message)
             while(retry_times > 0):
-                msg = message
                 try:
                     PAGE_SIZE_BYTES = 512
                     PAGE_UPLOAD_LIMIT_BYTES = 4194304 # 4 MB
                     STATUS_BLOB_LIMIT_BYTES = 10485760 # 10 MB
-                    http_util = HttpUtil(self.hutil)
-                    sasuri_obj = urlparse.urlparse(blobUri + '&comp=page')
+                    msgView = memoryview(messageBytes)
                     # Get Blob-properties to know content-length
                     blobProperties = self.GetBlobProperties(blobUri)
                     blobContentLength = int(blobProperties.contentLength)
@@ -104,55 +230,51 @@ class BlobWriter(object):
                     maxMsgLen = STATUS_BLOB_LIMIT_BYTES
                     if (blobContentLength > STATUS_BLOB_LIMIT_BYTES):
                         maxMsgLen = blobContentLength
-                    msgLen = len(msg)
+                    msgLen = len(msgView)
                     self.hutil.log("WritePageBlob: msg length:"+str(msgLen))
-                    if(len(msg) > maxMsgLen):
-                        msg = msg[msgLen-maxMsgLen:msgLen]
-                        msgLen = len(msg)
+                    if(msgLen > maxMsgLen):
+                        msgView = msgView[msgLen-maxMsgLen:msgLen]
+                        msgLen = len(msgView)
                         self.hutil.log("WritePageBlob: msg length after aligning to maxMsgLen:"+str(msgLen))
+                    paddedLen = msgLen
                     if((msgLen % PAGE_SIZE_BYTES) != 0):
-                        # Add padding to message to make its legth multiple of 512
-                        paddedLen = msgLen + (512 - (msgLen % PAGE_SIZE_BYTES))
-                        msg = msg.ljust(paddedLen)
-                        msgLen = len(msg)
-                        self.hutil.log("WritePageBlob: msg length after aligning to page-size(512):"+str(msgLen))
-                    if(blobContentLength < msgLen):
+                        # Message is padded with spaces to make its length multiple of 512, only the last page gets copied for it
+                        paddedLen = msgLen + (PAGE_SIZE_BYTES - (msgLen % PAGE_SIZE_BYTES))
+                        self.hutil.log("WritePageBlob: msg length after aligning to page-size(512):"+str(paddedLen))
+                    if(blobContentLength < paddedLen):
                         # Try to resize blob to increase its size
-                        isSuccessful = self.try_resize_page_blob(blobUri, msgLen)
+                        isSuccessful = self.try_resize_page_blob(blobUri, paddedLen)
                         if(isSuccessful == True):
-                            self.hutil.log("WritePageBlob: page-blob resized successfully new size(blobContentLength):"+str(msgLen))
-                            blobContentLength = msgLen
+                            self.hutil.log("WritePageBlob: page-blob resized successfully new size(blobContentLength):"+str(paddedLen))
+                            blobContentLength = paddedLen
                         else:
                             self.hutil.log("WritePageBlob: page-blob resize failed")
-                    if(msgLen > blobContentLength):
-                        msg = msg[msgLen-blobContentLength:msgLen]
-                        msgLen = len(msg)
-                        self.hutil.log("WritePageBlob: msg length after aligning to blobContentLength:"+str(msgLen))
+                    if(paddedLen > blobContentLength):
+                        trimLen = min(paddedLen - blobContentLength, msgLen)
+                        msgView = msgView[trimLen:msgLen]
+                        msgLen = len(msgView)
+                        paddedLen = blobContentLength
+                        self.hutil.log("WritePageBlob: msg length after aligning to blobContentLength:"+str(paddedLen))
                     # Write Pages
-                    result = CommonVariables.error
-                    bytes_sent = 0
-                    while (bytes_sent < msgLen):
-                        bytes_remaining = msgLen - bytes_sent
-                        pageContent = None
-                        if(bytes_remaining > PAGE_UPLOAD_LIMIT_BYTES): # more than 4 MB
-                            pageContent = msg[bytes_sent:bytes_sent+PAGE_UPLOAD_LIMIT_BYTES]
-                        else:
-                            pageContent = msg[bytes_sent:msgLen]
-                        self.hutil.log("WritePageBlob: pageContentLen:"+str(len(pageContent)))
-                        result = self.put_page_update(pageContent, blobUri, bytes_sent)
-                        if(result == CommonVariables.success):
-                            self.hutil.log("WritePageBlob: page written succesfully")
-                        else:
-                            self.hutil.log("WritePageBlob: page failed to write")
-                            break
-                        bytes_sent = bytes_sent + len(pageContent)                      
+                    pages = self.get_pages(msgView, msgLen, paddedLen, PAGE_UPLOAD_LIMIT_BYTES)
+                    maxConcurrency = self.hutil.get_intvalue_from_configfile('PageUploadConcurrency', 4)
+                    self.hutil.log("WritePageBlob: uploading " + str(len(pages)) + " pages with concurrency " + str(maxConcurrency))
+                    page_uploader = PageUploader(self, blobUri, maxConcurrency)
+                    time_before_upload = datetime.datetime.now()
+                    result, page_stats = page_uploader.upload(pages)
+                    self.hutil.log("WritePageBlob: time taken for page upload " + str(datetime.datetime.now() - time_before_upload))
+                    if(len(page_stats) > 0):
+                        HandlerUtil.HandlerUtility.add_to_telemetery_data("pageUploadMaxLatencyInMs", str(max(stats.latency for stats in page_stats if stats.latency is not None)))
                     if(result == CommonVariables.success):
                         self.hutil.log("WritePageBlob: page-blob written succesfully")
+                        BlobPropertiesCache.forget_etag(blobUri)
                         retry_times = 0
                     else:
                         self.hutil.log("WritePageBlob: page-blob failed to write")
+                        BlobPropertiesCache.invalidate(blobUri)
                         HandlerUtil.HandlerUtility.add_to_telemetery_data(CommonVariables.statusBlobUploadError, "true")
                 except Exception as e:
+                    BlobPropertiesCache.invalidate(blobUri)
                     HandlerUtil.HandlerUtility.add_to_telemetery_data(CommonVariables.statusBlobUploadError, "true")
                     self.hutil.log("WritePageBlob: Failed to write to page-blob with error: %s, stack trace: %s" % (str(e), traceback.format_exc()))
                 self.hutil.log("WritePageBlob: retry times is " + str(retry_times))
@@ -160,6 +282,27 @@ class BlobWriter(object):
         else:
             self.hutil.log("WritePageBlob: bloburi is None")
 
+    def to_bytes(self, message):
+        if(isinstance(message, bytes) or isinstance(message, bytearray)):
+            return message
+        return message.encode('utf-8')
+
+    def get_pages(self, msgView, msgLen, paddedLen, pageUploadLimit):
+        pages = []
+        offset = 0
+        while(offset < paddedLen):
+            pageEnd = min(offset + pageUploadLimit, paddedLen)
+            if(pageEnd <= msgLen):
+                pages.append((offset, msgView[offset:pageEnd]))
+            else:
+                # the last page carries the padding, it is the only page copied into a buffer of its own
+                paddingBuffer = bytearray(b' ') * (pageEnd - offset)
+                if(msgLen > offset):
+                    paddingBuffer[0:msgLen - offset] = msgView[offset:msgLen]
+                pages.append((offset, memoryview(paddingBuffer)))
+            offset = pageEnd
+        return pages
+
     def ClearPageBlob(self, blobUri):
         if(blobUri is not None):
             retry_times = 3
@@ -172,16 +315,20 @@ class BlobWriter(object):
                     contentLength = int(blobProperties.contentLength)
                     # Clear Pages
                     if(contentLength > 0):
-                        result = self.put_page_clear(blobUri, 0, contentLength)
+                        result = self.put_page_clear(blobUri, 0, contentLength, blobProperties.etag)
                         if(result == CommonVariables.success):
                             self.hutil.log("ClearPageBlob: page-blob cleared succesfully")
+                            BlobPropertiesCache.forget_etag(blobUri)
                             retry_times = 0
                         else:
-                            self.hutil.log("ClearPageBlob: page-blob failed to clear")
+                            # the blob changed since its properties were read (412) or the clear failed, read them again
+                            self.hutil.log("ClearPageBlob: page-blob failed to clear, result :" + str(result))
+                            BlobPropertiesCache.invalidate(blobUri)
                     else:
                         self.hutil.log("ClearPageBlob: page-blob contentLength is 0")
                         retry_times = 0
                 except Exception as e:
+                    BlobPropertiesCache.invalidate(blobUri)
                     self.hutil.log("ClearPageBlob: Failed to clear to page-blob with error: %s, stack trace: %s" % (str(e), traceback.format_exc()))
                 self.hutil.log("ClearPageBlob: retry times is " + str(retry_times))
                 retry_times = retry_times - 1
@@ -201,16 +348,22 @@ class BlobWriter(object):
     def GetBlobProperties(self, blobUri):
         blobProperties = None
         if(blobUri is not None):
+            blobProperties = BlobPropertiesCache.get(blobUri)
+            if(blobProperties is not None):
+                self.hutil.log("GetBlobProperties: cached blobProperties :" + str(blobProperties))
+                return blobProperties
             retry_times = 3
             while(retry_times > 0):
                 try:
                     http_util = HttpUtil(self.hutil)
                     sasuri_obj = urlparse.urlparse(blobUri)
                     headers = {}
-                    result, httpResp, errMsg = http_util.HttpCallGetResponse('GET', sasuri_obj, None, headers = headers)
+                    result, httpResp, errMsg = http_util.HttpCallGetResponse('HEAD', sasuri_obj, None, headers = headers)
                     self.hutil.log("GetBlobProperties: HttpCallGetResponse : result :" + str(result) + ", errMsg :" + str(errMsg))
                     blobProperties = self.httpresponse_get_blob_properties(httpResp)
                     self.hutil.log("GetBlobProperties: blobProperties :" + str(blobProperties))
+                    if(blobProperties is not None):
+                        BlobPropertiesCache.put(blobUri, blobProperties)
                     retry_times = 0
                 except Exception as e:
                     self.hutil.log("GetBlobProperties: Failed to get blob properties with error: %s, stack trace: %s" % (str(e), traceback.format_exc()))
@@ -218,11 +371,13 @@ class BlobWriter(object):
                     retry_times = retry_times - 1
         return blobProperties
 
-    def put_page_clear(self, blobUri, pageBlobIndex, clearLength):
+    def put_page_clear(self, blobUri, pageBlobIndex, clearLength, etag = None):
         http_util = HttpUtil(self.hutil)
         sasuri_obj = urlparse.urlparse(blobUri + '&comp=page')
         headers = {}
         headers["x-ms-page-write"] = 'clear'
+        if(etag is not None):
+            headers["If-Match"] = etag
         headers["x-ms-range"] = 'bytes={0}-{1}'.format(pageBlobIndex, pageBlobIndex + clearLength - 1)
         headers["Content-Length"] = 0
         result = http_util.Call(method = 'PUT', sasuri_obj = sasuri_obj, data = None, headers = headers, fallback_to_curl = True)
@@ -234,13 +389,14 @@ class BlobWriter(object):
         headers = {}
         headers["x-ms-page-write"] = 'update'
         headers["x-ms-range"] = 'bytes={0}-{1}'.format(pageBlobIndex, pageBlobIndex + len(pageContent) - 1)
-        headers["Content-Length"] = len(str(pageContent))
+        headers["Content-Length"] = len(pageContent)
         result = http_util.Call(method = 'PUT', sasuri_obj = sasuri_obj, data = pageContent, headers = headers, fallback_to_curl = True)
         return result
     
     def try_resize_page_blob(self, blobUri, size):
         isSuccessful = False
         if (size % 512 == 0):
+            BlobPropertiesCache.invalidate(blobUri)
             try:
                 http_util = HttpUtil(self.hutil)
                 sasuri_obj = urlparse.urlparse(blobUri + '&comp=properties')
@@ -266,6 +422,7 @@ class BlobWriter(object):
                 resp_headers = httpResp.getheaders()
                 blobType = httpResp.getheader('x-ms-blob-type')
                 contentLength = httpResp.getheader('Content-Length')
-                blobProperties = BlobProperties(blobType, contentLength)
+                etag = httpResp.getheader('ETag')
+                blobProperties = BlobProperties(blobType, contentLength, etag)
         return blobProperties
 
@@ -149,8 +149,9 @@ class CommonVariables:
 
 class DeviceItem(object):
     def __init__(self):
-        #NAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL
+        #NAME,KNAME,TYPE,FSTYPE,MOUNTPOINT,LABEL,UUID,MODEL,SIZE
         self.name = None
+        self.kname = None
         self.type = None
         self.file_system = None
         self.mount_point = None
@@ -38,12 +38,16 @@ from fsfreezer import FsFreezer
 from guestsnapshotter import GuestSnapshotter
 from hostsnapshotter import HostSnapshotter
 from Utils import HostSnapshotObjects
+from Utils.LatencyHistogram import LatencyHistogram
+from Utils.SpanTracer import SpanTracer, SpanName
 import ExtensionErrorCodeHelper
 # need to be implemented in next release
 #from dhcpHandler import DhcpHandler
 
 class FreezeSnapshotter(object):
     """description of class"""
+    HostLatencyHistogramFileName = 'HostLatencyHistogram.json'
+    HostLatencyBudgetPercentDefault = 50
     def __init__(self, logger, hutil , freezer, g_fsfreeze_on, para_parser, takeCrashConsistentSnapshot):
         self.logger = logger
         self.configfile = '/etc/azure/vmbackup.conf'
@@ -57,6 +61,7 @@ class FreezeSnapshotter(object):
         self.takeSnapshotFrom = CommonVariables.firstGuestThenHost
         self.isManaged = False
         self.taskId = self.para_parser.taskId
+        self.host_latency_histogram = None
         self.hostIp = '168.63.129.16'
         self.extensionErrorCode = ExtensionErrorCodeHelper.ExtensionErrorCodeEnum.success
         self.takeCrashConsistentSnapshot = takeCrashConsistentSnapshot
@@ -128,7 +133,8 @@ class FreezeSnapshotter(object):
         unable_to_sleep = False
 
         """ Do Not remove below HttpUtil object creation. This is to ensure HttpUtil singleton object is created before freeze."""
-        http_util = HttpUtil(self.logger)
+        with SpanTracer.start_span(SpanName.httpUtilWarmup):
+            http_util = HttpUtil(self.logger)
 
         if(self.takeSnapshotFrom == CommonVariables.onlyGuest):
             run_result, run_status, blob_snapshot_info_array, all_failed, all_snapshots_failed, unable_to_sleep, is_inconsistent = self.takeSnapshotFromGuest()
@@ -142,7 +148,9 @@ class FreezeSnapshotter(object):
             self.logger.log('Snapshot method did not match any listed type, taking  firstHostThenGuest as default')
             run_result, run_status, blob_snapshot_info_array, all_failed, unable_to_sleep, is_inconsistent = self.takeSnapshotFromFirstHostThenGuest()
 
+        self.save_host_latencies()
         self.logger.log('doFreezeSnapshot : run_result - {0} run_status - {1} all_failed - {2} unable_to_sleep - {3} is_inconsistent - {4} values post snapshot'.format(str(run_result), str(run_status), str(all_failed), str(unable_to_sleep), str(is_inconsistent)))
+        HandlerUtil.HandlerUtility.add_to_telemetery_data("httpConnectionPoolStats", str(http_util.get_connection_pool_stats()))
 
         if (run_result == CommonVariables.success):
             run_result, run_status = self.updateErrorCode(blob_snapshot_info_array, all_failed, unable_to_sleep, is_inconsistent)
@@ -339,11 +347,11 @@ class FreezeSnapshotter(object):
         is_inconsistent =  False
         unable_to_sleep = False
         blob_snapshot_info_array = None
-        snap_shotter = HostSnapshotter(self.logger, self.hostIp)
+        snap_shotter = self.create_host_snapshotter()
         pre_snapshot_statuscode = snap_shotter.pre_snapshot(self.para_parser, self.taskId)
 
-        if(pre_snapshot_statuscode == 200 or pre_snapshot_statuscode == 201):
-            run_result, run_status, blob_snapshot_info_array, all_failed, unable_to_sleep, is_inconsistent = self.takeSnapshotFromOnlyHost()
+        if((pre_snapshot_statuscode == 200 or pre_snapshot_statuscode == 201) and not self.is_host_too_slow(snap_shotter)):
+            run_result, run_status, blob_snapshot_info_array, all_failed, unable_to_sleep, is_inconsistent = self.takeSnapshotFromOnlyHost(snap_shotter)
         else:
             run_result, run_status, blob_snapshot_info_array, all_failed, all_snapshots_failed, unable_to_sleep, is_inconsistent  = self.takeSnapshotFromGuest()
 
@@ -354,7 +362,7 @@ class FreezeSnapshotter(object):
 
         return run_result, run_status, blob_snapshot_info_array, all_failed, unable_to_sleep, is_inconsistent
 
-    def takeSnapshotFromOnlyHost(self):
+    def takeSnapshotFromOnlyHost(self, snap_shotter = None):
         run_result = CommonVariables.success
         run_status = 'success'
         all_failed= False
@@ -364,10 +372,13 @@ class FreezeSnapshotter(object):
         self.logger.log('Taking Snapshot through Host')
         HandlerUtil.HandlerUtility.add_to_telemetery_data(CommonVariables.snapshotCreator, CommonVariables.backupHostService)
 
+        if snap_shotter is None:
+            snap_shotter = self.create_host_snapshotter()
+        # the dosnapshot request goes out as soon as the freeze completes
+        snap_shotter.prepare_snapshot(self.para_parser, self.taskId)
         if self.g_fsfreeze_on :
             run_result, run_status = self.freeze()
         if(run_result == CommonVariables.success or self.takeCrashConsistentSnapshot == True):
-            snap_shotter = HostSnapshotter(self.logger, self.hostIp)
             self.logger.log('T:S doing snapshot now...')
             time_before_snapshot = datetime.datetime.now()
             blob_snapshot_info_array, all_failed, is_inconsistent, unable_to_sleep  = snap_shotter.snapshotall(self.para_parser, self.freezer, self.g_fsfreeze_on, self.taskId)
@@ -378,3 +389,46 @@ class FreezeSnapshotter(object):
             self.logger.log('T:S snapshotall ends...', True)
 
         return run_result, run_status, blob_snapshot_info_array, all_failed, unable_to_sleep, is_inconsistent
+
+    def create_host_snapshotter(self):
+        if self.host_latency_histogram is None:
+            histogram_path = None
+            try:
+                histogram_path = os.path.join(self.hutil._context._log_dir, FreezeSnapshotter.HostLatencyHistogramFileName)
+            except Exception as e:
+                self.logger.log('Host latencies are not kept across runs, log folder unknown: ' + str(e), True, 'Warning')
+            self.host_latency_histogram = LatencyHistogram(self.logger, histogram_path)
+            self.host_latency_histogram.load()
+        return HostSnapshotter(self.logger, self.hostIp, self.host_latency_histogram)
+
+    def is_host_too_slow(self, snap_shotter):
+        """
+        The file systems stay frozen for the whole dosnapshot call and are thawed by safefreeze itself at the freeze timeout.
+        A host whose presnapshot just now, or whose dosnapshot in past runs (p90), took longer than HostLatencyBudgetPercent
+        of that timeout is skipped for guest snapshots. The history decays on every run it skips the host, so the host gets tried again later.
+        A budget of 0 turns the check off.
+        """
+        timeout = self.hutil.get_intvalue_from_configfile('timeout', 60)
+        budget_percent = self.hutil.get_intvalue_from_configfile('HostLatencyBudgetPercent', FreezeSnapshotter.HostLatencyBudgetPercentDefault)
+        if budget_percent <= 0:
+            return False
+        budget_in_ms = timeout * 1000 * budget_percent // 100
+        pre_snapshot_latency = snap_shotter.pre_snapshot_latency_in_ms
+        do_snapshot_latency = self.host_latency_histogram.get_percentile(HostSnapshotter.DoSnapshotCallName, 90)
+        self.logger.log('Host latency budget ' + str(budget_in_ms) + 'ms, presnapshot took ' + str(pre_snapshot_latency) + 'ms, dosnapshot p90 ' + str(do_snapshot_latency) + 'ms')
+        reason = None
+        if pre_snapshot_latency is not None and pre_snapshot_latency > budget_in_ms:
+            reason = 'preSnapshotLatency'
+        elif do_snapshot_latency is not None and do_snapshot_latency > budget_in_ms:
+            reason = 'doSnapshotLatency'
+            self.host_latency_histogram.decay(HostSnapshotter.DoSnapshotCallName)
+        if reason is None:
+            return False
+        self.logger.log('Host is too slow for the freeze timeout (' + reason + '), taking snapshot through guest', True, 'Warning')
+        HandlerUtil.HandlerUtility.add_to_telemetery_data("hostSlowFallbackReason", reason)
+        return True
+
+    def save_host_latencies(self):
+        if self.host_latency_histogram is not None:
+            self.host_latency_histogram.save()
+            HandlerUtil.HandlerUtility.add_to_telemetery_data("hostLatencyHistogram", str(self.host_latency_histogram.get_summary()))
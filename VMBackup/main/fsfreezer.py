@@ -19,23 +19,20 @@
 import subprocess
 from mounts import Mounts
 import datetime
+import errno
 import threading
 import os
+import select
 import time
 import sys
 import signal
 import traceback
 import threading
+import re
 from common import CommonVariables
 from Utils.ResourceDiskUtil import ResourceDiskUtil
-
-def thread_for_binary(self,args):
-    self.logger.log("Thread for binary is called",True)
-    time.sleep(3)
-    self.logger.log("Waited in thread for 3 seconds",True)
-    self.logger.log("****** 1. Starting Freeze Binary ",True)
-    self.child = subprocess.Popen(args,stdout=subprocess.PIPE)
-    self.logger.log("Binary subprocess Created",True)
+from Utils import HandlerUtil
+from Utils.SpanTracer import SpanTracer, SpanName
 
 class FreezeError(object):
     def __init__(self):
@@ -55,10 +52,21 @@ class FreezeResult(object):
         return error_str
 
 class FreezeHandler(object):
+    """
+    Runs the safefreeze binary. The binary reports freeze completion on a control pipe (SAFEFREEZE_NOTIFY_FD)
+    and exits after the thaw, which closes the pipe, so both transitions are seen as soon as they happen.
+    SIGUSR1/SIGCHLD from the binary are still handled, they are noticed within PollIntervalInSeconds.
+    """
+    NotifyFdEnvironmentVariable = 'SAFEFREEZE_NOTIFY_FD'
+    MaxParallelMountsEnvironmentVariable = 'SAFEFREEZE_MAX_PARALLEL_MOUNTS'
+    FreezeCompletedEvent = b'F'
+    PollIntervalInSeconds = 1
+
     def __init__(self,logger,hutil):
         # sig_handle valid values(0:nothing done,1: freezed successfully, 2:freeze failed)
         self.sig_handle = 0
         self.child= None
+        self.notify_read_fd = None
         self.logger=logger
         self.hutil = hutil
 
@@ -77,25 +85,101 @@ class FreezeHandler(object):
     def reset_signals(self):
         self.sig_handle = 0
         self.child= None
+        self.close_notify_pipe()
 
+    def close_notify_pipe(self):
+        if(self.notify_read_fd is not None):
+            os.close(self.notify_read_fd)
+            self.notify_read_fd = None
 
-    def startproc(self,args):
-        binary_thread = threading.Thread(target=thread_for_binary, args=[self, args])
-        binary_thread.start()
+    def start_binary(self, args):
+        self.logger.log("****** 1. Starting Freeze Binary ",True)
+        notify_read_fd, notify_write_fd = os.pipe()
+        env = dict(os.environ)
+        env[FreezeHandler.NotifyFdEnvironmentVariable] = str(notify_write_fd)
+        # independent mounts are frozen concurrently by the binary, 1 freezes them one by one
+        max_parallel_mounts = self.hutil.get_intvalue_from_configfile('FreezeMountConcurrency', 0)
+        if(max_parallel_mounts > 0):
+            env[FreezeHandler.MaxParallelMountsEnvironmentVariable] = str(max_parallel_mounts)
+        popen_args = {}
+        if sys.version_info > (3,):
+            popen_args['pass_fds'] = (notify_write_fd,)
+        try:
+            self.child = subprocess.Popen(args, stdout=subprocess.PIPE, env=env, **popen_args)
+            self.notify_read_fd = notify_read_fd
+            self.logger.log("Binary subprocess Created",True)
+        except Exception:
+            os.close(notify_read_fd)
+            raise
+        finally:
+            # only the binary keeps the write end, so its exit shows up as end of file on the read end
+            os.close(notify_write_fd)
 
+    def wait_for_binary_event(self, timeout):
+        """
+        Returns the next event the binary wrote to the control pipe, b'' once the binary exited, or None on timeout.
+        """
+        if(self.notify_read_fd is None):
+            time.sleep(max(timeout, 0))
+            return None
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if(remaining <= 0):
+                return None
+            try:
+                readable, writable, exceptional = select.select([self.notify_read_fd], [], [], remaining)
+            except (select.error, OSError) as e:
+                if(e.args[0] == errno.EINTR):
+                    continue
+                raise
+            if(len(readable) > 0):
+                return os.read(self.notify_read_fd, 1)
+
+    def startproc(self,args):
         SafeFreezeWaitInSecondsDefault = 66
 
         proc_sleep_time = self.hutil.get_intvalue_from_configfile('SafeFreezeWaitInSeconds',SafeFreezeWaitInSecondsDefault)
-        
-        for i in range(0,(int(proc_sleep_time/2))):
-            if(self.sig_handle==0):
-                self.logger.log("inside while with sig_handle "+str(self.sig_handle))
-                time.sleep(2)
-            else:
-                break
+
+        try:
+            self.start_binary(args)
+        except Exception as e:
+            errMsg = 'Failed to start the freeze binary with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+            self.logger.log(errMsg, True, 'Error')
+            return self.sig_handle
+
+        deadline = time.time() + proc_sleep_time
+        while(self.sig_handle == 0 and time.time() < deadline):
+            event = self.wait_for_binary_event(min(FreezeHandler.PollIntervalInSeconds, deadline - time.time()))
+            if(event == FreezeHandler.FreezeCompletedEvent and self.sig_handle == 0):
+                self.logger.log("****** 4. Freeze Completed (control pipe)",False)
+                self.sig_handle = 1
+            elif(event == b''):
+                self.close_notify_pipe()
+                if(self.sig_handle == 0):
+                    self.logger.log("****** 9. Binary Process completed (control pipe closed)",True)
+                    self.sig_handle = 2
         self.logger.log("Binary output for signal handled: "+str(self.sig_handle))
         return self.sig_handle
 
+    def thaw(self, timeout):
+        """
+        Sends the thaw signal and waits up to timeout seconds for the binary to exit, returns its return code or None.
+        """
+        self.child.send_signal(signal.SIGUSR1)
+        deadline = time.time() + timeout
+        while(self.child.poll() is None and time.time() < deadline):
+            event = self.wait_for_binary_event(min(FreezeHandler.PollIntervalInSeconds, deadline - time.time()))
+            if(event == b''):
+                # the pipe closes as the binary exits, reap it
+                self.close_notify_pipe()
+                while(self.child.poll() is None and time.time() < deadline):
+                    time.sleep(0.005)
+            elif(event is None):
+                self.logger.log("child still running sigusr1 sent")
+        self.close_notify_pipe()
+        return self.child.returncode
+
     def signal_receiver(self):
         signal.signal(signal.SIGUSR1,self.sigusr1_handler)
         signal.signal(signal.SIGCHLD,self.sigchld_handler)
@@ -119,10 +203,20 @@ class FsFreezer:
         self.freeze_handler = FreezeHandler(self.logger, self.hutil)
         self.mount_open_failed = False
         self.resource_disk= ResourceDiskUtil(patching = patching, logger = logger)
+        self.resource_disk_mount_point = None
+        self.resource_disk_mount_point_checked = False
+        self.mount_freeze_latencies = {}
         self.skip_freeze= True
 
+    def get_resource_disk_mount_point(self):
+        # looked up once per FsFreezer, should_skip runs for every mount
+        if(self.resource_disk_mount_point_checked == False):
+            self.resource_disk_mount_point = self.resource_disk.get_resource_disk_mount_point()
+            self.resource_disk_mount_point_checked = True
+        return self.resource_disk_mount_point
+
     def should_skip(self, mount):
-        resource_disk_mount_point= self.resource_disk.get_resource_disk_mount_point()
+        resource_disk_mount_point= self.get_resource_disk_mount_point()
         if(resource_disk_mount_point is not None and mount.mount_point == resource_disk_mount_point):
             return True
         elif((mount.fstype == 'ext3' or mount.fstype == 'ext4' or mount.fstype == 'xfs' or mount.fstype == 'btrfs') and mount.type != 'loop' ):
@@ -165,6 +259,7 @@ class FsFreezer:
             if(self.skip_freeze == True):
                 return freeze_result,timedout
             self.logger.log("arg : " + str(args),True)
+            self.mount_freeze_latencies = {}
             self.freeze_handler.reset_signals()
             self.freeze_handler.signal_receiver()
             self.logger.log("proceeded for accepting signals", True)
@@ -172,7 +267,9 @@ class FsFreezer:
                 self.logger.enforce_local_flag(True)
             else:
                 self.logger.enforce_local_flag(False) 
+            freeze_span = SpanTracer.start_span(SpanName.freeze, mountCount = len(args) - 2)
             sig_handle=self.freeze_handler.startproc(args)
+            freeze_span.finish(sigHandle = sig_handle)
             self.logger.log("freeze_safe after returning from startproc : sig_handle="+str(sig_handle))
             if(sig_handle != 1):
                 if (self.freeze_handler.child is not None):
@@ -210,13 +307,9 @@ class FsFreezer:
         elif(self.freeze_handler.child.poll() is None):
             self.logger.log("child process still running")
             self.logger.log("****** 7. Sending Thaw Signal to Binary")
-            self.freeze_handler.child.send_signal(signal.SIGUSR1)
-            for i in range(0,30):
-                if(self.freeze_handler.child.poll() is None):
-                    self.logger.log("child still running sigusr1 sent")
-                    time.sleep(1)
-                else:
-                    break
+            thaw_span = SpanTracer.start_span(SpanName.thaw)
+            self.freeze_handler.thaw(30)
+            thaw_span.finish(returnCode = self.freeze_handler.child.returncode)
             self.logger.enforce_local_flag(True)
             self.log_binary_output()
             if(self.freeze_handler.child.returncode!=0):
@@ -238,6 +331,20 @@ class FsFreezer:
         self.logger.enforce_local_flag(True)
         return thaw_result, unable_to_sleep
 
+    def trace_mount_freeze(self, line):
+        match = re.search(r'(Freeze|Thaw) timing: (.*) start_us=(\d+) duration_us=(\d+)', line)
+        if(match is not None):
+            duration = int(match.group(4)) / 1000000.0
+            start = int(match.group(3)) / 1000000.0
+            if(not SpanTracer.clock_is_monotonic):
+                # binary timestamps are CLOCK_MONOTONIC, only the duration is meaningful against time.time()
+                start = SpanTracer.origin
+            if(match.group(1) == 'Freeze'):
+                self.mount_freeze_latencies[match.group(2)] = int(round(duration * 1000))
+                SpanTracer.add_completed_span(SpanName.freezeMount, start, duration, mountPoint = match.group(2))
+            else:
+                SpanTracer.add_completed_span(SpanName.thawMount, start, duration, mountPoint = match.group(2))
+
     def log_binary_output(self):
         self.logger.log("============== Binary output traces start ================= ", True)
         while True:
@@ -248,9 +355,12 @@ class FsFreezer:
                 line = str(line)
             if("Failed to open:" in line):
                 self.mount_open_failed = True
+            self.trace_mount_freeze(line)
             if(line != ''):
                 self.logger.log(line.rstrip(), True)
             else:
                 break
         self.logger.log("============== Binary output traces end ================= ", True)
+        if(len(self.mount_freeze_latencies) > 0):
+            HandlerUtil.HandlerUtility.add_to_telemetery_data("mountFreezeLatencyInMs", ",".join([mount_point + ":" + str(latency) for mount_point, latency in sorted(self.mount_freeze_latencies.items())]))
 
@@ -27,14 +27,19 @@ try:
     import ConfigParser as ConfigParsers
 except ImportError:
     import configparser as ConfigParsers
-import multiprocessing as mp
-import datetime
+try:
+    import Queue as Queues
+except ImportError:
+    import queue as Queues
+import threading
 from common import CommonVariables
 from HttpUtil import HttpUtil
 from Utils import Status
 from Utils import HandlerUtil
 from fsfreezer import FsFreezer
 from Utils import HostSnapshotObjects
+from Utils.SnapshotConcurrency import SnapshotConcurrencyController
+from Utils.SpanTracer import SpanTracer, SpanName
 
 class SnapshotInfoIndexerObj():
     def __init__(self, index, isSuccessful, snapshotTs, errorMessage):
@@ -65,12 +70,16 @@ class SnapshotResult(object):
 
 class GuestSnapshotter(object):
     """description of class"""
+    SnapshotConcurrencyFileName = 'SnapshotConcurrency.json'
+    ThrottledSnapshotRetries = 2
+
     def __init__(self, logger, hutil):
         self.logger = logger
         self.configfile='/etc/azure/vmbackup.conf'
         self.hutil = hutil
+        self.concurrency_controller = None
 
-    def snapshot(self, sasuri, sasuri_index, meta_data, snapshot_result_error, snapshot_info_indexer_queue, global_logger, global_error_logger):
+    def snapshot(self, sasuri, sasuri_index, meta_data, snapshot_result_error, snapshot_info_indexer_queue, global_logger, global_error_logger, retry_if_throttled = False):
         temp_logger=''
         error_logger=''
         snapshot_error = SnapshotError()
@@ -121,10 +130,14 @@ class GuestSnapshotter(object):
             snapshot_error.errorcode = CommonVariables.error
             snapshot_error.sasuri = sasuri
         temp_logger=temp_logger + str(datetime.datetime.now()) + ' snapshot ends..'
+        if(retry_if_throttled and SnapshotConcurrencyController.is_throttled(snapshot_info_indexer.statusCode)):
+            # the caller sends it again, only the final attempt is reported
+            return snapshot_info_indexer.statusCode
         global_logger.put(temp_logger)
         global_error_logger.put(error_logger)
         snapshot_result_error.put(snapshot_error)
         snapshot_info_indexer_queue.put(snapshot_info_indexer)
+        return snapshot_info_indexer.statusCode
 
     def snapshot_seq(self, sasuri, sasuri_index, meta_data):
         result = None
@@ -173,6 +186,61 @@ class GuestSnapshotter(object):
             snapshot_error.sasuri = sasuri
         return snapshot_error, snapshot_info_indexer
 
+    def get_max_snapshot_concurrency(self):
+        max_concurrency = self.hutil.get_intvalue_from_configfile('SnapshotConcurrency', 16)
+        if(max_concurrency <= 0):
+            max_concurrency = 16
+        return max_concurrency
+
+    def get_snapshot_concurrency(self, blob_count):
+        """ number of snapshot threads, the concurrency controller decides how many of them send at a time """
+        return min(self.get_max_snapshot_concurrency(), blob_count)
+
+    def get_concurrency_controller(self):
+        if(self.concurrency_controller is None):
+            max_concurrency = self.get_max_snapshot_concurrency()
+            initial_concurrency = self.hutil.get_intvalue_from_configfile('SnapshotInitialConcurrency', 8)
+            if(initial_concurrency <= 0):
+                initial_concurrency = 8
+            controller_path = None
+            try:
+                controller_path = os.path.join(self.hutil._context._log_dir, GuestSnapshotter.SnapshotConcurrencyFileName)
+            except Exception as e:
+                self.logger.log("Learned snapshot concurrency is not kept across runs, log folder unknown: " + str(e), True, 'Warning')
+            self.concurrency_controller = SnapshotConcurrencyController(self.logger, max_concurrency, initial_concurrency, controller_path)
+            self.concurrency_controller.load()
+        return self.concurrency_controller
+
+    def publish_concurrency(self):
+        self.concurrency_controller.save()
+        summary = self.concurrency_controller.get_summary()
+        self.logger.log("snapshot concurrency: " + str(summary))
+        HandlerUtil.HandlerUtility.add_to_telemetery_data("snapshotConcurrency", str(summary))
+
+    def snapshot_worker(self, snapshot_requests, meta_data, snapshot_result_error, snapshot_info_indexer_queue, global_logger, global_error_logger, snapshot_latencies):
+        while True:
+            try:
+                blob, blob_index, attempt = snapshot_requests.get_nowait()
+            except Queues.Empty:
+                return
+            ticket = self.concurrency_controller.acquire()
+            snapshot_span = SpanTracer.start_span(SpanName.snapshot, blobIndex = blob_index)
+            status_code = None
+            retry_if_throttled = attempt < GuestSnapshotter.ThrottledSnapshotRetries
+            try:
+                status_code = self.snapshot(blob, blob_index, meta_data, snapshot_result_error, snapshot_info_indexer_queue, global_logger, global_error_logger, retry_if_throttled)
+            finally:
+                snapshot_latencies[blob_index] = snapshot_span.finish().duration_in_ms()
+                self.concurrency_controller.release(ticket, status_code, snapshot_latencies[blob_index])
+            if(retry_if_throttled and SnapshotConcurrencyController.is_throttled(status_code)):
+                # sent again once the lowered limit leaves room for it, by this worker if the others are done
+                snapshot_requests.put((blob, blob_index, attempt + 1))
+
+    def publish_snapshot_latencies(self, snapshot_latencies):
+        latencies = [str(snapshot_latencies.get(blob_index)) for blob_index in range(len(snapshot_latencies))]
+        self.logger.log("snapshot latency in ms per blob index: " + ','.join(latencies))
+        HandlerUtil.HandlerUtility.add_to_telemetery_data("snapshotLatencyInMs", ','.join(latencies))
+
     def snapshotall_parallel(self, paras, freezer, thaw_done, g_fsfreeze_on):
         self.logger.log("doing snapshotall now in parallel...")
         snapshot_result = SnapshotResult()
@@ -183,49 +251,37 @@ class GuestSnapshotter(object):
         thaw_done_local = thaw_done
         unable_to_sleep = False
         all_snapshots_failed = False
-        set_next_backup_to_seq = False
         try:
-            self.logger.log("before start of multiprocessing queues..")
-            mp_jobs = []
-            queue_creation_starttime = datetime.datetime.now()
-            global_logger = mp.Queue()
-            global_error_logger = mp.Queue()
-            snapshot_result_error = mp.Queue()
-            snapshot_info_indexer_queue = mp.Queue()
-            time_before_snapshot_start = datetime.datetime.now()
+            self.logger.log("before start of snapshot threads..")
+            global_logger = Queues.Queue()
+            global_error_logger = Queues.Queue()
+            snapshot_result_error = Queues.Queue()
+            snapshot_info_indexer_queue = Queues.Queue()
+            snapshot_requests = Queues.Queue()
+            snapshot_latencies = {}
             blobs = paras.blobs
 
             if blobs is not None:
                 # initialize blob_snapshot_info_array
-                mp_jobs = []
                 blob_index = 0
                 self.logger.log('****** 5. Snaphotting (Guest-parallel) Started')
                 for blob in blobs:
                     blobUri = blob.split("?")[0]
                     self.logger.log("index: " + str(blob_index) + " blobUri: " + str(blobUri))
                     blob_snapshot_info_array.append(HostSnapshotObjects.BlobSnapshotInfo(False, blobUri, None, 500))
-                    try:
-                        mp_jobs.append(mp.Process(target=self.snapshot,args=(blob, blob_index, paras.backup_metadata, snapshot_result_error, snapshot_info_indexer_queue, global_logger, global_error_logger)))
-                    except Exception as e:
-                        self.logger.log("multiprocess queue creation failed")
-                        all_snapshots_failed = True
-                        raise Exception("Exception while creating multiprocess queue")
-
+                    snapshot_requests.put((blob, blob_index, 0))
                     blob_index = blob_index + 1
 
-                counter = 0
-                for job in mp_jobs:
-                    job.start()
-                    if(counter == 0):
-                        queue_creation_endtime = datetime.datetime.now()
-                        timediff = queue_creation_endtime - queue_creation_starttime
-                        if(timediff.seconds >= 10):
-                            self.logger.log("mp queue creation took more than 10 secs. Setting next backup to sequential")
-                            set_next_backup_to_seq = True
-                    counter = counter + 1
-
-                for job in mp_jobs:
-                    job.join()
+                # a bounded set of threads shares the pooled http connections, nothing is forked while frozen
+                snapshot_concurrency = self.get_snapshot_concurrency(len(blobs))
+                self.logger.log("snapshot threads: " + str(snapshot_concurrency) + ", requests in flight: " + str(self.get_concurrency_controller().get_concurrency(len(blobs))))
+                workers = []
+                for i in range(snapshot_concurrency):
+                    workers.append(threading.Thread(target=self.snapshot_worker, args=(snapshot_requests, paras.backup_metadata, snapshot_result_error, snapshot_info_indexer_queue, global_logger, global_error_logger, snapshot_latencies)))
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
                 self.logger.log('****** 6. Snaphotting (Guest-parallel) Completed')
                 thaw_result = None
                 if g_fsfreeze_on and thaw_done_local == False:
@@ -234,26 +290,24 @@ class GuestSnapshotter(object):
                     time_after_thaw = datetime.datetime.now()
                     HandlerUtil.HandlerUtility.add_to_telemetery_data("ThawTime", str(time_after_thaw-time_before_thaw))
                     thaw_done_local = True
-                    if(set_next_backup_to_seq == True):
-                        self.logger.log("Setting to sequential snapshot")
-                        self.hutil.set_value_to_configfile('seqsnapshot', '1')
                     self.logger.log('T:S thaw result ' + str(thaw_result))
                     if(thaw_result is not None and len(thaw_result.errors) > 0  and (snapshot_result is None or len(snapshot_result.errors) == 0)):
                         is_inconsistent = True
                         snapshot_result.errors.append(thaw_result.errors)
                         return snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done_local, unable_to_sleep, all_snapshots_failed
                 self.logger.log('end of snapshot process')
-                logging = [global_logger.get() for job in mp_jobs]
+                self.publish_snapshot_latencies(snapshot_latencies)
+                logging = [global_logger.get() for blob in blobs]
                 self.logger.log(str(logging))
-                error_logging = [global_error_logger.get() for job in mp_jobs]
+                error_logging = [global_error_logger.get() for blob in blobs]
                 self.logger.log(str(error_logging),False,'Error')
                 if not snapshot_result_error.empty():
-                    results = [snapshot_result_error.get() for job in mp_jobs]
+                    results = [snapshot_result_error.get() for blob in blobs]
                     for result in results:
                         if(result.errorcode != CommonVariables.success):
                             snapshot_result.errors.append(result)
                 if not snapshot_info_indexer_queue.empty():
-                    snapshot_info_indexers = [snapshot_info_indexer_queue.get() for job in mp_jobs]
+                    snapshot_info_indexers = [snapshot_info_indexer_queue.get() for blob in blobs]
                     for snapshot_info_indexer in snapshot_info_indexers:
                         # update blob_snapshot_info_array element properties from snapshot_info_indexer object
                         self.get_snapshot_info(snapshot_info_indexer, blob_snapshot_info_array[snapshot_info_indexer.index])
@@ -287,6 +341,7 @@ class GuestSnapshotter(object):
         all_snapshots_failed = False
         try:
             blobs = paras.blobs
+            snapshot_latencies = {}
             if blobs is not None:
                 blob_index = 0
                 self.logger.log('****** 5. Snaphotting (Guest-seq) Started')
@@ -294,7 +349,14 @@ class GuestSnapshotter(object):
                     blobUri = blob.split("?")[0]
                     self.logger.log("index: " + str(blob_index) + " blobUri: " + str(blobUri))
                     blob_snapshot_info_array.append(HostSnapshotObjects.BlobSnapshotInfo(False, blobUri, None, 500))
-                    snapshotError, snapshot_info_indexer = self.snapshot_seq(blob, blob_index, paras.backup_metadata)
+                    for attempt in range(GuestSnapshotter.ThrottledSnapshotRetries + 1):
+                        ticket = self.get_concurrency_controller().acquire()
+                        snapshot_span = SpanTracer.start_span(SpanName.snapshot, blobIndex = blob_index)
+                        snapshotError, snapshot_info_indexer = self.snapshot_seq(blob, blob_index, paras.backup_metadata)
+                        snapshot_latencies[blob_index] = snapshot_span.finish().duration_in_ms()
+                        self.concurrency_controller.release(ticket, snapshot_info_indexer.statusCode, snapshot_latencies[blob_index])
+                        if not SnapshotConcurrencyController.is_throttled(snapshot_info_indexer.statusCode):
+                            break
                     if(snapshotError.errorcode != CommonVariables.success):
                         snapshot_result.errors.append(snapshotError)
                     # update blob_snapshot_info_array element properties from snapshot_info_indexer object
@@ -304,6 +366,7 @@ class GuestSnapshotter(object):
                     blob_index = blob_index + 1
 
                 self.logger.log('****** 6. Snaphotting (Guest-seq) Completed')
+                self.publish_snapshot_latencies(snapshot_latencies)
                 all_snapshots_failed = all_failed
                 self.logger.log("Setting all_snapshots_failed to " + str(all_snapshots_failed))
 
@@ -330,7 +393,8 @@ class GuestSnapshotter(object):
 
     def snapshotall(self, paras, freezer, g_fsfreeze_on):
         thaw_done = False
-        if (self.hutil.get_intvalue_from_configfile('seqsnapshot',0) == 1 or self.hutil.get_intvalue_from_configfile('seqsnapshot',0) == 2 or (len(paras.blobs) <= 4)):
+        # a single request in flight, learned from throttling in earlier runs, is sent without threads
+        if (self.hutil.get_intvalue_from_configfile('seqsnapshot',0) == 1 or self.hutil.get_intvalue_from_configfile('seqsnapshot',0) == 2 or self.get_concurrency_controller().get_concurrency(len(paras.blobs)) <= 1):
             snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done, unable_to_sleep, all_snapshots_failed =  self.snapshotall_seq(paras, freezer, thaw_done, g_fsfreeze_on)
         else:
             snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent, thaw_done, unable_to_sleep, all_snapshots_failed =  self.snapshotall_parallel(paras, freezer, thaw_done, g_fsfreeze_on)
@@ -338,6 +402,7 @@ class GuestSnapshotter(object):
             if exceptOccurred and thaw_done == False and all_snapshots_failed:
                 self.logger.log("Trying sequential snapshotting as parallel snapshotting failed")
                 snapshot_result, blob_snapshot_info_array, all_failed, exceptOccurred, is_inconsistent,thaw_done, unable_to_sleep, all_snapshots_failed =  self.snapshotall_seq(paras, freezer, thaw_done, g_fsfreeze_on)
+        self.publish_concurrency()
         return snapshot_result, blob_snapshot_info_array, all_failed, is_inconsistent, unable_to_sleep, all_snapshots_failed
 
     def httpresponse_get_snapshot_info(self, resp, sasuri_index, sasuri, responseBody):
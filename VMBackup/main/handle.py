@@ -38,23 +38,22 @@ from time import sleep
 from os.path import join
 from mounts import Mounts
 from mounts import Mount
+from Utils.DiskUtil import DiskUtil
 from patch import *
 from fsfreezer import FsFreezer
 from common import CommonVariables
 from parameterparser import ParameterParser
 from Utils import HandlerUtil
-from Utils import SizeCalculation
 from Utils import Status
-from freezesnapshotter import FreezeSnapshotter
+from Utils.SpanTracer import SpanTracer, SpanName
 from backuplogger import Backuplogger
-from blobwriter import BlobWriter
 from taskidentity import TaskIdentity
 from MachineIdentity import MachineIdentity
 import ExtensionErrorCodeHelper
-from PluginHost import PluginHost
-from PluginHost import PluginHostResult
 import platform
-from workloadPatch import WorkloadPatch
+# the snapshot, size calculation, blob status, plugin host and workload modules are
+# imported by the functions using them: install, enable and the other commands
+# run under the agent's timeouts and need none of them
 
 #Main function is the only entrence to this extension handler
 
@@ -112,6 +111,7 @@ def status_report_to_blob(blob_report_msg):
     if(UploadStatusAndLog == None or UploadStatusAndLog == 'True'):
         try:
             if(para_parser is not None and para_parser.statusBlobUri is not None and para_parser.statusBlobUri != ""):
+                from blobwriter import BlobWriter
                 blobWriter = BlobWriter(hutil)
                 if(blob_report_msg is not None):
                     blobWriter.WriteBlob(blob_report_msg,para_parser.statusBlobUri)
@@ -129,6 +129,7 @@ def get_status_to_report(status, status_code, message, snapshot_info = None):
     file_report_msg = None
     try:
         if total_used_size == -1 :
+            from Utils import SizeCalculation
             sizeCalculation = SizeCalculation.SizeCalculation(patching = MyPatching , logger = backup_logger , para_parser = para_parser)
             total_used_size,size_calculation_failed = sizeCalculation.get_total_used_size()
             number_of_blobs = len(para_parser.includeLunList)
@@ -192,6 +193,7 @@ def freeze_snapshot(timeout):
     try:
         global hutil,backup_logger,run_result,run_status,error_msg,freezer,freeze_result,para_parser,snapshot_info_array,g_fsfreeze_on, workload_patch
         canTakeCrashConsistentSnapshot = can_take_crash_consistent_snapshot(para_parser)
+        from freezesnapshotter import FreezeSnapshotter
         freeze_snap_shotter = FreezeSnapshotter(backup_logger, hutil, freezer, g_fsfreeze_on, para_parser, canTakeCrashConsistentSnapshot)
         backup_logger.log("Calling do snapshot method", True, 'Info')
         run_result, run_status, snapshot_info_array = freeze_snap_shotter.doFreezeSnapshot()
@@ -209,6 +211,17 @@ def freeze_snapshot(timeout):
         hutil.SetExtErrorCode(ExtensionErrorCodeHelper.ExtensionErrorCodeEnum.error)
     #snapshot_done = True
 
+def publish_freeze_trace():
+    global backup_logger,hutil
+    try:
+        breakdown = SpanTracer.get_breakdown()
+        backup_logger.log("freeze window breakdown in ms: " + str(breakdown), True)
+        HandlerUtil.HandlerUtility.add_to_telemetery_data("freezeWindowBreakdownInMs", json.dumps(breakdown, sort_keys = True))
+        SpanTracer.write_trace_file(os.path.join(hutil._context._log_dir, 'FreezeTrace.json'))
+    except Exception as e:
+        errMsg = 'Failed to publish the freeze trace with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
+        backup_logger.log(errMsg, True, 'Warning')
+
 def check_snapshot_array_fail():
     global snapshot_info_array, backup_logger
     snapshot_array_fail = False
@@ -247,6 +260,7 @@ def daemon():
     global MyPatching,backup_logger,hutil,run_result,run_status,error_msg,freezer,para_parser,snapshot_done,snapshot_info_array,g_fsfreeze_on,total_used_size,patch_class_name,orig_distro, workload_patch
     #this is using the most recent file timestamp.
     hutil.do_parse_context('Executing')
+    hutil.start_workload_scan()
 
     try:
         backup_logger.log('starting daemon', True)
@@ -267,6 +281,8 @@ def daemon():
         errMsg = 'Failed to validate sequence number with error: %s, stack trace: %s' % (str(e), traceback.format_exc())
         backup_logger.log(errMsg, True, 'Error')
 
+    # the device table is built once per backup, disks may have been attached or detached since the last one
+    DiskUtil.invalidate_device_table()
     freezer = FsFreezer(patching= MyPatching, logger = backup_logger, hutil = hutil)
     global_error_result = None
     # precheck
@@ -296,14 +312,12 @@ def daemon():
         if(freezer.mounts is not None):
             hutil.partitioncount = len(freezer.mounts.mounts)
         backup_logger.log(" configfile " + str(configfile), True)
-        config = ConfigParsers.ConfigParser()
-        config.read(configfile)
-        if config.has_option('SnapshotThread','timeout'):
-            thread_timeout= config.get('SnapshotThread','timeout')      
-        if config.has_option('SnapshotThread','OnAppFailureDoFsFreeze'):
-            OnAppFailureDoFsFreeze= config.get('SnapshotThread','OnAppFailureDoFsFreeze')
-        if config.has_option('SnapshotThread','OnAppSuccessDoFsFreeze'):
-            OnAppSuccessDoFsFreeze= config.get('SnapshotThread','OnAppSuccessDoFsFreeze')
+        if hutil.get_value_from_configfile('timeout') is not None:
+            thread_timeout= hutil.get_value_from_configfile('timeout')
+        if hutil.get_value_from_configfile('OnAppFailureDoFsFreeze') is not None:
+            OnAppFailureDoFsFreeze= hutil.get_value_from_configfile('OnAppFailureDoFsFreeze')
+        if hutil.get_value_from_configfile('OnAppSuccessDoFsFreeze') is not None:
+            OnAppSuccessDoFsFreeze= hutil.get_value_from_configfile('OnAppSuccessDoFsFreeze')
     except Exception as e:
         errMsg='cannot read config file or file not present'
         backup_logger.log(errMsg, True, 'Warning')
@@ -393,6 +407,7 @@ def daemon():
                     backup_logger.log("the logs blob uri is not there, so do not upload log.")
                 backup_logger.log('commandToExecute is ' + commandToExecute, True)
                 
+                from workloadPatch import WorkloadPatch
                 workload_patch = WorkloadPatch.WorkloadPatch(backup_logger)
                 #new flow only if workload name is present in workload.conf
                 if workload_patch.name != None and workload_patch.name != "":
@@ -403,7 +418,8 @@ def daemon():
                         backup_logger.log("skip pre and post")
                         pre_skipped = True
                     else:
-                        workload_patch.pre()
+                        with SpanTracer.start_span(SpanName.preScript, workload = workload_patch.name):
+                            workload_patch.pre()
                     if len(workload_patch.error_details) > 0:
                         backup_logger.log("file system consistent backup only")
                     #todo error handling
@@ -423,7 +439,8 @@ def daemon():
                         g_fsfreeze_on = True
                     freeze_snapshot(thread_timeout)
                     if pre_skipped == False:
-                        workload_patch.post()
+                        with SpanTracer.start_span(SpanName.postScript, workload = workload_patch.name):
+                            workload_patch.post()
                     workload_error = workload_patch.populateErrors()
                     if workload_error != None and g_fsfreeze_on == False:
                         run_status = 'error'
@@ -448,6 +465,7 @@ def daemon():
                             error_msg = 'Enable failed in fsfreeze snapshot flow'
                             backup_logger.log(error_msg, True)
                 else:
+                    from PluginHost import PluginHost, PluginHostResult
                     PluginHostObj = PluginHost(logger=backup_logger)
                     PluginHostErrorCode,dobackup,g_fsfreeze_on = PluginHostObj.pre_check()
                     doFsConsistentbackup = False
@@ -470,7 +488,8 @@ def daemon():
                     postResult = PluginHostResult()
 
                     if not doFsConsistentbackup:
-                        preResult = PluginHostObj.pre_script()
+                        with SpanTracer.start_span(SpanName.preScript):
+                            preResult = PluginHostObj.pre_script()
                         dobackup = preResult.continueBackup
 
                         if(g_fsfreeze_on == False and preResult.anyScriptFailed):
@@ -480,7 +499,8 @@ def daemon():
                         freeze_snapshot(thread_timeout)
 
                     if not doFsConsistentbackup:
-                        postResult = PluginHostObj.post_script()
+                        with SpanTracer.start_span(SpanName.postScript):
+                            postResult = PluginHostObj.post_script()
                         if not postResult.continueBackup:
                             dobackup = False
                 
@@ -570,7 +590,9 @@ def daemon():
         status_report_msg = None
         hutil.SetExtErrorCode(run_result) #setting extension errorcode at the end if missed somewhere
         HandlerUtil.HandlerUtility.add_to_telemetery_data("extErrorCode", str(ExtensionErrorCodeHelper.ExtensionErrorCodeHelper.ExtensionErrorCodeNameDict[hutil.ExtErrorCode]))
+        HandlerUtil.HandlerUtility.add_to_telemetery_data("configFileReadCount", str(HandlerUtil.HandlerUtility.get_config_read_count()))
         total_used_size = -1
+        publish_freeze_trace()
         blob_report_msg, file_report_msg = get_status_to_report(run_status,run_result,error_msg, snapshot_info_array)
         if(hutil.is_status_file_exists()):
             status_report_to_file(file_report_msg)
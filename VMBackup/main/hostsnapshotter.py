@@ -35,17 +35,63 @@ from HttpUtil import HttpUtil
 from Utils import Status
 from Utils import HostSnapshotObjects
 from Utils import HandlerUtil
+from Utils.SpanTracer import SpanTracer, SpanName
 from fsfreezer import FsFreezer
 import sys
 
 
 class HostSnapshotter(object):
-    """description of class"""
-    def __init__(self, logger, hostIp):
+    """
+    Client of the host snapshot service. Both calls go over the keep-alive host connection of HttpUtil,
+    the dosnapshot request is built and its connection opened by prepare_snapshot before the freeze,
+    so that snapshotall only has to send it once the file systems are frozen.
+    """
+    PreSnapshotCallName = 'preSnapshot'
+    DoSnapshotCallName = 'doSnapshot'
+
+    def __init__(self, logger, hostIp, latency_histogram = None):
         self.logger = logger
         self.configfile='/etc/azure/vmbackup.conf'
+        self.hostIp = hostIp
         self.snapshoturi = 'http://' + hostIp + '/metadata/recsvc/snapshot/dosnapshot?api-version=2017-12-01'
         self.presnapshoturi = 'http://' + hostIp + '/metadata/recsvc/snapshot/presnapshot?api-version=2017-12-01'
+        self.latency_histogram = latency_histogram
+        self.pre_snapshot_latency_in_ms = None
+        self.prepared_snapshot_request = None
+
+    def record_latency(self, call_name, span):
+        if(self.latency_histogram is not None):
+            self.latency_histogram.record(call_name, span.duration_in_ms())
+
+    def prepare_snapshot(self, paras, taskId):
+        """
+        Builds the dosnapshot request and makes sure a connection to the host is open, everything snapshotall
+        would otherwise do between freeze and sending the request. Failures are left for snapshotall to report.
+        """
+        self.prepared_snapshot_request = None
+        try:
+            snapshoturi_obj = urlparser.urlparse(self.snapshoturi)
+            if(snapshoturi_obj is None or snapshoturi_obj.hostname is None):
+                return
+            diskIds = []
+            headers = {}
+            headers['Backup'] = 'true'
+            headers['Content-type'] = 'application/json'
+            hostDoSnapshotRequestBodyObj = HostSnapshotObjects.HostDoSnapshotRequestBody(taskId, diskIds, paras.snapshotTaskToken, paras.backup_metadata)
+            body_content = json.dumps(hostDoSnapshotRequestBodyObj, cls = HandlerUtil.ComplexEncoder)
+            self.logger.log('Headers : ' + str(headers))
+            self.logger.log('Host Request body : ' + str(body_content))
+            self.prepared_snapshot_request = (snapshoturi_obj, body_content, headers)
+        except Exception as e:
+            errorMsg = "Failed to prepare the snapshot request for host with error: %s, stack trace: %s" % (str(e), traceback.format_exc())
+            self.logger.log(errorMsg, False, 'Error')
+            return
+        try:
+            if(HttpUtil(self.logger).warm_host_connection(snapshoturi_obj.hostname)):
+                self.logger.log("Opened a new connection to host " + str(snapshoturi_obj.hostname) + " for dosnapshot")
+        except Exception as e:
+            errorMsg = "Failed to connect to host ahead of dosnapshot with error: %s, stack trace: %s" % (str(e), traceback.format_exc())
+            self.logger.log(errorMsg, False, 'Warning')
 
     def snapshotall(self, paras, freezer, g_fsfreeze_on, taskId):
         result = None
@@ -53,30 +99,26 @@ class HostSnapshotter(object):
         all_failed = True
         is_inconsistent = False
         unable_to_sleep = False
-        meta_data = paras.backup_metadata
         if(self.snapshoturi is None):
             self.logger.log("Failed to do the snapshot because snapshoturi is none",False,'Error')
             all_failed = True
         try:
-            snapshoturi_obj = urlparser.urlparse(self.snapshoturi)
-            if(snapshoturi_obj is None or snapshoturi_obj.hostname is None):
+            if(self.prepared_snapshot_request is None):
+                self.prepare_snapshot(paras, taskId)
+            if(self.prepared_snapshot_request is None):
                 self.logger.log("Failed to parse the snapshoturi",False,'Error')
                 all_failed = True
             else:
-                diskIds = []
-                body_content = ''
-                headers = {}
-                headers['Backup'] = 'true'
-                headers['Content-type'] = 'application/json'
-                hostDoSnapshotRequestBodyObj = HostSnapshotObjects.HostDoSnapshotRequestBody(taskId, diskIds, paras.snapshotTaskToken, meta_data)
-                body_content = json.dumps(hostDoSnapshotRequestBodyObj, cls = HandlerUtil.ComplexEncoder)
-                self.logger.log('Headers : ' + str(headers))
-                self.logger.log('Host Request body : ' + str(body_content))
+                snapshoturi_obj, body_content, headers = self.prepared_snapshot_request
+                self.prepared_snapshot_request = None
                 http_util = HttpUtil(self.logger)
                 self.logger.log("start calling the snapshot rest api")
                 # initiate http call for blob-snapshot and get http response
                 self.logger.log('****** 5. Snaphotting (Host) Started')
+                snapshot_span = SpanTracer.start_span(SpanName.hostSnapshot)
                 result, httpResp, errMsg,responseBody = http_util.HttpCallGetResponse('POST', snapshoturi_obj, body_content, headers = headers, responseBodyRequired = True, isHostCall = True)
+                snapshot_span.finish()
+                self.record_latency(HostSnapshotter.DoSnapshotCallName, snapshot_span)
                 self.logger.log('****** 6. Snaphotting (Host) Completed')
                 self.logger.log("dosnapshot responseBody: " + responseBody)
                 if(httpResp != None):
@@ -131,7 +173,10 @@ class HostSnapshotter(object):
                 http_util = HttpUtil(self.logger)
                 self.logger.log("start calling the presnapshot rest api")
                 # initiate http call for blob-snapshot and get http response
-                result, httpResp, errMsg,responseBody = http_util.HttpCallGetResponse('POST', presnapshoturi_obj, body_content, headers = headers, responseBodyRequired = True, isHostCall = True)
+                with SpanTracer.start_span(SpanName.hostPreSnapshot) as pre_snapshot_span:
+                    result, httpResp, errMsg,responseBody = http_util.HttpCallGetResponse('POST', presnapshoturi_obj, body_content, headers = headers, responseBodyRequired = True, isHostCall = True)
+                self.pre_snapshot_latency_in_ms = pre_snapshot_span.duration_in_ms()
+                self.record_latency(HostSnapshotter.PreSnapshotCallName, pre_snapshot_span)
                 self.logger.log("presnapshot responseBody: " + responseBody)
                 if(httpResp != None):
                     statusCode = httpResp.status
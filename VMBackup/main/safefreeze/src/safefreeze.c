@@ -27,6 +27,9 @@
 #include<unistd.h>
 #include<sys/stat.h>
 #include <errno.h>
+#include <stdint.h>
+#include <sys/select.h>
+#include <pthread.h>
 
 
 #define JUMPWITHSTATUS(x)        \
@@ -34,23 +37,184 @@
     status = (x);                \
     if (status) goto CLEANUP;    \
 }
+
+#define DEFAULT_MAX_PARALLEL_MOUNTS 16
+
+pthread_mutex_t gLoggerLock = PTHREAD_MUTEX_INITIALIZER;
+
 void logger(const char *logstr,...)
 {
     time_t mytime;
-    struct tm * timeinfo;
+    struct tm timeinfo;
     char buffer[80];
     time(&mytime);
-    timeinfo = localtime(&mytime);
-    strftime(buffer, 80, "%F %X", timeinfo);
+    localtime_r(&mytime, &timeinfo);
+    strftime(buffer, 80, "%F %X", &timeinfo);
     va_list arg;
-    int done;
+    pthread_mutex_lock(&gLoggerLock);
     printf("%s ", buffer);
     va_start(arg, logstr);
-    done = vfprintf(stdout,  logstr, arg);
+    vfprintf(stdout,  logstr, arg);
     va_end(arg);
+    pthread_mutex_unlock(&gLoggerLock);
 }
 
+typedef struct
+{
+    char *mountPoint;
+    int fd;
+    int level;
+    int frozen;
+    int error;
+    int64_t startUs;
+    int64_t durationUs;
+} MountState;
+
 int gThaw = 0;
+int gNotifyFd = -1;
+
+
+int64_t monotonicMicroseconds()
+{
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return ((int64_t) now.tv_sec) * 1000000 + now.tv_nsec / 1000;
+}
+
+
+// 1 if mountPoint is nested below parentMountPoint, e.g. /data/logs below /data
+int isNestedMount(const char *mountPoint, const char *parentMountPoint)
+{
+    size_t parentLength = strlen(parentMountPoint);
+    if (strcmp(mountPoint, parentMountPoint) == 0)
+    {
+        return 0;
+    }
+    if (strcmp(parentMountPoint, "/") == 0)
+    {
+        return mountPoint[0] == '/';
+    }
+    return strncmp(mountPoint, parentMountPoint, parentLength) == 0 && mountPoint[parentLength] == '/';
+}
+
+
+// level 0 mounts have no other mount nested below them, a mount is one level above the highest mount nested below it.
+// Mounts of the same level are independent and are frozen together, levels are frozen bottom up and thawed top down.
+int assignMountLevels(MountState *mounts, int numMounts)
+{
+    int i = 0, j = 0, changed = 1, maxLevel = 0;
+    for (i = 0; i < numMounts; i++)
+    {
+        mounts[i].level = 0;
+    }
+    while (changed)
+    {
+        changed = 0;
+        for (i = 0; i < numMounts; i++)
+        {
+            for (j = 0; j < numMounts; j++)
+            {
+                if (isNestedMount(mounts[j].mountPoint, mounts[i].mountPoint) && mounts[i].level <= mounts[j].level)
+                {
+                    mounts[i].level = mounts[j].level + 1;
+                    changed = 1;
+                }
+            }
+        }
+    }
+    for (i = 0; i < numMounts; i++)
+    {
+        if (mounts[i].level > maxLevel)
+        {
+            maxLevel = mounts[i].level;
+        }
+    }
+    return maxLevel;
+}
+
+
+void *freezeMount(void *arg)
+{
+    MountState *mount = (MountState *) arg;
+    mount->startUs = monotonicMicroseconds();
+    if (ioctl(mount->fd, FIFREEZE, 0) != 0)
+    {
+        mount->error = errno;
+    }
+    else
+    {
+        mount->frozen = 1;
+    }
+    mount->durationUs = monotonicMicroseconds() - mount->startUs;
+    return NULL;
+}
+
+
+void *thawMount(void *arg)
+{
+    MountState *mount = (MountState *) arg;
+    mount->startUs = monotonicMicroseconds();
+    if (ioctl(mount->fd, FITHAW, 0) != 0)
+    {
+        mount->error = errno;
+    }
+    else
+    {
+        mount->frozen = 0;
+    }
+    mount->durationUs = monotonicMicroseconds() - mount->startUs;
+    return NULL;
+}
+
+
+// runs operation on the selected mounts of one level, at most maxParallel at a time
+void runOnLevel(MountState *mounts, int numMounts, int level, int onlyFrozen, int maxParallel, void *(*operation)(void *))
+{
+    pthread_t *threads = (pthread_t *) malloc(sizeof(pthread_t) * maxParallel);
+    int *started = (int *) malloc(sizeof(int) * maxParallel);
+    int i = 0, batch = 0, next = 0;
+    while (next < numMounts)
+    {
+        batch = 0;
+        while (next < numMounts && batch < maxParallel)
+        {
+            MountState *mount = &mounts[next++];
+            if (mount->level != level || (onlyFrozen && !mount->frozen))
+            {
+                continue;
+            }
+            mount->error = 0;
+            // fall back to doing it inline if a thread can not be created
+            started[batch] = (threads != NULL && started != NULL && maxParallel > 1 && pthread_create(&threads[batch], NULL, operation, mount) == 0);
+            if (!started[batch])
+            {
+                operation(mount);
+            }
+            batch++;
+        }
+        for (i = 0; i < batch; i++)
+        {
+            if (started[i])
+            {
+                pthread_join(threads[i], NULL);
+            }
+        }
+    }
+    free(threads);
+    free(started);
+}
+
+
+void notifyParent(char event)
+{
+    // the parent waits on this pipe, see FreezeHandler in fsfreezer.py
+    if (gNotifyFd >= 0)
+    {
+        while (write(gNotifyFd, &event, 1) < 0 && errno == EINTR)
+        {
+        }
+    }
+}
 
 
 void globalSignalHandler(int signum)
@@ -74,7 +238,10 @@ int main(int argc, char *argv[])
 
     int timeout = 0;
     int numFileSystems = 0;
-    int *fileSystemDescriptors = NULL;
+    MountState *mounts = NULL;
+    int maxLevel = 0;
+    int maxParallel = DEFAULT_MAX_PARALLEL_MOUNTS;
+    int level = 0;
 
     int i = 0;
 
@@ -90,28 +257,41 @@ int main(int argc, char *argv[])
         JUMPWITHSTATUS(EXIT_FAILURE);
     }
 
+    char *notifyFd = getenv("SAFEFREEZE_NOTIFY_FD");
+    if (notifyFd != NULL)
+    {
+        gNotifyFd = atoi(notifyFd);
+    }
+
+    char *maxParallelMounts = getenv("SAFEFREEZE_MAX_PARALLEL_MOUNTS");
+    if (maxParallelMounts != NULL && atoi(maxParallelMounts) > 0)
+    {
+        maxParallel = atoi(maxParallelMounts);
+    }
+
     numFileSystems = argc - 2;
-    fileSystemDescriptors = (int *) malloc(sizeof(int) * numFileSystems);
+    mounts = (MountState *) calloc(numFileSystems, sizeof(MountState));
 
     for (i = 0; i < numFileSystems; i++)
     {
-        fileSystemDescriptors[i] = -1;
+        mounts[i].mountPoint = argv[i + 2];
+        mounts[i].fd = -1;
     }
 
     for (i = 0; i < numFileSystems; i++)
     {
         char *mountPoint = argv[i + 2];
 
-        if ((fileSystemDescriptors[i] = open(mountPoint, O_RDONLY | O_NONBLOCK)) < 0)
+        if ((mounts[i].fd = open(mountPoint, O_RDONLY | O_NONBLOCK)) < 0)
         {
             int errsv = errno;
-            logger("Failed to open: %s with error: %d and error message: %s\n", mountPoint, fileSystemDescriptors[i], strerror(errsv));
+            logger("Failed to open: %s with error: %d and error message: %s\n", mountPoint, mounts[i].fd, strerror(errsv));
             JUMPWITHSTATUS(EXIT_FAILURE);
         }
 
         struct stat sb;
 
-        if (fstat(fileSystemDescriptors[i], &sb) == -1)
+        if (fstat(mounts[i].fd, &sb) == -1)
         {
             int errsv = errno;
             logger("Failed to stat: %s with error message: %s\n", mountPoint, strerror(errsv));
@@ -145,22 +325,55 @@ int main(int argc, char *argv[])
         JUMPWITHSTATUS(EXIT_FAILURE);
     }
 
+    // SIGUSR1 stays blocked outside of pselect, so a thaw signal is never lost between the gThaw check and the wait
+    sigset_t thawSignalMask, waitSignalMask;
+    sigemptyset(&thawSignalMask);
+    sigaddset(&thawSignalMask, SIGUSR1);
+    if (sigprocmask(SIG_BLOCK, &thawSignalMask, &waitSignalMask) != 0)
+    {
+        logger("Failed to block the thaw signal\n");
+        JUMPWITHSTATUS(EXIT_FAILURE);
+    }
+    sigdelset(&waitSignalMask, SIGUSR1);
+
+    maxLevel = assignMountLevels(mounts, numFileSystems);
+
     logger("****** 2. Binary Freeze Started \n");
     sync();
-    for (i = 0; i < numFileSystems; i++)
+    for (level = 0; level <= maxLevel; level++)
     {
-        char *mountPoint = argv[i + 2];
-        logger("Freezing: %s\n", mountPoint);
+        for (i = 0; i < numFileSystems; i++)
+        {
+            if (mounts[i].level == level)
+            {
+                logger("Freezing: %s level: %d\n", mounts[i].mountPoint, level);
+            }
+        }
+
+        runOnLevel(mounts, numFileSystems, level, 0, maxParallel, freezeMount);
 
-        if (ioctl(fileSystemDescriptors[i], FIFREEZE, 0) != 0)
+        for (i = 0; i < numFileSystems; i++)
         {
-            int errsv = errno;
-            logger("Failed to FIFREEZE: %s with error message: %s\n", mountPoint, strerror(errsv));
-            JUMPWITHSTATUS(EXIT_FAILURE);
+            if (mounts[i].level != level)
+            {
+                continue;
+            }
+            if (!mounts[i].frozen)
+            {
+                logger("Failed to FIFREEZE: %s with error message: %s\n", mounts[i].mountPoint, strerror(mounts[i].error));
+                status = EXIT_FAILURE;
+            }
+            else
+            {
+                logger("Freeze timing: %s start_us=%lld duration_us=%lld\n", mounts[i].mountPoint, (long long) mounts[i].startUs, (long long) mounts[i].durationUs);
+            }
         }
+        JUMPWITHSTATUS(status);
     }
 
     logger("****** 3. Binary Freeze Completed \n");
+    fflush(stdout);
+    notifyParent('F');
 
     if (kill(getppid(), SIGUSR1) != 0)
     {
@@ -180,7 +393,8 @@ int main(int argc, char *argv[])
         }
         else
         {
-            sleep(1);
+            struct timespec oneSecond = {1, 0};
+            pselect(0, NULL, NULL, NULL, &oneSecond, &waitSignalMask);
             logger("sleep for 1 second \n");
         }
     }
@@ -198,27 +412,60 @@ int main(int argc, char *argv[])
 
 CLEANUP:
 
-    if (fileSystemDescriptors != NULL)
+    if (mounts != NULL)
     {
-        for (i = numFileSystems-1 ; i >= 0; i--)
+        // parents are thawed before the mounts nested below them, only what this process froze is thawed
+        for (level = maxLevel; level >= 0; level--)
         {
-            if (fileSystemDescriptors[i] >= 0)
+            for (i = 0; i < numFileSystems; i++)
             {
-                char *mountPoint = argv[i + 2];
-                logger("Thawing: %s\n", mountPoint);
+                if (mounts[i].level != level)
+                {
+                    continue;
+                }
+                // the freeze timing is logged already, only the mounts thawed below get a duration again
+                mounts[i].durationUs = -1;
+                if (mounts[i].frozen)
+                {
+                    logger("Thawing: %s\n", mounts[i].mountPoint);
+                }
+            }
 
-                if (ioctl(fileSystemDescriptors[i], FITHAW, 0) != 0)
+            runOnLevel(mounts, numFileSystems, level, 1, maxParallel, thawMount);
+
+            for (i = 0; i < numFileSystems; i++)
+            {
+                if (mounts[i].level != level)
+                {
+                    continue;
+                }
+                if (mounts[i].error == 0)
+                {
+                    if (mounts[i].durationUs >= 0)
+                    {
+                        logger("Thaw timing: %s start_us=%lld duration_us=%lld\n", mounts[i].mountPoint, (long long) mounts[i].startUs, (long long) mounts[i].durationUs);
+                    }
+                    continue;
+                }
+                if (mounts[i].frozen)
                 {
-                    logger("Failed to FITHAW: %s with error message : %s\n", mountPoint, strerror(errno));
+                    logger("Failed to FITHAW: %s with error message : %s\n", mounts[i].mountPoint, strerror(mounts[i].error));
                     status = EXIT_FAILURE;
                 }
+                mounts[i].error = 0;
+            }
+        }
 
-                close(fileSystemDescriptors[i]);
-                fileSystemDescriptors[i] = -1;
+        for (i = 0; i < numFileSystems; i++)
+        {
+            if (mounts[i].fd >= 0)
+            {
+                close(mounts[i].fd);
+                mounts[i].fd = -1;
             }
         }
-        free(fileSystemDescriptors);
-        fileSystemDescriptors = NULL;
+        free(mounts);
+        mounts = NULL;
     }
 
     return status;
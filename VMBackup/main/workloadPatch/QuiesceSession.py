@@ -0,0 +1,205 @@
+#!/usr/bin/python
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import subprocess
+import sys
+import threading
+try:
+    import Queue as Queues
+except ImportError:
+    import queue as Queues
+import Utils.HandlerUtil
+from Utils.SpanTracer import monotonic_now
+
+class IpcFolderWatcher:
+    """
+    Calls on_change whenever a file is created, written or moved into the IPC folder, through inotify.
+    Where inotify can not be used (no libc support, folder missing) the folder is checked every PollIntervalInSeconds.
+    """
+    InotifyEventMask = 0x00000008 | 0x00000080 | 0x00000100 # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    PollIntervalInSeconds = 0.2
+
+    def __init__(self, logger, folder, on_change):
+        self.logger = logger
+        self.folder = folder
+        self.on_change = on_change
+        self.stopped = threading.Event()
+        self.inotify_fd = None
+        self.stop_read_fd = None
+        self.stop_write_fd = None
+        self.watcher_thread = None
+
+    def start(self):
+        self.inotify_fd = self.open_inotify()
+        if self.inotify_fd is None:
+            target = self.poll_loop
+        else:
+            self.stop_read_fd, self.stop_write_fd = os.pipe()
+            target = self.inotify_loop
+        self.watcher_thread = threading.Thread(target=target)
+        self.watcher_thread.daemon = True
+        self.watcher_thread.start()
+        return self
+
+    def open_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init failed")
+            folder = self.folder
+            if not isinstance(folder, bytes):
+                folder = folder.encode(sys.getfilesystemencoding() or 'utf-8')
+            if libc.inotify_add_watch(fd, ctypes.c_char_p(folder), IpcFolderWatcher.InotifyEventMask) < 0:
+                error = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(error, "inotify_add_watch failed")
+            return fd
+        except Exception as e:
+            self.logger.log("WorkloadPatch: inotify not available for IPC folder, polling it instead: " + str(e))
+            return None
+
+    def inotify_loop(self):
+        # only a byte on the stop pipe ends the loop, stop() may still be about to write it
+        while True:
+            try:
+                readable, writable, exceptional = select.select([self.inotify_fd, self.stop_read_fd], [], [])
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.stop_read_fd in readable:
+                break
+            os.read(self.inotify_fd, 4096)
+            self.on_change()
+        os.close(self.inotify_fd)
+        os.close(self.stop_read_fd)
+        os.close(self.stop_write_fd)
+
+    def poll_loop(self):
+        while not self.stopped.wait(IpcFolderWatcher.PollIntervalInSeconds):
+            self.on_change()
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.stop_write_fd is not None:
+            os.write(self.stop_write_fd, b'x')
+        self.watcher_thread.join(1)
+
+class QuiesceSession:
+    """
+    One SQL client run of a workload script. Its output is read by a thread as it is written, so the quiesce
+    is seen as done on the line the script prints for it (ready_markers), or as soon as the script creates
+    outfile in the IPC folder, instead of on the next poll. Without ready markers the script is done when
+    its output ends. The session stays open until the script ends or is killed.
+    """
+    def __init__(self, logger, engine, args, ready_markers = None, outfile = None, stdin = None, stderr = None):
+        self.logger = logger
+        self.engine = engine
+        self.args = args
+        self.ready_markers = ready_markers
+        self.outfile = outfile
+        self.stdin = stdin
+        self.stderr = stderr
+        self.process = None
+        self.watcher = None
+        self.lines = Queues.Queue()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.output_ended = threading.Event()
+        self.start_time = None
+        self.ready_time = None
+        self.ready_source = None
+
+    def start(self):
+        self.logger.log("WorkloadPatch: command to execute: "+str(self.args))
+        self.start_time = monotonic_now()
+        self.process = subprocess.Popen(self.args, stdout=subprocess.PIPE, stdin=self.stdin, stderr=self.stderr, shell=True)
+        reader_thread = threading.Thread(target=self.read_output)
+        reader_thread.daemon = True
+        reader_thread.start()
+        if self.outfile:
+            self.watcher = IpcFolderWatcher(self.logger, os.path.dirname(self.outfile), self.check_outfile).start()
+        return self
+
+    def read_output(self):
+        for line in iter(self.process.stdout.readline, b''):
+            line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
+            self.lines.put(line)
+            if self.ready_markers is not None:
+                for marker in self.ready_markers:
+                    if marker in line:
+                        self.set_ready('stdout')
+        self.process.stdout.close()
+        if self.ready_markers is None:
+            self.set_ready('exit')
+        self.lines.put(None)
+        self.output_ended.set()
+        # wakes wait_until_ready, the script ended without signaling
+        self.ready.set()
+
+    def check_outfile(self):
+        if os.path.exists(self.outfile):
+            self.set_ready('outfile')
+
+    def set_ready(self, source):
+        with self.lock:
+            if self.ready_time is None:
+                self.ready_time = monotonic_now()
+                self.ready_source = source
+        self.ready.set()
+
+    def wait_until_ready(self, timeout):
+        """ True once the script signaled the quiesce, False if it ended without or timeout seconds passed """
+        self.ready.wait(timeout)
+        if self.outfile:
+            # the outfile may have been written just before the output ended
+            self.check_outfile()
+            self.watcher.stop()
+        return self.ready_time is not None
+
+    def wait_for_output_end(self, timeout):
+        return self.output_ended.wait(timeout)
+
+    def get_lines(self, timeout):
+        """ output lines as they come, until the output ends or timeout seconds passed """
+        deadline = monotonic_now() + timeout
+        while True:
+            remaining = deadline - monotonic_now()
+            if remaining <= 0:
+                self.logger.log("WorkloadPatch: " + self.engine + " script output did not end within " + str(timeout) + " seconds")
+                return
+            try:
+                line = self.lines.get(True, remaining)
+            except Queues.Empty:
+                continue
+            if line is None:
+                return
+            yield line
+
+    def get_ready_latency_in_ms(self):
+        if self.ready_time is None:
+            return None
+        return int((self.ready_time - self.start_time) * 1000)
@@ -18,7 +18,6 @@
 
 import sys
 import Utils.HandlerUtil
-import threading
 import os
 from time import sleep
 try:
@@ -28,6 +27,7 @@ except ImportError:
 import subprocess
 from common import CommonVariables
 from workloadPatch.LogBackupPatch import LogBackupPatch
+from workloadPatch.QuiesceSession import QuiesceSession
 
 class ErrorDetail:
     def __init__(self, errorCode, errorMsg):
@@ -35,6 +35,10 @@ class ErrorDetail:
         self.errorMsg = errorMsg
     
 class WorkloadPatch:
+    MysqlQuiescedMarker = "azbackupQuiesced"
+    WaitForQuiesceInSeconds = 120
+    WaitForScriptOutputInSeconds = 60
+
     def __init__(self, logger):
         self.logger = logger
         self.name = None
@@ -47,6 +51,7 @@ class WorkloadPatch:
         self.enforce_slave_only = 0
         self.role = "master"
         self.child = []
+        self.quiesce_session = None
         self.timeout = "90"
         self.linux_user = "root"
         self.sudo_user = "sudo"
@@ -128,9 +133,8 @@ class WorkloadPatch:
                 self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadIPCDirectoryMissing, "IPC directory missing"))
                 return None
             prescript = os.path.join(self.temp_script_folder, self.scriptpath + "/preMysqlMaster.sql")
-            arg = self.sudo_user+" "+self.command+self.name+" "+self.cred_string+" -e\"set @timeout="+self.timeout+";set @outfile=\\\"\\\\\\\""+self.outfile+"\\\\\\\"\\\";source "+prescript+";\""
-            binary_thread = threading.Thread(target=self.thread_for_sql, args=[arg])
-            binary_thread.start()
+            arg = self.sudo_user+" "+self.command+self.name+" --unbuffered "+self.cred_string+" -e\"set @timeout="+self.timeout+";set @outfile=\\\"\\\\\\\""+self.outfile+"\\\\\\\"\\\";source "+prescript+";\""
+            self.startSqlSession(arg)
             self.waitForPreScriptCompletion()
         elif 'oracle' in self.name.lower():
             self.logger.log("WorkloadPatch: Pre- Inside oracle pre")
@@ -138,20 +142,12 @@ class WorkloadPatch:
             args = "su - "+self.linux_user+" -c "+"\'"+preOracle+"\'"
             self.logger.log("WorkloadPatch: argument passed for pre script:"+str(args))
 
-            process = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)
-            wait_counter = 5
-            while process.poll() == None and wait_counter>0:
-                wait_counter -= 1
-                sleep(2)
-            while True:
-                line= process.stdout.readline()
-                line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
-                if(line != ''):
-                    self.logger.log("WorkloadPatch: pre completed with output "+line.rstrip(), True)
-                else:
-                    break
+            session = QuiesceSession(self.logger, self.name, args, ready_markers = ['BEGIN BACKUP succeeded']).start()
+            for line in session.get_lines(self.WaitForScriptOutputInSeconds):
+                self.logger.log("WorkloadPatch: pre completed with output "+line.rstrip(), True)
                 if('BEGIN BACKUP succeeded' in line):
                     preSuccess = True
+                    self.recordQuiesceLatency(session)
                     break
                 if('LOG_MODE=' in line):
                     line = line.replace('\n','')
@@ -192,18 +188,10 @@ class WorkloadPatch:
             args =  "su - "+self.linux_user+" -c "+"\'"+prePostgres+"\'"
             self.logger.log("WorkloadPatch: argument passed for pre script:"+str(self.linux_user)+"  "+str(self.command))
 
-            process = subprocess.Popen(args,stdout=subprocess.PIPE, shell=True)
-            wait_counter = 5
-            while process.poll() == None and wait_counter>0:
-                wait_counter -= 1
-                sleep(2)
-            while True:
-                line= process.stdout.readline()
-                line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
-                if(line != ''):
-                    self.logger.log("WorkloadPatch: pre completed with output "+line.rstrip(), True)
-                else:
-                    break
+            session = QuiesceSession(self.logger, self.name, args).start()
+            for line in session.get_lines(self.WaitForScriptOutputInSeconds):
+                self.logger.log("WorkloadPatch: pre completed with output "+line.rstrip(), True)
+            self.recordQuiesceLatency(session)
             self.timeoutDaemon()
             self.logger.log("WorkloadPatch: Pre- Exiting pre mode for master postgres")
         #Add new workload support here
@@ -249,18 +237,9 @@ class WorkloadPatch:
             postOracle = self.command + "sqlplus" + " -S -R 2 /nolog @" + os.path.join(self.temp_script_folder, self.scriptpath + "/postOracleMaster.sql ")
             args =  "su - "+self.linux_user+" -c "+"\'"+postOracle+"\'"
             self.logger.log("WorkloadPatch: argument passed for post script:"+str(args))
-            process = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)
-            wait_counter = 5
-            while process.poll()==None and wait_counter>0:
-                wait_counter -= 1
-                sleep(2)
-            while True:
-                line= process.stdout.readline()
-                line = Utils.HandlerUtil.HandlerUtility.convert_to_string(line)
-                if(line != ''):
-                    self.logger.log("WorkloadPatch: post completed with output "+line.rstrip(), True)
-                else:
-                    break
+            session = QuiesceSession(self.logger, self.name, args).start()
+            for line in session.get_lines(self.WaitForScriptOutputInSeconds):
+                self.logger.log("WorkloadPatch: post completed with output "+line.rstrip(), True)
                 if 'END BACKUP succeeded' in line:
                     self.logger.log("WorkloadPatch: post succeeded")
                     postSuccess = True
@@ -304,11 +283,8 @@ class WorkloadPatch:
             postPostgres = self.command + "psql " + self.cred_string + " -f " + os.path.join(os.getcwd(), "main/workloadPatch/"+self.scriptpath+"/postPostgresMaster.sql")
             args =  "su - "+self.linux_user+" -c "+"\'"+postPostgres+"\'"
             self.logger.log("WorkloadPatch: argument passed for post script:"+str(self.linux_user)+"  "+str(self.command))
-            process = subprocess.Popen(args,stdout=subprocess.PIPE, shell=True)
-            wait_counter = 5
-            while process.poll()==None and wait_counter>0:
-                wait_counter -= 1
-                sleep(2)
+            session = QuiesceSession(self.logger, self.name, args).start()
+            session.wait_for_output_end(10)
             self.logger.log("WorkloadPatch: Post- Completed")
         #Add new workload support here
         else:
@@ -330,9 +306,8 @@ class WorkloadPatch:
                 self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadIPCDirectoryMissing, "IPC directory missing"))
                 return None
             prescript = os.path.join(self.temp_script_folder, self.scriptpath + "/preMysqlSlave.sql")
-            arg = self.sudo_user+" "+self.command+self.name+" "+self.cred_string+" -e\"set @timeout="+self.timeout+";set @outfile=\\\"\\\\\\\""+self.outfile+"\\\\\\\"\\\";source "+prescript+";\""
-            binary_thread = threading.Thread(target=self.thread_for_sql, args=[arg])
-            binary_thread.start()
+            arg = self.sudo_user+" "+self.command+self.name+" --unbuffered "+self.cred_string+" -e\"set @timeout="+self.timeout+";set @outfile=\\\"\\\\\\\""+self.outfile+"\\\\\\\"\\\";source "+prescript+";\""
+            self.startSqlSession(arg)
             self.waitForPreScriptCompletion()
         #Add new workload support here
         else:
@@ -493,31 +468,41 @@ class WorkloadPatch:
         else:
             return None
 
+    def startSqlSession(self, args):
+        self.quiesce_session = QuiesceSession(self.logger, self.name, args, [WorkloadPatch.MysqlQuiescedMarker], self.outfile, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            self.quiesce_session.start()
+            self.child.append(self.quiesce_session.process)
+        except Exception as e:
+            self.logger.log("WorkloadPatch: sql connection failed with error: " + str(e))
+
     def waitForPreScriptCompletion(self):
         if self.ipc_folder != None:
-            wait_counter = 5 
-            while len(self.child) == 0 and wait_counter > 0:
-                self.logger.log("WorkloadPatch: child not created yet", True)
-                wait_counter -= 1
-                sleep(2)
-            if wait_counter > 0:
-                self.logger.log("WorkloadPatch: sql subprocess Created "+str(self.child[0].pid))
-            else:
+            if len(self.child) == 0:
                 self.logger.log("WorkloadPatch: sql connection failed")
                 self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadConnectionError, "sql connection failed"))
                 return None
-            wait_counter = 60
-            while os.path.exists(self.outfile) == False and wait_counter > 0:
-                self.logger.log("WorkloadPatch: Waiting for sql to complete")
-                wait_counter -= 1
-                sleep(2)
-            if wait_counter > 0:
+            self.logger.log("WorkloadPatch: sql subprocess Created "+str(self.child[0].pid))
+            # the pre script prints the marker once the tables are locked, the outfile is still watched for custom scripts
+            if self.quiesce_session.wait_until_ready(WorkloadPatch.WaitForQuiesceInSeconds):
                 self.logger.log("WorkloadPatch: pre at server level completed")
+                self.recordQuiesceLatency(self.quiesce_session)
             else:
                 self.logger.log("WorkloadPatch: pre failed to quiesce")
+                while not self.quiesce_session.lines.empty():
+                    line = self.quiesce_session.lines.get()
+                    if line is not None:
+                        self.logger.log("WorkloadPatch: pre output "+line.rstrip(), True)
                 self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadQuiescingError, "pre failed to quiesce"))
                 return None
-        
+
+    def recordQuiesceLatency(self, session):
+        latency_in_ms = session.get_ready_latency_in_ms()
+        if latency_in_ms is None:
+            return
+        self.logger.log("WorkloadPatch: " + self.name + " quiesced in " + str(latency_in_ms) + " ms, signaled by " + str(session.ready_source))
+        Utils.HandlerUtil.HandlerUtility.add_to_telemetery_data("workloadQuiesceLatencyInMs", self.name + ":" + str(latency_in_ms) + ":" + str(session.ready_source))
+
     def timeoutDaemon(self):
         global daemonProcess
         argsDaemon = "su - "+self.linux_user+" -c " + "'" + os.path.join(self.temp_script_folder, self.scriptpath + "/timeoutDaemon.sh")+" "+self.name+" "+self.command+" \""+self.cred_string+"\" "+self.timeout+" "+os.path.join(self.temp_script_folder, self.scriptpath + "'")
@@ -542,11 +527,6 @@ class WorkloadPatch:
             self.error_details.append(ErrorDetail(CommonVariables.FailedWorkloadConnectionError, "sql connection failed"))
         return None
 
-    def thread_for_sql(self,args):
-        self.logger.log("WorkloadPatch: command to execute: "+str(args))
-        self.child.append(subprocess.Popen(args,stdout=subprocess.PIPE,stdin=subprocess.PIPE,shell=True,stderr=subprocess.PIPE))
-        sleep(1)
-    
     def getRole(self):
         return "master"
     
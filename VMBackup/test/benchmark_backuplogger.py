@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Cost of Backuplogger.log() while the file systems are frozen, for the string
+# concatenating logger used before and the current ring buffer based one, and
+# of committing the freeze logs afterwards. The console is a temp file unless
+# --console is given. The legacy logger is quadratic in the number of lines, it
+# only logs --legacy-lines (100k lines take it tens of minutes).
+#
+# To run (from the VMBackup folder):
+# python test/benchmark_backuplogger.py --lines 100000 --threads 4
+
+import datetime
+import optparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+
+from backuplogger import Backuplogger
+
+class StubHandlerUtil(object):
+    def __init__(self, config):
+        self.config = config
+        self.patching = None
+        self.logged_bytes = 0
+        self.config_reads = 0
+
+    def log(self, message, level = 'Info'):
+        self.logged_bytes += len(message)
+
+    def get_intvalue_from_configfile(self, key, default):
+        self.config_reads += 1
+        return int(self.config.get(key, default))
+
+    def get_strvalue_from_configfile(self, key, default):
+        self.config_reads += 1
+        return str(self.config.get(key, default))
+
+class LegacyBackuplogger(Backuplogger):
+    """log and commit_to_local as Backuplogger did them before the ring buffer"""
+    def __init__(self, hutil):
+        Backuplogger.__init__(self, hutil)
+        self.msg = ''
+
+    def enforce_local_flag(self, enforced_local):
+        if (self.enforced_local_flag_value != False and enforced_local == False):
+            self.msg = self.msg + "================== Logs during Freeze Start ==============" + "\n"
+        elif (self.enforced_local_flag_value == False and enforced_local == True):
+            self.msg = self.msg + "================== Logs during Freeze End ==============" + "\n"
+            self.commit_to_local()
+        self.enforced_local_flag_value = enforced_local
+
+    def log(self, msg, local=False, level='Info'):
+        WriteLog = self.hutil.get_strvalue_from_configfile('WriteLog','True')
+        if (WriteLog == None or WriteLog == 'True'):
+            log_msg = ""
+            if sys.version_info > (3,):
+                log_msg = self.log_to_con_py3(msg, level)
+            else:
+                log_msg = "{0}  {1}  {2} \n".format(str(datetime.datetime.now()) , level , msg)
+            if(self.enforced_local_flag_value == False):
+                self.msg += log_msg
+            else:
+                self.hutil.log(str(msg),level)
+
+    def log_to_con_py3(self, msg, level='Info'):
+        time = datetime.datetime.now().strftime(u'%Y/%m/%d %H:%M:%S.%f')
+        log_msg = u"{0}  {1}  {2} \n".format(time , level , msg)
+        return str(log_msg.encode('ascii', "backslashreplace"), encoding="ascii")
+
+    def commit_to_local(self):
+        self.hutil.log(self.msg)
+        self.msg = ''
+
+def run_once(logger_class, lines, options, console_path):
+    hutil = StubHandlerUtil({'LogRingBufferSize' : options.ring_size})
+    logger = logger_class(hutil)
+    logger.con_path = console_path
+    if logger.console_sink is not None:
+        logger.console_sink.con_path = console_path
+    logger.enforce_local_flag(False)
+    lines_per_thread = lines // options.threads
+    def log_lines(thread_index):
+        for i in range(lines_per_thread):
+            logger.log('snapshot thread {0} blob disk{1}.vhd page range {2} uploaded'.format(thread_index, i % 16, i), True)
+    threads = [threading.Thread(target=log_lines, args=(thread_index,)) for thread_index in range(options.threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    logged = time.time()
+    logger.enforce_local_flag(True)
+    committed = time.time()
+    return logged - start, committed - logged, hutil.logged_bytes, hutil.config_reads
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--lines', type = 'int', default = 100000)
+    parser.add_option('--legacy-lines', type = 'int', default = 20000)
+    parser.add_option('--threads', type = 'int', default = 1)
+    parser.add_option('--ring-size', type = 'int', default = Backuplogger.LogRingBufferSizeDefault)
+    parser.add_option('--console', default = None, help = 'console path, a temp file by default')
+    options, args = parser.parse_args()
+
+    console_path = options.console
+    if console_path is None:
+        console_file, console_path = tempfile.mkstemp()
+        os.close(console_file)
+
+    print('threads={0} ring-size={1}'.format(options.threads, options.ring_size))
+    print('{0:<8} {1:>8} {2:>12} {3:>12} {4:>14} {5:>14} {6:>14}'.format('logger', 'lines', 'log(ms)', 'us/line', 'commit(ms)', 'bytes logged', 'config reads'))
+    for name, logger_class, lines in [('legacy', LegacyBackuplogger, options.legacy_lines), ('current', Backuplogger, options.lines)]:
+        log_time, commit_time, logged_bytes, config_reads = run_once(logger_class, lines, options, console_path)
+        print('{0:<8} {1:>8} {2:>12.1f} {3:>12.2f} {4:>14.1f} {5:>14} {6:>14}'.format(name, lines, log_time * 1000, log_time * 1000000 / lines, commit_time * 1000, logged_bytes, config_reads))
+
+    if options.console is None:
+        os.remove(console_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Freeze-to-thaw overhead of FreezeHandler with a fake freezer binary
+# (test/fake_safefreeze.py), for the 2 second polling handler FsFreezer used
+# before and for the current control pipe based one.
+# overhead = time the file systems stay frozen - simulated snapshot work
+#
+# To run (from the VMBackup folder):
+# python test/benchmark_freeze_overhead.py --iterations 5 --snapshot-ms 200
+
+import optparse
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+
+from fsfreezer import FreezeHandler
+
+FAKE_FREEZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_safefreeze.py')
+
+class StubLogger(object):
+    def log(self, msg, local = False, level = 'Info'):
+        pass
+
+class StubHandlerUtil(object):
+    def get_intvalue_from_configfile(self, key, default):
+        return default
+
+class LegacyFreezeHandler(FreezeHandler):
+    """startproc and thaw as FreezeHandler did them before the control pipe"""
+    def startproc(self, args):
+        def thread_for_binary():
+            time.sleep(3)
+            self.child = subprocess.Popen(args, stdout=subprocess.PIPE)
+        binary_thread = threading.Thread(target=thread_for_binary)
+        binary_thread.start()
+        for i in range(0, 33):
+            if(self.sig_handle == 0):
+                time.sleep(2)
+            else:
+                break
+        return self.sig_handle
+
+    def thaw(self, timeout):
+        self.child.send_signal(signal.SIGUSR1)
+        for i in range(0, timeout):
+            if(self.child.poll() is None):
+                time.sleep(1)
+            else:
+                break
+        return self.child.returncode
+
+def run_once(handler_class, options):
+    handler = handler_class(StubLogger(), StubHandlerUtil())
+    handler.reset_signals()
+    handler.signal_receiver()
+    args = [sys.executable, FAKE_FREEZER, '--freeze-ms', str(options.freeze_ms), '--thaw-ms', str(options.thaw_ms), '60'] + ['/mnt/disk{0}'.format(i) for i in range(options.mounts)]
+    start = time.time()
+    sig_handle = handler.startproc(args)
+    freeze_noticed_at = time.time()
+    if(sig_handle != 1):
+        raise Exception('fake freeze failed, sig_handle=' + str(sig_handle))
+    # the snapshot work done while frozen, python 2 cuts sleeps short when a signal arrives
+    snapshot_done_at = freeze_noticed_at + options.snapshot_ms / 1000.0
+    while time.time() < snapshot_done_at:
+        time.sleep(snapshot_done_at - time.time())
+    return_code = handler.thaw(30)
+    thaw_done_at = time.time()
+    output = handler.child.stdout.read().decode('utf-8')
+    match = re.search(r'frozen_at=([\d.]+) thaw_received_at=([\d.]+) thawed_at=([\d.]+)', output)
+    frozen_at, thaw_received_at, thawed_at = [float(value) for value in match.groups()]
+    return {
+        'startproc' : freeze_noticed_at - start,
+        'freezeNotice' : freeze_noticed_at - frozen_at,
+        'thawNotice' : thaw_done_at - thawed_at,
+        'overhead' : (thawed_at - frozen_at) - options.snapshot_ms / 1000.0,
+        'returnCode' : return_code,
+    }
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--iterations', type = 'int', default = 5)
+    parser.add_option('--mounts', type = 'int', default = 4)
+    parser.add_option('--freeze-ms', type = 'float', default = 5, help = 'simulated FIFREEZE time per mount')
+    parser.add_option('--thaw-ms', type = 'float', default = 2, help = 'simulated FITHAW time per mount')
+    parser.add_option('--snapshot-ms', type = 'float', default = 200, help = 'simulated snapshot work while frozen')
+    options, args = parser.parse_args()
+
+    print('{0:<8} {1:>14} {2:>18} {3:>16} {4:>16}'.format('handler', 'startproc(ms)', 'freeze notice(ms)', 'thaw notice(ms)', 'overhead(ms)'))
+    for name, handler_class in [('legacy', LegacyFreezeHandler), ('current', FreezeHandler)]:
+        results = [run_once(handler_class, options) for i in range(options.iterations)]
+        average = lambda key: sum([result[key] for result in results]) * 1000 / len(results)
+        print('{0:<8} {1:>14.1f} {2:>18.1f} {3:>16.1f} {4:>16.1f}'.format(name, average('startproc'), average('freezeNotice'), average('thawNotice'), average('overhead')))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Peak RSS of a 64MB page-blob write, with the copy based page slicing that
+# BlobWriter used before and with the current memoryview based one.
+# Nothing is sent over the network, pages are handed to a stub put_page_update.
+#
+# To run (from the VMBackup folder):
+# python test/benchmark_pagewrite_memory.py
+
+import os
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+
+MESSAGE_SIZE_BYTES = 64 * 1024 * 1024 + 100 # not page aligned, so padding is exercised
+PAGE_SIZE_BYTES = 512
+PAGE_UPLOAD_LIMIT_BYTES = 4194304
+
+class StubHandlerUtil(object):
+    def log(self, message, level='Info'):
+        pass
+
+    def get_intvalue_from_configfile(self, key, default):
+        return default
+
+def peak_rss_in_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def build_message():
+    # log and status payloads as bytes, joined in one allocation so building them does not inflate the peak
+    line = b'x' * 99 + b'\n'
+    return b''.join([line] * (MESSAGE_SIZE_BYTES // len(line)) + [b'y' * (MESSAGE_SIZE_BYTES % len(line))])
+
+def write_legacy(msg):
+    # page slicing as done by BlobWriter.WritePageBlob before the memoryview rework
+    sent = 0
+    msgLen = len(msg)
+    if((msgLen % PAGE_SIZE_BYTES) != 0):
+        msg = msg.ljust(msgLen + (PAGE_SIZE_BYTES - (msgLen % PAGE_SIZE_BYTES)))
+        msgLen = len(msg)
+    bytes_sent = 0
+    while (bytes_sent < msgLen):
+        pageContent = msg[bytes_sent:min(bytes_sent + PAGE_UPLOAD_LIMIT_BYTES, msgLen)]
+        sent = sent + len(pageContent)
+        bytes_sent = bytes_sent + len(pageContent)
+    return sent
+
+def write_current(msg):
+    from common import CommonVariables
+    from blobwriter import BlobWriter, BlobProperties
+    blob_writer = BlobWriter(StubHandlerUtil())
+    counter = {'sent' : 0}
+    def put_page_update(pageContent, blobUri, pageBlobIndex):
+        counter['sent'] = counter['sent'] + len(pageContent)
+        return CommonVariables.success
+    blob_writer.GetBlobProperties = lambda blobUri: BlobProperties('PageBlob', str(2 * MESSAGE_SIZE_BYTES))
+    blob_writer.put_page_update = put_page_update
+    blob_writer.WritePageBlob(msg, 'https://localhost/container/blob?sig=stub')
+    return counter['sent']
+
+def run_mode(mode):
+    # both modes pay for the same imports before the baseline is taken
+    import blobwriter
+    msg = build_message()
+    baseline = peak_rss_in_kb()
+    if mode == 'legacy':
+        sent = write_legacy(msg)
+    else:
+        sent = write_current(msg)
+    print('{0} {1} {2} {3}'.format(mode, baseline, peak_rss_in_kb(), sent))
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--mode':
+        run_mode(sys.argv[2])
+        return
+    print('mode       baseline(MB)  peak(MB)  delta(MB)  bytes sent')
+    for mode in ['legacy', 'current']:
+        # every mode runs in its own process as ru_maxrss never goes down
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--mode', mode])
+        name, baseline, peak, sent = output.decode('utf-8').split()
+        print('{0:<10} {1:>12.1f} {2:>9.1f} {3:>10.1f}  {4}'.format(name, int(baseline) / 1024.0, int(peak) / 1024.0, (int(peak) - int(baseline)) / 1024.0, sent))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Throughput of the VMBackup snapshot and blob upload paths against the local
+# blob store emulator (test/blobstore_emulator.py), for N simulated disks.
+# All http(s) connections HttpUtil opens, including the ones to the host
+# endpoint, are redirected to the emulator, so no network access is needed.
+# The file systems are not frozen: the freeze duration reported is the time
+# from the start of the snapshot phase to the (stubbed) thaw, which is the
+# part of the freeze window the snapshot code is responsible for.
+# The guest snapshot concurrency learned in an iteration carries over to the
+# next one through a temp log folder, as it does across backups on a VM.
+#
+# To run (from the VMBackup folder):
+# python test/benchmark_snapshot_throughput.py --disks 16 --latency-ms 20 --error-rate 0.01
+# python test/benchmark_snapshot_throughput.py --disks 32 --snapshot-throttle-limit 6
+
+import json
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from blobstore_emulator import BlobStoreEmulator
+
+class StubLogger(object):
+    def log(self, msg, local = False, level = 'Info'):
+        pass
+
+class StubContext(object):
+    def __init__(self, log_dir):
+        self._log_dir = log_dir
+
+class StubHandlerUtil(object):
+    def __init__(self, config, log_dir = None):
+        self.config = config
+        self._context = StubContext(log_dir)
+
+    def log(self, message, level = 'Info'):
+        pass
+
+    def get_intvalue_from_configfile(self, key, default):
+        return int(self.config.get(key, default))
+
+    def get_strvalue_from_configfile(self, key, default):
+        return str(self.config.get(key, default))
+
+class StubFreezer(object):
+    """records when the snapshot code thaws, nothing is frozen"""
+    def __init__(self):
+        self.thaw_time = None
+
+    def thaw_safe(self):
+        self.thaw_time = time.time()
+        return None, False
+
+class StubParameters(object):
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.backup_metadata = [{'Key' : 'backupTaskId', 'Value' : 'emulator'}]
+        self.snapshotTaskToken = 'emulator'
+
+def redirect_http_to_emulator(port):
+    import HttpUtil
+    real_httplib = HttpUtil.httplibs
+    class EmulatorConnection(real_httplib.HTTPConnection):
+        def __init__(self, host, *args, **kwargs):
+            real_httplib.HTTPConnection.__init__(self, '127.0.0.1', port, timeout = kwargs.get('timeout', 10))
+    class EmulatorHttpLib(object):
+        HTTPConnection = EmulatorConnection
+        HTTPSConnection = EmulatorConnection
+        def __getattr__(self, name):
+            return getattr(real_httplib, name)
+    HttpUtil.httplibs = EmulatorHttpLib()
+
+def run_guest_snapshots(emulator, blobs, hutil, logger):
+    from guestsnapshotter import GuestSnapshotter
+    freezer = StubFreezer()
+    guest_snapshotter = GuestSnapshotter(logger, hutil)
+    start = time.time()
+    snapshot_result, blob_snapshot_info_array, all_failed, is_inconsistent, unable_to_sleep, all_snapshots_failed = guest_snapshotter.snapshotall(StubParameters(blobs), freezer, True)
+    end = time.time()
+    succeeded = len([info for info in blob_snapshot_info_array if info.isSuccessful])
+    return succeeded, end - start, (freezer.thaw_time or end) - start, guest_snapshotter.concurrency_controller.get_summary()
+
+def run_host_snapshots(emulator, blobs, logger):
+    from hostsnapshotter import HostSnapshotter
+    freezer = StubFreezer()
+    host_snapshotter = HostSnapshotter(logger, '127.0.0.1')
+    pre_start = time.time()
+    host_snapshotter.pre_snapshot(StubParameters(blobs), 'emulator')
+    start = time.time()
+    blob_snapshot_info_array, all_failed, is_inconsistent, unable_to_sleep = host_snapshotter.snapshotall(StubParameters(blobs), freezer, True, 'emulator')
+    end = time.time()
+    succeeded = len([info for info in blob_snapshot_info_array if info.isSuccessful == 'true'])
+    return succeeded, start - pre_start, end - start, (freezer.thaw_time or end) - start
+
+def run_uploads(blobs, payload_bytes, hutil):
+    from blobwriter import BlobWriter
+    message = b'x' * payload_bytes
+    start = time.time()
+    for blob in blobs:
+        BlobWriter(hutil).WriteBlob(message, blob)
+    return len(blobs) * payload_bytes, time.time() - start
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--disks', type = 'int', default = 8)
+    parser.add_option('--iterations', type = 'int', default = 3)
+    parser.add_option('--latency-ms', type = 'float', default = 10)
+    parser.add_option('--latency-jitter-ms', type = 'float', default = 5)
+    parser.add_option('--error-rate', type = 'float', default = 0.0)
+    parser.add_option('--upload-mb', type = 'int', default = 4, help = 'payload written to every disk blob per iteration')
+    parser.add_option('--snapshot-concurrency', type = 'int', default = 16)
+    parser.add_option('--snapshot-initial-concurrency', type = 'int', default = 8)
+    parser.add_option('--snapshot-throttle-limit', type = 'int', default = 0, help = 'blob snapshots in flight before the emulator throttles, 0 for no limit')
+    parser.add_option('--page-upload-concurrency', type = 'int', default = 4)
+    parser.add_option('--seed', type = 'int', default = 1)
+    options, args = parser.parse_args()
+
+    emulator = BlobStoreEmulator(latency_ms = options.latency_ms, latency_jitter_ms = options.latency_jitter_ms, error_rate = options.error_rate, seed = options.seed, snapshot_throttle_limit = options.snapshot_throttle_limit).start()
+    redirect_http_to_emulator(emulator.port)
+    from HttpUtil import HttpUtil
+    logger = StubLogger()
+    log_dir = tempfile.mkdtemp()
+    hutil = StubHandlerUtil({'SnapshotConcurrency' : options.snapshot_concurrency, 'SnapshotInitialConcurrency' : options.snapshot_initial_concurrency, 'PageUploadConcurrency' : options.page_upload_concurrency}, log_dir)
+    payload_bytes = options.upload_mb * 1024 * 1024
+    blobs = [emulator.add_page_blob('disk{0}.vhd'.format(disk_index), 2 * payload_bytes) for disk_index in range(options.disks)]
+
+    print('disks={0} latency={1}+-{2}ms error-rate={3} throttle-limit={4} upload={5}MB/disk'.format(options.disks, options.latency_ms, options.latency_jitter_ms, options.error_rate, options.snapshot_throttle_limit, options.upload_mb))
+    print('{0:<10} {1:>10} {2:>12} {3:>12} {4:>14} {5:>12}  {6}'.format('iteration', 'path', 'succeeded', 'freeze(ms)', 'snapshots/s', 'MB/s', 'in flight'))
+    totals = {'guest' : [0, 0.0, 0.0], 'host' : [0, 0.0, 0.0], 'upload' : [0, 0.0]}
+    for iteration in range(options.iterations):
+        succeeded, elapsed, freeze, concurrency = run_guest_snapshots(emulator, blobs, hutil, logger)
+        totals['guest'][0] += succeeded
+        totals['guest'][1] += elapsed
+        totals['guest'][2] += freeze
+        print('{0:<10} {1:>10} {2:>12} {3:>12.1f} {4:>14.1f} {5:>12}  {6}->{7} throttled={8}'.format(iteration, 'guest', succeeded, freeze * 1000, succeeded / elapsed, '-', concurrency['initial'], concurrency['final'], concurrency['throttled']))
+
+        succeeded, pre_elapsed, elapsed, freeze = run_host_snapshots(emulator, blobs, logger)
+        totals['host'][0] += succeeded
+        totals['host'][1] += elapsed
+        totals['host'][2] += freeze
+        print('{0:<10} {1:>10} {2:>12} {3:>12.1f} {4:>14.1f} {5:>12}'.format(iteration, 'host', succeeded, freeze * 1000, succeeded / elapsed, '-'))
+
+        sent, elapsed = run_uploads(blobs, payload_bytes, hutil)
+        totals['upload'][0] += sent
+        totals['upload'][1] += elapsed
+        print('{0:<10} {1:>10} {2:>12} {3:>12} {4:>14} {5:>12.1f}'.format(iteration, 'upload', '-', '-', '-', sent / elapsed / (1024 * 1024)))
+
+    summary = {
+        'guestSnapshotsPerSecond' : round(totals['guest'][0] / totals['guest'][1], 1),
+        'guestFreezeInMs' : round(totals['guest'][2] * 1000 / options.iterations, 1),
+        'hostSnapshotsPerSecond' : round(totals['host'][0] / totals['host'][1], 1),
+        'hostFreezeInMs' : round(totals['host'][2] * 1000 / options.iterations, 1),
+        'uploadBytesPerSecond' : int(totals['upload'][0] / totals['upload'][1]),
+        'httpConnectionPool' : HttpUtil(logger).get_connection_pool_stats(),
+        'emulator' : emulator.stats.convertToDictionary(),
+    }
+    print(json.dumps(summary, indent = 1, sort_keys = True))
+    emulator.stop()
+    shutil.rmtree(log_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Time to import main/handle.py, paid by every install, enable, status and
+# daemon command before it does any work. Each iteration imports it in a new
+# interpreter, right after Utils.HandlerUtil, which every command needs
+# anyway and which brings in WaagentLib. The budget is the median ratio of
+# the whole import to that baseline, so it holds on slow and fast machines
+# alike, the absolute times are only reported. The modules only the daemon
+# needs must not be imported at startup, test_startup_imports.py checks that
+# too. On python 3.7+ the modules taking the most time (-X importtime,
+# cumulative) are listed.
+# Exits with 1 when the ratio is over --budget-ratio or a deferred module is
+# imported.
+#
+# To run (from the VMBackup folder):
+# python test/benchmark_startup_imports.py --iterations 10 --budget-ratio 2
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+
+VMBACKUP_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# the snapshot, plugin host and workload stacks, and the libraries they bring
+DEFERRED_MODULES = ['freezesnapshotter', 'guestsnapshotter', 'hostsnapshotter', 'HttpUtil', 'blobwriter',
+    'PluginHost', 'workloadPatch.WorkloadPatch', 'Utils.SizeCalculation', 'multiprocessing', 'distutils',
+    'httplib', 'http.client']
+
+CHILD_SCRIPT = """
+import sys, time
+sys.path.insert(0, 'main')
+start = time.time()
+import Utils.HandlerUtil
+baseline = (time.time() - start) * 1000
+import handle
+elapsed = (time.time() - start) * 1000
+import json
+print(json.dumps({'baseline' : baseline, 'elapsed' : elapsed, 'deferred' : [name for name in %r if name in sys.modules]}))
+""" % (DEFERRED_MODULES,)
+
+def import_handle(importtime):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = 'main'
+    args = [sys.executable]
+    if importtime:
+        args += ['-X', 'importtime']
+    args += ['-c', CHILD_SCRIPT]
+    process = subprocess.Popen(args, cwd=VMBACKUP_FOLDER, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise Exception('import handle failed: ' + err.decode('utf-8', 'replace'))
+    result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    return result, err.decode('utf-8', 'replace')
+
+def parse_importtime(output):
+    """ (cumulative us, depth, module) for each '-X importtime' line """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((int(fields[1]), depth, name.strip()))
+    return modules
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--iterations', type='int', default=10)
+    parser.add_option('--budget-ratio', type='float', default=2.0, help='import handle time over import Utils.HandlerUtil time')
+    parser.add_option('--top', type='int', default=15)
+    options, args = parser.parse_args()
+
+    # the first import may compile the sources, it is not counted
+    import_handle(False)
+    timings = []
+    baselines = []
+    ratios = []
+    deferred = set()
+    for i in range(options.iterations):
+        result, err = import_handle(False)
+        timings.append(result['elapsed'])
+        baselines.append(result['baseline'])
+        ratios.append(result['elapsed'] / max(result['baseline'], 0.001))
+        deferred.update(result['deferred'])
+    timings.sort()
+    baselines.sort()
+    ratios.sort()
+    median = timings[len(timings) // 2]
+    median_ratio = ratios[len(ratios) // 2]
+
+    if sys.version_info >= (3, 7):
+        result, err = import_handle(True)
+        modules = parse_importtime(err)
+        print('%-50s %14s' % ('module (-X importtime)', 'cumulative(ms)'))
+        for cumulative, depth, name in sorted(modules, reverse=True)[:options.top]:
+            print('%-50s %14.1f' % ('  ' * (depth - 1) + name, cumulative / 1000.0))
+        print('')
+
+    print('import handle: min %.1f ms, median %.1f ms, max %.1f ms' % (timings[0], median, timings[-1]))
+    print('import Utils.HandlerUtil: median %.1f ms' % baselines[len(baselines) // 2])
+    print('ratio: median %.2f, budget %.2f' % (median_ratio, options.budget_ratio))
+    failed = False
+    if median_ratio > options.budget_ratio:
+        print('FAIL: median import time ratio is over the budget')
+        failed = True
+    if len(deferred) > 0:
+        print('FAIL: imported at startup: ' + ', '.join(sorted(deferred)))
+        failed = True
+    if failed:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
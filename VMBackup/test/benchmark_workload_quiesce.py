@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Quiesce-to-ready latency of the WorkloadPatch pre script wait, with a shell
+# command standing in for the sql client: it takes --lock-ms to lock the
+# tables, writes the IPC outfile, prints the quiesced marker and keeps the
+# session open. Measured for the thread plus 2 second outfile polling
+# WorkloadPatch used before and for QuiesceSession, signaled on stdout or,
+# for scripts without the marker, on the outfile through inotify.
+# latency = time the pre script wait returned - time the client was started
+#
+# To run (from the VMBackup folder):
+# python test/benchmark_workload_quiesce.py --iterations 5 --lock-ms 300
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+
+from workloadPatch.QuiesceSession import QuiesceSession
+
+MARKER = "azbackupQuiesced"
+
+class StubLogger(object):
+    def log(self, msg, local = False, level = 'Info'):
+        pass
+
+def client_command(outfile, lock_ms, print_marker):
+    script = "sleep %s; echo serverlevel > %s;" % (lock_ms / 1000.0, outfile)
+    if print_marker:
+        script += " echo %s;" % MARKER
+    return "sh -c '" + script + " sleep 30'"
+
+def legacy_wait(args, outfile):
+    """thread_for_sql and waitForPreScriptCompletion as WorkloadPatch had them before QuiesceSession"""
+    child = []
+    def thread_for_sql():
+        child.append(subprocess.Popen(args, stdout=subprocess.PIPE, stdin=subprocess.PIPE, shell=True, stderr=subprocess.PIPE))
+        time.sleep(1)
+    sql_thread = threading.Thread(target=thread_for_sql)
+    sql_thread.start()
+    sql_thread.join()
+    wait_counter = 5
+    while len(child) == 0 and wait_counter > 0:
+        wait_counter -= 1
+        time.sleep(2)
+    wait_counter = 60
+    while os.path.exists(outfile) == False and wait_counter > 0:
+        wait_counter -= 1
+        time.sleep(2)
+    return child[0]
+
+def session_wait(args, outfile):
+    session = QuiesceSession(StubLogger(), "mysql", args, [MARKER], outfile, stdin=subprocess.PIPE, stderr=subprocess.STDOUT).start()
+    session.wait_until_ready(120)
+    return session.process
+
+def run(path, wait, print_marker, lock_ms, folder):
+    outfile = os.path.join(folder, "azbackupIPC.txt")
+    if os.path.exists(outfile):
+        os.remove(outfile)
+    args = client_command(outfile, lock_ms, print_marker)
+    start = time.time()
+    process = wait(args, outfile)
+    latency = (time.time() - start) * 1000
+    process.kill()
+    process.wait()
+    return latency
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--iterations', type='int', default=5)
+    parser.add_option('--lock-ms', type='int', default=300)
+    options, args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    paths = [('legacy', legacy_wait, True), ('stdout', session_wait, True), ('outfile', session_wait, False)]
+    try:
+        print('lock=%dms' % options.lock_ms)
+        print('%-10s %12s %12s %12s' % ('path', 'min(ms)', 'avg(ms)', 'max(ms)'))
+        for name, wait, print_marker in paths:
+            latencies = [run(name, wait, print_marker, options.lock_ms, folder) for i in range(options.iterations)]
+            print('%-10s %12.1f %12.1f %12.1f' % (name, min(latencies), sum(latencies) / len(latencies), max(latencies)))
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local stand-in for the storage and host endpoints VMBackup talks to, so that
+# BlobWriter, GuestSnapshotter and HostSnapshotter can be measured offline.
+# It serves plain http with keep-alive:
+#   HEAD  <blob>                              blob properties
+#   PUT   <blob>  x-ms-blob-type              create a page or block blob
+#   PUT   <blob>?comp=properties              resize a page blob
+#   PUT   <blob>?comp=page                    page update/clear, honors If-Match
+#   PUT   <blob>?comp=snapshot                blob snapshot
+#   POST  /metadata/recsvc/snapshot/presnapshot and .../dosnapshot  host snapshot
+# Every request can be delayed (--latency-ms, --latency-jitter-ms) and failed
+# with a 503 ServerBusy (--error-rate). Blob snapshot requests beyond
+# --snapshot-throttle-limit in flight are throttled with a 503 ServerBusy.
+#
+# To run standalone (from the VMBackup folder):
+# python test/blobstore_emulator.py --port 8080 --latency-ms 20 --error-rate 0.01
+
+import datetime
+import json
+import optparse
+import random
+import threading
+import time
+try:
+    import urlparse as urlparser
+except ImportError:
+    import urllib.parse as urlparser
+try:
+    import BaseHTTPServer as httpservers
+    import SocketServer as socketservers
+except ImportError:
+    import http.server as httpservers
+    import socketserver as socketservers
+
+PAGE_SIZE_BYTES = 512
+
+class EmulatedBlob(object):
+    def __init__(self, blob_type, content_length = 0):
+        self.blob_type = blob_type
+        self.content = bytearray(content_length)
+        self.version = 0
+        self.snapshots = []
+
+    def get_etag(self):
+        return '"0x{0:X}"'.format(self.version)
+
+    def resize(self, content_length):
+        if content_length > len(self.content):
+            self.content.extend(bytearray(content_length - len(self.content)))
+        else:
+            del self.content[content_length:]
+        self.version = self.version + 1
+
+class EmulatorStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.injected_errors = 0
+        self.throttled = 0
+        self.bytes_received = 0
+
+    def add_request(self, operation, bytes_received):
+        with self.lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            self.bytes_received = self.bytes_received + bytes_received
+
+    def add_injected_error(self):
+        with self.lock:
+            self.injected_errors = self.injected_errors + 1
+
+    def add_throttled(self):
+        with self.lock:
+            self.throttled = self.throttled + 1
+
+    def convertToDictionary(self):
+        with self.lock:
+            return dict(requests = dict(self.requests), injectedErrors = self.injected_errors, throttled = self.throttled, bytesReceived = self.bytes_received)
+
+class EmulatorRequestHandler(httpservers.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        emulator = self.server.emulator
+        url = urlparser.urlparse(self.path)
+        query = urlparser.parse_qs(url.query)
+        body = self.read_body()
+        operation = emulator.get_operation(method, url.path, query)
+        emulator.stats.add_request(operation, len(body))
+        if operation == 'snapshot' and not emulator.begin_snapshot():
+            emulator.delay()
+            emulator.stats.add_throttled()
+            self.send_reply(503, b'<?xml version="1.0" encoding="utf-8"?><Error><Code>ServerBusy</Code></Error>')
+            return
+        try:
+            emulator.delay()
+            failed = emulator.should_fail()
+            if not failed:
+                status, headers, reply = getattr(emulator, 'handle_' + operation)(url.path, self.headers, body)
+        finally:
+            # done before replying, the client may send its next snapshot as soon as it has the reply
+            if operation == 'snapshot':
+                emulator.end_snapshot()
+        if failed:
+            emulator.stats.add_injected_error()
+            self.send_reply(503, b'<?xml version="1.0" encoding="utf-8"?><Error><Code>ServerBusy</Code></Error>')
+            return
+        self.send_reply(status, reply, headers, include_body = (method != 'HEAD'))
+
+    def read_body(self):
+        content_length = int(self.headers.get('Content-Length') or 0)
+        if content_length <= 0:
+            return b''
+        return self.rfile.read(content_length)
+
+    def send_reply(self, status, reply = b'', headers = None, include_body = True):
+        self.send_response(status)
+        headers = headers or {}
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        if include_body and len(reply) > 0:
+            self.wfile.write(reply)
+
+class EmulatorHttpServer(socketservers.ThreadingMixIn, httpservers.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class BlobStoreEmulator(object):
+    """
+    In memory page/block blob store plus the host snapshot endpoints, with injected latency and errors.
+    """
+    def __init__(self, port = 0, latency_ms = 0, latency_jitter_ms = 0, error_rate = 0.0, seed = None, snapshot_throttle_limit = 0):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.snapshot_throttle_limit = snapshot_throttle_limit
+        self.snapshots_in_flight = 0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.blobs = {}
+        self.stats = EmulatorStats()
+        self.server = EmulatorHttpServer(('127.0.0.1', port), EmulatorRequestHandler)
+        self.server.emulator = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_blob_uri(self, blob_name):
+        return 'https://127.0.0.1:{0}/vhds/{1}?sv=2014-02-14&sig=emulator'.format(self.port, blob_name)
+
+    def add_page_blob(self, blob_name, content_length):
+        with self.lock:
+            self.blobs['/vhds/' + blob_name] = EmulatedBlob('PageBlob', content_length)
+        return self.get_blob_uri(blob_name)
+
+    def get_blob(self, path):
+        with self.lock:
+            return self.blobs.get(path)
+
+    def delay(self):
+        latency_ms = self.latency_ms
+        if self.latency_jitter_ms > 0:
+            with self.lock:
+                latency_ms = latency_ms + self.random.uniform(-self.latency_jitter_ms, self.latency_jitter_ms)
+        if latency_ms > 0:
+            time.sleep(latency_ms / 1000.0)
+
+    def begin_snapshot(self):
+        """ False if the snapshot request is throttled, 0 as limit never throttles """
+        with self.lock:
+            if self.snapshot_throttle_limit > 0 and self.snapshots_in_flight >= self.snapshot_throttle_limit:
+                return False
+            self.snapshots_in_flight = self.snapshots_in_flight + 1
+            return True
+
+    def end_snapshot(self):
+        with self.lock:
+            self.snapshots_in_flight = self.snapshots_in_flight - 1
+
+    def should_fail(self):
+        if self.error_rate <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def get_operation(self, method, path, query):
+        if method == 'POST':
+            if path.endswith('/presnapshot'):
+                return 'host_presnapshot'
+            return 'host_dosnapshot'
+        if method == 'HEAD':
+            return 'get_properties'
+        comp = query.get('comp', [''])[0]
+        if comp == 'snapshot':
+            return 'snapshot'
+        if comp == 'page':
+            return 'put_page'
+        if comp == 'properties':
+            return 'set_properties'
+        return 'put_blob'
+
+    def handle_get_properties(self, path, headers, body):
+        blob = self.get_blob(path)
+        if blob is None:
+            return 404, {'Content-Length' : '0'}, b''
+        return 200, {'x-ms-blob-type' : blob.blob_type, 'Content-Length' : str(len(blob.content)), 'ETag' : blob.get_etag()}, b''
+
+    def handle_put_blob(self, path, headers, body):
+        blob_type = headers.get('x-ms-blob-type') or 'BlockBlob'
+        if blob_type == 'PageBlob':
+            blob = EmulatedBlob(blob_type, int(headers.get('x-ms-blob-content-length') or 0))
+        else:
+            blob = EmulatedBlob(blob_type)
+            blob.content = bytearray(body)
+        with self.lock:
+            self.blobs[path] = blob
+        return 201, {'ETag' : blob.get_etag()}, b''
+
+    def handle_set_properties(self, path, headers, body):
+        blob = self.get_blob(path)
+        if blob is None:
+            return 404, {}, b''
+        content_length = headers.get('x-ms-blob-content-length')
+        if content_length is not None:
+            with self.lock:
+                blob.resize(int(content_length))
+        return 200, {'ETag' : blob.get_etag()}, b''
+
+    def handle_put_page(self, path, headers, body):
+        blob = self.get_blob(path)
+        if blob is None or blob.blob_type != 'PageBlob':
+            return 404, {}, b''
+        start, end = [int(index) for index in headers.get('x-ms-range').split('=')[1].split('-')]
+        if start % PAGE_SIZE_BYTES != 0 or (end + 1) % PAGE_SIZE_BYTES != 0 or end >= len(blob.content):
+            return 416, {}, b''
+        with self.lock:
+            if_match = headers.get('If-Match')
+            if if_match is not None and if_match != blob.get_etag():
+                return 412, {}, b''
+            if headers.get('x-ms-page-write') == 'clear':
+                blob.content[start:end + 1] = bytearray(end + 1 - start)
+            else:
+                if len(body) != end + 1 - start:
+                    return 400, {}, b''
+                blob.content[start:end + 1] = body
+            blob.version = blob.version + 1
+            etag = blob.get_etag()
+        return 201, {'ETag' : etag}, b''
+
+    def handle_snapshot(self, path, headers, body):
+        blob = self.get_blob(path)
+        if blob is None:
+            return 404, {}, b''
+        snapshot_time = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f0Z')
+        with self.lock:
+            blob.snapshots.append(snapshot_time)
+        return 201, {'x-ms-snapshot' : snapshot_time, 'ETag' : blob.get_etag()}, b''
+
+    def handle_host_presnapshot(self, path, headers, body):
+        return 200, {'Content-Type' : 'application/json'}, b'{"status" : "success"}'
+
+    def handle_host_dosnapshot(self, path, headers, body):
+        # the host snapshots every disk of the VM
+        with self.lock:
+            paths = sorted(self.blobs.keys())
+        snapshot_info = []
+        for path in paths:
+            status, reply_headers, reply = self.handle_snapshot(path, headers, b'')
+            snapshot_uri = 'https://127.0.0.1:{0}{1}?snapshot={2}'.format(self.port, path, reply_headers.get('x-ms-snapshot'))
+            snapshot_info.append(dict(isSuccessful = 'true', snapshotUri = snapshot_uri, errorMessage = '', statusCode = status))
+        return 200, {'Content-Type' : 'application/json'}, json.dumps(dict(snapshotInfo = snapshot_info)).encode('utf-8')
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type = 'int', default = 8080)
+    parser.add_option('--latency-ms', type = 'float', default = 0)
+    parser.add_option('--latency-jitter-ms', type = 'float', default = 0)
+    parser.add_option('--error-rate', type = 'float', default = 0.0)
+    parser.add_option('--snapshot-throttle-limit', type = 'int', default = 0, help = 'blob snapshots in flight before 503s, 0 for no limit')
+    parser.add_option('--disks', type = 'int', default = 4, help = 'page blobs created at startup')
+    parser.add_option('--disk-size-mb', type = 'int', default = 64)
+    options, args = parser.parse_args()
+    emulator = BlobStoreEmulator(options.port, options.latency_ms, options.latency_jitter_ms, options.error_rate, snapshot_throttle_limit = options.snapshot_throttle_limit)
+    for disk_index in range(options.disks):
+        print(emulator.add_page_blob('disk{0}.vhd'.format(disk_index), options.disk_size_mb * 1024 * 1024))
+    print('serving on 127.0.0.1:{0}, ctrl-c to stop'.format(emulator.port))
+    try:
+        emulator.server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(emulator.stats.convertToDictionary()))
+
+if __name__ == '__main__':
+    main()
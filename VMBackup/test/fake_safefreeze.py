@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Stand-in for the safefreeze binary that freezes nothing. It follows the same
+# protocol: SIGUSR1 and a byte on SAFEFREEZE_NOTIFY_FD to the parent once the
+# (simulated) freeze completed, then waits for SIGUSR1 to thaw and exits.
+# The times it froze and thawed are printed so the overhead can be measured.
+#
+# Usage: fake_safefreeze.py [--freeze-ms N] [--thaw-ms N] TimeoutInSeconds MountPoint1 [MountPoint2 [..]]
+
+import os
+import signal
+import sys
+import threading
+import time
+
+def main():
+    args = sys.argv[1:]
+    freeze_ms = 0
+    thaw_ms = 0
+    while len(args) > 0 and args[0].startswith('--'):
+        if args[0] == '--freeze-ms':
+            freeze_ms = float(args[1])
+        elif args[0] == '--thaw-ms':
+            thaw_ms = float(args[1])
+        args = args[2:]
+    timeout = int(args[0])
+    mount_points = args[1:]
+
+    thaw_event = threading.Event()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: thaw_event.set())
+
+    print('****** 2. Binary Freeze Started ')
+    for mount_point in mount_points:
+        print('Freezing: ' + mount_point)
+        time.sleep(freeze_ms / 1000.0)
+    frozen_at = time.time()
+    print('****** 3. Binary Freeze Completed ')
+    sys.stdout.flush()
+    notify_fd = os.environ.get('SAFEFREEZE_NOTIFY_FD')
+    if notify_fd is not None:
+        os.write(int(notify_fd), b'F')
+    os.kill(os.getppid(), signal.SIGUSR1)
+
+    if not thaw_event.wait(timeout):
+        print('Failed to receive timely Thaw from parent process')
+        sys.exit(1)
+    thaw_received_at = time.time()
+    print('****** 8. Binary Thaw Signal Received ')
+    for mount_point in reversed(mount_points):
+        print('Thawing: ' + mount_point)
+        time.sleep(thaw_ms / 1000.0)
+    print('Fake freeze timing: frozen_at={0:.6f} thaw_received_at={1:.6f} thawed_at={2:.6f}'.format(frozen_at, thaw_received_at, time.time()))
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
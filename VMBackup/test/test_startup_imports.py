@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#
+# VM Backup extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The modules only the daemon needs are not imported with main/handle.py.
+#
+# To run (from the VMBackup folder):
+# python -m unittest discover -s test -p "test_*.py"
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark_startup_imports import DEFERRED_MODULES, import_handle
+
+class TestStartupImports(unittest.TestCase):
+    def test_daemon_modules_deferred(self):
+        result, err = import_handle(False)
+        self.assertEqual([], result['deferred'])
+        self.assertTrue(len(DEFERRED_MODULES) > 0)
+
+if __name__ == '__main__':
+    unittest.main()
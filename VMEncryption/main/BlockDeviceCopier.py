@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import os.path
+import struct
+import time
+
+from Common import CommonVariables
+from CopyEngine import CopyEngine
+
+
+class BlockDeviceCopier(object):
+    """
+    Copies the rootfs block device onto the dm-crypt mapping of itself chunk by chunk, instead of one dd run.
+    The mapping has a detached header, so a chunk goes back to the offset it is read from, encrypted.
+    That is not idempotent: a chunk read again after it was written is read encrypted. So every chunk that
+    is written is first saved with its offset to the chunk backup file, the backup of the last chunk
+    is written again on resume, and the copy goes on after it.
+    With sparse, chunks of zeros are not written at all, as dd conv=sparse does.
+    The offset copied up to is checkpointed to the state marker folder every checkpoint_interval seconds,
+    the progress is reported every copy_status_report_interval seconds.
+    The state marker folder is under /var/lib, which the stripdown state copies into the tmpfs root
+    before pivot_root, so a copy resumes after a daemon or extension restart within the same boot only,
+    not after a reboot.
+    """
+    chunk_size = 8 * 1024 * 1024
+    checkpoint_interval = 10
+    # the chunk data in the backup file and in the buffer follow an aligned header with its offset and size
+    header_format = '<QQ'
+    header_size = CopyEngine.direct_io_alignment
+
+    def __init__(self, logger, hutil, source, destination, total_size, state_path, sparse=True, use_direct_io=True):
+        self.logger = logger
+        self.hutil = hutil
+        self.source = source
+        self.destination = destination
+        self.total_size = total_size
+        self.sparse = sparse
+        self.checkpoint_path = state_path + '.checkpoint'
+        self.chunk_backup_path = state_path + '.chunk'
+        self.copy_engine = CopyEngine(logger, use_direct_io=use_direct_io)
+        self.zero_chunk = b'\0' * BlockDeviceCopier.chunk_size
+        self.offset = 0
+        self.written_size = 0
+        self.start_time = None
+        self.start_offset = 0
+        self.last_checkpoint_time = None
+        self.last_status_report_time = None
+
+    def has_checkpoint(self):
+        """
+        True once a copy started, the destination holds encrypted chunks and must not be formatted again
+        """
+        return os.path.exists(self.checkpoint_path) or os.path.exists(self.chunk_backup_path)
+
+    def read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path, 'r') as checkpoint_file:
+            fields = checkpoint_file.read().split()
+        offset = int(fields[0])
+        self.written_size = int(fields[1])
+        return offset
+
+    def write_checkpoint(self):
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            checkpoint_file.write('{0} {1} {2}\n'.format(self.offset, self.written_size, self.total_size))
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(temp_path, self.checkpoint_path)
+        self.copy_engine.sync_folder(os.path.dirname(self.checkpoint_path))
+        self.last_checkpoint_time = time.time()
+
+    def restore_chunk_backup(self):
+        """
+        writes the last chunk again from its backup, returns the offset after it, 0 without a backup
+        """
+        if not os.path.exists(self.chunk_backup_path):
+            return 0
+        backup_size = os.path.getsize(self.chunk_backup_path)
+        if backup_size < BlockDeviceCopier.header_size:
+            raise Exception("the chunk backup {0} is cut short".format(self.chunk_backup_path))
+        self.copy_engine.read(self.chunk_backup_path, 0, backup_size)
+        offset, length = struct.unpack_from(BlockDeviceCopier.header_format, self.copy_engine.buffer, 0)
+        if backup_size != BlockDeviceCopier.header_size + length:
+            raise Exception("the chunk backup {0} holds {1} bytes instead of {2}".format(self.chunk_backup_path, backup_size - BlockDeviceCopier.header_size, length))
+        self.logger.log("writing the chunk at {0} of {1} again from its backup".format(offset, self.destination))
+        self.copy_engine.write(self.destination, offset, length, BlockDeviceCopier.header_size)
+        return offset + length
+
+    def is_zero_chunk(self, length):
+        data_offset = BlockDeviceCopier.header_size
+        return self.copy_engine.buffer[data_offset:data_offset + length] == self.zero_chunk[:length]
+
+    def copy_chunk(self, length):
+        """
+        copies the chunk at offset, returns False if the source ended before it
+        """
+        read_size = self.copy_engine.read(self.source, self.offset, length, BlockDeviceCopier.header_size)
+        if read_size != length:
+            self.logger.log(msg="read {0} bytes of the {1} bytes chunk at {2} of {3}".format(read_size, length, self.offset, self.source),
+                            level=CommonVariables.ErrorLevel)
+            return False
+        if not (self.sparse and self.is_zero_chunk(length)):
+            struct.pack_into(BlockDeviceCopier.header_format, self.copy_engine.buffer, 0, self.offset, length)
+            self.copy_engine.write_file(self.chunk_backup_path, BlockDeviceCopier.header_size + length)
+            self.copy_engine.write(self.destination, self.offset, length, BlockDeviceCopier.header_size)
+            self.written_size += length
+        self.offset += length
+        return True
+
+    def report_progress(self, done=False):
+        now = time.time()
+        if not done and self.last_status_report_time is not None \
+                and now - self.last_status_report_time < CommonVariables.copy_status_report_interval:
+            return
+        self.last_status_report_time = now
+        percent = 100 if self.total_size == 0 else int(self.offset * 100.0 / self.total_size)
+        throughput = (self.offset - self.start_offset) / max(now - self.start_time, 0.001) / (1024 * 1024)
+        msg = 'OS disk encryption: {0}% done, {1:.1f} MB/s'.format(percent, throughput)
+        self.logger.log(msg)
+        self.hutil.do_status_report(operation='EnableEncryptionDataVolumes',
+                                    status=CommonVariables.extension_success_status,
+                                    status_code=str(CommonVariables.success),
+                                    message=msg)
+
+    def copy(self):
+        """
+        copies from the last checkpoint on, returns CommonVariables.process_success once the whole source is copied
+        """
+        self.copy_engine.reserve(BlockDeviceCopier.header_size + BlockDeviceCopier.chunk_size)
+        try:
+            self.offset = max(self.read_checkpoint(), self.restore_chunk_backup())
+            if self.offset > 0:
+                self.logger.log("resuming the copy of {0} at {1} of {2} bytes".format(self.source, self.offset, self.total_size))
+            self.start_time = time.time()
+            self.start_offset = self.offset
+            self.write_checkpoint()
+
+            while self.offset < self.total_size:
+                if not self.copy_chunk(min(BlockDeviceCopier.chunk_size, self.total_size - self.offset)):
+                    self.write_checkpoint()
+                    return CommonVariables.copy_data_error
+                if time.time() - self.last_checkpoint_time >= BlockDeviceCopier.checkpoint_interval:
+                    self.write_checkpoint()
+                self.report_progress()
+
+            self.write_checkpoint()
+            self.report_progress(done=True)
+            return CommonVariables.process_success
+        finally:
+            self.copy_engine.release()
+
+    def clear(self):
+        """
+        removes the checkpoint and the chunk backup, once the state is marked as executed
+        """
+        for path in [self.checkpoint_path, self.chunk_backup_path]:
+            if os.path.exists(path):
+                os.remove(path)
@@ -33,6 +33,13 @@ class CommonVariables:
     sector_size = 512
     luks_header_size = 4096 * 512
     default_block_size = 52428800
+    # the slice size tuner keeps the block size of copies between these
+    min_block_size = 4194304
+    max_block_size = 52428800 * 16
+    copy_status_report_interval = 30
+    # data volumes encrypted in place at the same time, and the MB/s each of them may copy, 0 for no limit
+    default_max_parallel_encryptions = 4
+    default_encryption_io_budget = 0
     min_filesystem_size_support = 52428800 * 3
     #TODO for the sles 11, we should use the ext3
     default_file_system = 'ext4'
@@ -62,6 +69,8 @@ class CommonVariables:
     default_encryption_algorithm = 'RSA-OAEP'
     DiskFormatQuerykey = "DiskFormatQuery"
     PassphraseKey = 'Passphrase'
+    MaxParallelEncryptionsKey = 'MaxParallelEncryptions'
+    EncryptionIOBudgetKey = 'EncryptionIOBudgetMBps'
 
     """
     value for VolumeType could be OS or Data
@@ -94,6 +103,8 @@ class CommonVariables:
     EncryptionDecryptionOperationKey = 'DecryptionOperation'
     EncryptionVolumeTypeKey = 'VolumeType'
     EncryptionDiskFormatQueryKey = 'DiskFormatQuery'
+    EncryptionMaxParallelEncryptionsKey = 'MaxParallelEncryptions'
+    EncryptionIOBudgetKey = 'EncryptionIOBudgetMBps'
 
     """
     crypt ongoing item config keys
@@ -114,6 +125,7 @@ class CommonVariables:
     OngoingItemCurrentLuksHeaderFilePathKey = 'CurrentLuksHeaderFilePath'
     OngoingItemCurrentSourcePathKey = 'CurrentSourcePath'
     OngoingItemCurrentBlockSizeKey = 'CurrentBlockSize'
+    OngoingItemJournalGenerationKey = 'JournalGeneration'
 
     """
     encryption phase devinitions
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import errno
+import io
+import mmap
+import os
+import os.path
+
+
+class CopyEngine(object):
+    """
+    Copies byte ranges between block devices and files inside the extension process, instead of a dd process per hop.
+    A range is read into a page aligned buffer kept for the next range, and written from there to each destination,
+    every destination flushed to disk before the next one is written.
+    With use_direct_io the source and destinations are opened with O_DIRECT for the ranges aligned to
+    direct_io_alignment, bypassing the page cache.
+    Data is read straight into the buffer, with os.preadv on python 3.7+ and through a ctypes view of it elsewhere.
+    """
+    direct_io_alignment = 4096
+
+    def __init__(self, logger, use_direct_io=False):
+        self.logger = logger
+        self.use_direct_io = use_direct_io and hasattr(os, 'O_DIRECT')
+        self.buffer = None
+        self.buffer_size = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def reserve(self, size):
+        """
+        makes sure the buffer holds size bytes, it is only ever grown and keeps its content when it is
+        """
+        if size > self.buffer_size:
+            buffer_size = ((size + mmap.PAGESIZE - 1) // mmap.PAGESIZE) * mmap.PAGESIZE
+            new_buffer = mmap.mmap(-1, buffer_size)
+            if self.buffer is not None:
+                new_buffer[0:self.buffer_size] = self.buffer[0:self.buffer_size]
+                self.buffer.close()
+            self.buffer = new_buffer
+            self.buffer_size = buffer_size
+
+    def release(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+            self.buffer_size = 0
+
+    def is_aligned(self, *values):
+        return all(value % CopyEngine.direct_io_alignment == 0 for value in values)
+
+    def open(self, path, flags, direct):
+        if direct:
+            try:
+                return os.open(path, flags | os.O_DIRECT, 0o600)
+            except OSError as e:
+                # tmpfs and some file systems refuse O_DIRECT
+                if e.errno != errno.EINVAL:
+                    raise
+                self.logger.log("O_DIRECT not supported for {0}, using the page cache".format(path))
+        return os.open(path, flags, 0o600)
+
+    def read(self, path, offset, length, buffer_offset=0):
+        """
+        reads length bytes at offset of path into the buffer at buffer_offset.
+        returns the number of bytes read, less than length if path ends first.
+        """
+        self.reserve(buffer_offset + length)
+        direct = self.use_direct_io and self.is_aligned(offset, length, buffer_offset)
+        fd = self.open(path, os.O_RDONLY, direct)
+        try:
+            done = 0
+            while done < length:
+                count = self.read_at(fd, offset + done, buffer_offset + done, length - done)
+                if count == 0:
+                    break
+                done += count
+            self.bytes_read += done
+            return done
+        finally:
+            os.close(fd)
+
+    def read_at(self, fd, offset, buffer_offset, length):
+        if hasattr(os, 'preadv'):
+            view = memoryview(self.buffer)[buffer_offset:buffer_offset + length]
+            try:
+                return os.preadv(fd, [view], offset)
+            finally:
+                view.release()
+        # python 2 has no memoryview of an mmap, a ctypes array over the same memory is read into instead
+        target = (ctypes.c_char * length).from_buffer(self.buffer, buffer_offset)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return io.FileIO(fd, 'r', closefd=False).readinto(target)
+        finally:
+            del target
+
+    def write(self, path, offset, length, buffer_offset=0):
+        """
+        writes length bytes of the buffer at buffer_offset to offset of path and flushes them to disk.
+        path is created if it does not exist, as dd does.
+        """
+        direct = self.use_direct_io and self.is_aligned(offset, length, buffer_offset)
+        fd = self.open(path, os.O_WRONLY | os.O_CREAT, direct)
+        try:
+            done = 0
+            while done < length:
+                done += self.write_at(fd, offset + done, buffer_offset + done, length - done)
+            os.fsync(fd)
+            self.bytes_written += done
+        finally:
+            os.close(fd)
+
+    def write_at(self, fd, offset, buffer_offset, length):
+        if hasattr(os, 'pwritev'):
+            view = memoryview(self.buffer)[buffer_offset:buffer_offset + length]
+            try:
+                return os.pwritev(fd, [view], offset)
+            finally:
+                view.release()
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, buffer(self.buffer, buffer_offset, length))
+
+    def write_file(self, path, length, buffer_offset=0):
+        """
+        replaces path with length bytes of the buffer at buffer_offset, it either holds all of them or does
+        not exist after a crash: they go to a temporary file, flushed and renamed to path.
+        """
+        temp_path = path + '.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        self.write(temp_path, 0, length, buffer_offset)
+        os.rename(temp_path, path)
+        self.sync_folder(os.path.dirname(path))
+
+    def sync_folder(self, folder):
+        fd = os.open(folder or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def copy(self, source_path, source_offset, length, destinations):
+        """
+        reads length bytes at source_offset of source_path once and writes them to each (path, offset) of
+        destinations in order. returns the number of bytes copied, less than length if the source ends first.
+        """
+        count = self.read(source_path, source_offset, length)
+        for destination_path, destination_offset in destinations:
+            self.write(destination_path, destination_offset, count)
+        return count
@@ -23,6 +23,7 @@ import os.path
 import re
 from subprocess import Popen
 import shutil
+import threading
 import traceback
 import uuid
 import glob
@@ -32,6 +33,7 @@ from EncryptionConfig import EncryptionConfig
 from DecryptionMarkConfig import DecryptionMarkConfig
 from EncryptionMarkConfig import EncryptionMarkConfig
 from TransactionalCopyTask import TransactionalCopyTask
+from SliceSizeTuner import SliceSizeTuner
 from CommandExecutor import CommandExecutor, ProcessCommunicator
 from Common import CommonVariables, CryptItem, LvmItem, DeviceItem
 
@@ -40,9 +42,15 @@ class DiskUtil(object):
     os_disk_lvm = None
     sles_cache = {}
     device_id_cache = {}
+    # the crypt items and fstab are shared by the devices encrypted in parallel
+    config_files_lock = threading.Lock()
 
-    def __init__(self, hutil, patching, logger, encryption_environment):
+    def __init__(self, hutil, patching, logger, encryption_environment, io_budget=None):
+        """
+        io_budget is the MB/s the copies of this disk util may do, None or 0 for no limit
+        """
         self.encryption_environment = encryption_environment
+        self.io_budget = io_budget
         self.hutil = hutil
         self.distro_patcher = patching
         self.logger = logger
@@ -58,7 +66,9 @@ class DiskUtil(object):
                                           ongoing_item_config=ongoing_item_config,
                                           patching=self.distro_patcher,
                                           encryption_environment=self.encryption_environment,
-                                          status_prefix=status_prefix)
+                                          status_prefix=status_prefix,
+                                          max_bytes_per_second=(self.io_budget * 1024 * 1024 if self.io_budget else None),
+                                          slice_size_tuner=SliceSizeTuner(self.logger))
         try:
             mem_fs_result = copy_task.prepare_mem_fs()
             if mem_fs_result != CommonVariables.process_success:
@@ -239,10 +249,11 @@ class DiskUtil(object):
         return non_os_entry_found
 
     def add_crypt_item(self, crypt_item, key_file_path):
-        if self.should_use_azure_crypt_mount():
-            return self.add_crypt_item_to_azure_crypt_mount(crypt_item)
-        else:
-            return self.add_crypt_item_to_crypttab(crypt_item, key_file_path)
+        with DiskUtil.config_files_lock:
+            if self.should_use_azure_crypt_mount():
+                return self.add_crypt_item_to_azure_crypt_mount(crypt_item)
+            else:
+                return self.add_crypt_item_to_crypttab(crypt_item, key_file_path)
 
     def add_crypt_item_to_crypttab(self, crypt_item, key_file):
         if key_file is None and crypt_item.uses_cleartext_key:
@@ -579,40 +590,41 @@ class DiskUtil(object):
             self.logger.log("modify_fstab_entry_encrypt: mount_point is empty")
             return
 
-        shutil.copy2('/etc/fstab', '/etc/fstab.backup.' + str(str(uuid.uuid4())))
+        with DiskUtil.config_files_lock:
+            shutil.copy2('/etc/fstab', '/etc/fstab.backup.' + str(str(uuid.uuid4())))
 
-        with open('/etc/fstab', 'r') as f:
-            lines = f.readlines()
+            with open('/etc/fstab', 'r') as f:
+                lines = f.readlines()
 
-        relevant_line = None
-        for i in range(len(lines)):
-            line = lines[i]
-            fstab_device, fstab_mount_point = self.parse_fstab_line(line)
-            if fstab_mount_point != mount_point:  # Not the line we are looking for
-                continue
+            relevant_line = None
+            for i in range(len(lines)):
+                line = lines[i]
+                fstab_device, fstab_mount_point = self.parse_fstab_line(line)
+                if fstab_mount_point != mount_point:  # Not the line we are looking for
+                    continue
 
-            self.logger.log("Found the relevant fstab line: " + line)
-            relevant_line = line
+                self.logger.log("Found the relevant fstab line: " + line)
+                relevant_line = line
 
-            if self.should_use_azure_crypt_mount():
-                # in this case we just remove the line
-                lines.pop(i)
-                break
-            else:
-                new_line = relevant_line.replace(fstab_device, mapper_path)
-                self.logger.log("Replacing that line with: " + new_line)
-                lines[i] = new_line
-                break
+                if self.should_use_azure_crypt_mount():
+                    # in this case we just remove the line
+                    lines.pop(i)
+                    break
+                else:
+                    new_line = relevant_line.replace(fstab_device, mapper_path)
+                    self.logger.log("Replacing that line with: " + new_line)
+                    lines[i] = new_line
+                    break
 
-        if not self.is_bek_in_fstab_file(lines):
-            lines.append(self.get_fstab_bek_line())
+            if not self.is_bek_in_fstab_file(lines):
+                lines.append(self.get_fstab_bek_line())
 
-        with open('/etc/fstab', 'w') as f:
-            f.writelines(lines)
+            with open('/etc/fstab', 'w') as f:
+                f.writelines(lines)
 
-        if relevant_line is not None:
-            with open('/etc/fstab.azure.backup', 'a+') as f:
-                f.write("\n" + relevant_line)
+            if relevant_line is not None:
+                with open('/etc/fstab.azure.backup', 'a+') as f:
+                    f.write("\n" + relevant_line)
 
     def get_fstab_bek_line(self):
         if self.distro_patcher.distro_info[0].lower() == 'ubuntu' and self.distro_patcher.distro_info[1].startswith('14'):
@@ -1174,6 +1186,53 @@ class DiskUtil(object):
 
         return lvm_items
 
+    def get_pv_vg_names(self):
+        """
+        returns the volume group name of each lvm physical volume by its path
+        """
+        pvs_command = 'pvs --noheadings --nameprefixes --unquoted -o pv_name,vg_name'
+        proc_comm = ProcessCommunicator()
+
+        if self.command_executor.Execute(pvs_command, communicator=proc_comm):
+            return {}
+
+        pv_vg_names = {}
+
+        for line in proc_comm.stdout.splitlines():
+            pv_name = None
+            vg_name = None
+
+            for pair in line.strip().split():
+                if len(pair.split('=')) != 2:
+                    continue
+
+                key, value = pair.split('=')
+
+                if key == 'LVM2_PV_NAME':
+                    pv_name = value
+
+                if key == 'LVM2_VG_NAME':
+                    vg_name = value
+
+            if pv_name and vg_name:
+                pv_vg_names[pv_name] = vg_name
+
+        return pv_vg_names
+
+    def get_device_lock_keys(self, device_item, pv_vg_names):
+        """
+        returns the keys a device is locked by while it is encrypted. logical volumes and physical volumes
+        of a volume group share its key, so no two of them are encrypted at the same time.
+        """
+        lock_keys = [device_item.name]
+        # logical volumes are named vg/lv
+        if '/' in device_item.name:
+            lock_keys.append('vg:' + device_item.name.split('/')[0])
+        vg_name = pv_vg_names.get(os.path.join('/dev/', device_item.name))
+        if vg_name:
+            lock_keys.append('vg:' + vg_name)
+        return lock_keys
+
     def is_os_disk_lvm(self):
         if DiskUtil.os_disk_lvm is not None:
             return DiskUtil.os_disk_lvm
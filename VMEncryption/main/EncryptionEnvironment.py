@@ -16,9 +16,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import os
 import os.path
 import subprocess
+import urllib
 from subprocess import *
 
 class EncryptionEnvironment(object):
@@ -35,6 +37,7 @@ class EncryptionEnvironment(object):
         self.azure_crypt_request_queue_path = os.path.join(self.encryption_config_path, 'azure_crypt_request_queue.ini')
         self.azure_decrypt_request_queue_path = os.path.join(self.encryption_config_path, 'azure_decrypt_request_queue.ini')
         self.azure_crypt_ongoing_item_config_path = os.path.join(self.encryption_config_path, 'azure_crypt_ongoing_item.ini')
+        self.azure_crypt_ongoing_item_journal_path = os.path.join(self.encryption_config_path, 'azure_crypt_ongoing_item.journal')
         self.azure_crypt_current_transactional_copy_path = os.path.join(self.encryption_config_path, 'azure_crypt_copy_progress.ini')
         self.luks_header_base_path = os.path.join(self.encryption_config_path, 'azureluksheader')
         self.cleartext_key_base_path = os.path.join(self.encryption_config_path, 'cleartext_key')
@@ -42,6 +45,37 @@ class EncryptionEnvironment(object):
         self.copy_slice_item_backup_file = os.path.join(self.encryption_config_path, 'copy_slice_item.bak')
         self.os_encryption_markers_path = os.path.join(self.encryption_config_path, 'os_encryption_markers')
         self.bek_backup_path = os.path.join(self.encryption_config_path, 'bek_backup')
+        # one folder per device encrypted in parallel, holding its ongoing item config and copy files
+        self.device_ongoing_items_path = os.path.join(self.encryption_config_path, 'ongoing_items')
+        self.device_name = None
+
+    def get_device_environment(self, device_name):
+        """
+        returns a copy of this environment with the ongoing item config, its journal and the copy files
+        of device_name in a folder of their own, so devices encrypted at the same time do not share them
+        """
+        device_environment = copy.copy(self)
+        device_environment.device_name = device_name
+        device_folder = os.path.join(self.device_ongoing_items_path, urllib.quote(device_name, safe=''))
+        if not os.path.exists(device_folder):
+            os.makedirs(device_folder)
+        device_environment.azure_crypt_ongoing_item_config_path = os.path.join(device_folder, 'azure_crypt_ongoing_item.ini')
+        device_environment.azure_crypt_ongoing_item_journal_path = os.path.join(device_folder, 'azure_crypt_ongoing_item.journal')
+        device_environment.copy_header_slice_file_path = os.path.join(device_folder, 'copy_header_slice_file')
+        device_environment.copy_slice_item_backup_file = os.path.join(device_folder, 'copy_slice_item.bak')
+        return device_environment
+
+    def get_device_environments(self):
+        """
+        returns the environments of the devices that have an ongoing item config, the ones to resume
+        """
+        device_environments = []
+        if os.path.exists(self.device_ongoing_items_path):
+            for device_folder in sorted(os.listdir(self.device_ongoing_items_path)):
+                device_environment = self.get_device_environment(urllib.unquote(device_folder))
+                if os.path.exists(device_environment.azure_crypt_ongoing_item_config_path):
+                    device_environments.append(device_environment)
+        return device_environments
 
     def get_se_linux(self):
         proc = Popen([self.patching.getenforce_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
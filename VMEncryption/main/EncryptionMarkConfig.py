@@ -29,6 +29,8 @@ class EncryptionMarkConfig(object):
         self.command = None
         self.volume_type = None
         self.diskFormatQuery = None
+        self.max_parallel_encryptions = None
+        self.io_budget = None
         self.encryption_mark_config = ConfigUtil(self.encryption_environment.azure_crypt_request_queue_path,
                                                  'encryption_request_queue',
                                                  self.logger)
@@ -42,6 +44,23 @@ class EncryptionMarkConfig(object):
     def get_encryption_disk_format_query(self):
         return self.encryption_mark_config.get_config(CommonVariables.EncryptionDiskFormatQueryKey)
 
+    def get_max_parallel_encryptions(self):
+        max_parallel_encryptions = self.encryption_mark_config.get_config(CommonVariables.EncryptionMaxParallelEncryptionsKey)
+        if max_parallel_encryptions is None or max_parallel_encryptions == "":
+            return CommonVariables.default_max_parallel_encryptions
+        else:
+            return max(1, int(max_parallel_encryptions))
+
+    def get_io_budget(self):
+        """
+        returns the MB/s a device may be copied with, 0 for no limit
+        """
+        io_budget = self.encryption_mark_config.get_config(CommonVariables.EncryptionIOBudgetKey)
+        if io_budget is None or io_budget == "":
+            return CommonVariables.default_encryption_io_budget
+        else:
+            return max(0, int(io_budget))
+
     def config_file_exists(self):
         """
         we should compare the timestamp of the file with the current system time
@@ -57,6 +76,10 @@ class EncryptionMarkConfig(object):
         key_value_pairs.append(volume_type)
         disk_format_query = ConfigKeyValuePair(CommonVariables.EncryptionDiskFormatQueryKey, self.diskFormatQuery)
         key_value_pairs.append(disk_format_query)
+        max_parallel_encryptions = ConfigKeyValuePair(CommonVariables.EncryptionMaxParallelEncryptionsKey, self.max_parallel_encryptions)
+        key_value_pairs.append(max_parallel_encryptions)
+        io_budget = ConfigKeyValuePair(CommonVariables.EncryptionIOBudgetKey, self.io_budget)
+        key_value_pairs.append(io_budget)
         self.encryption_mark_config.save_configs(key_value_pairs)
 
     def clear_config(self):
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import traceback
+from Common import CommonVariables
+
+
+class DeviceLockTable(object):
+    """
+    the lock keys held by the devices being encrypted, a device is only started once none of its keys is held
+    """
+    def __init__(self):
+        self.held_keys = set()
+
+    def try_acquire(self, lock_keys):
+        if any(lock_key in self.held_keys for lock_key in lock_keys):
+            return False
+        self.held_keys.update(lock_keys)
+        return True
+
+    def release(self, lock_keys):
+        self.held_keys.difference_update(lock_keys)
+
+
+class EncryptionJob(object):
+    def __init__(self, name, lock_keys, target, item=None):
+        """
+        target is called without arguments on a worker thread and returns True if the device is encrypted
+        """
+        self.name = name
+        self.lock_keys = lock_keys
+        self.target = target
+        self.item = item
+        self.succeeded = None
+
+    def __str__(self):
+        return "name:" + str(self.name) + " lock_keys:" + str(self.lock_keys) + " succeeded:" + str(self.succeeded)
+
+
+class EncryptionScheduler(object):
+    """
+    Encrypts devices on up to max_workers threads at the same time, in the order they are added.
+    A job waits while another one holding one of its lock keys runs, say a volume of the same volume group.
+    Once a job failed no more jobs are started, the running ones are finished.
+    """
+    def __init__(self, logger, max_workers):
+        self.logger = logger
+        self.max_workers = max(1, max_workers)
+        self.jobs = []
+        self.lock_table = DeviceLockTable()
+        self.condition = threading.Condition()
+        self.running_count = 0
+
+    def add_job(self, name, lock_keys, target, item=None):
+        job = EncryptionJob(name, lock_keys, target, item)
+        self.jobs.append(job)
+        return job
+
+    def run(self):
+        """
+        returns the first job that failed, None if all of them succeeded
+        """
+        pending_jobs = list(self.jobs)
+        failed_jobs = []
+        with self.condition:
+            while True:
+                if not failed_jobs:
+                    for job in list(pending_jobs):
+                        if self.running_count >= self.max_workers:
+                            break
+                        if self.lock_table.try_acquire(job.lock_keys):
+                            pending_jobs.remove(job)
+                            self.start_job(job, failed_jobs)
+                elif pending_jobs:
+                    self.logger.log(msg="not starting {0} jobs after {1} failed".format(len(pending_jobs), failed_jobs[0].name),
+                                    level=CommonVariables.WarningLevel)
+                    pending_jobs = []
+                if self.running_count == 0:
+                    break
+                self.condition.wait()
+        if failed_jobs:
+            return failed_jobs[0]
+        return None
+
+    def start_job(self, job, failed_jobs):
+        self.logger.log("starting encryption job {0}, {1} running".format(job, self.running_count))
+        self.running_count += 1
+        worker = threading.Thread(target=self.run_job, args=(job, failed_jobs))
+        worker.daemon = True
+        worker.start()
+
+    def run_job(self, job, failed_jobs):
+        try:
+            job.succeeded = bool(job.target())
+        except Exception as e:
+            self.logger.log(msg="encryption job {0} failed: {1}, stack trace: {2}".format(job.name, e, traceback.format_exc()),
+                            level=CommonVariables.ErrorLevel)
+            job.succeeded = False
+        with self.condition:
+            self.lock_table.release(job.lock_keys)
+            self.running_count -= 1
+            if not job.succeeded:
+                failed_jobs.append(job)
+            self.logger.log("encryption job {0} finished".format(job))
+            self.condition.notify()
+
+
+class SynchronizedHandlerUtil(object):
+    """
+    hands the handler util to the jobs encrypting in parallel, one status report written at a time
+    """
+    def __init__(self, hutil):
+        self.hutil = hutil
+        self.status_lock = threading.Lock()
+
+    def do_status_report(self, operation, status, status_code, message):
+        with self.status_lock:
+            return self.hutil.do_status_report(operation=operation,
+                                               status=status,
+                                               status_code=status_code,
+                                               message=message)
+
+    def __getattr__(self, name):
+        return getattr(self.hutil, name)
@@ -60,6 +60,8 @@ class ExtensionParameter(object):
 
         self.VolumeType = public_settings.get(CommonVariables.VolumeTypeKey)
         self.DiskFormatQuery = public_settings.get(CommonVariables.DiskFormatQuerykey)
+        self.MaxParallelEncryptions = public_settings.get(CommonVariables.MaxParallelEncryptionsKey)
+        self.EncryptionIOBudget = public_settings.get(CommonVariables.EncryptionIOBudgetKey)
 
         """
         private settings
@@ -25,6 +25,7 @@ from Common import CommonVariables
 from ConfigParser import ConfigParser
 from ConfigUtil import ConfigUtil
 from ConfigUtil import ConfigKeyValuePair
+from ProgressJournal import ProgressJournal
 
 
 class OnGoingItemConfig(object):
@@ -46,7 +47,10 @@ class OnGoingItemConfig(object):
         self.current_total_copy_size = None
         self.current_slice_index = None
         self.current_destination = None
+        self.journal_generation = None
         self.ongoing_item_config = ConfigUtil(encryption_environment.azure_crypt_ongoing_item_config_path, 'azure_crypt_ongoing_item_config', logger)
+        # the slice index is appended to the journal per slice, the config file is rewritten by commit only
+        self.progress_journal = ProgressJournal(encryption_environment.azure_crypt_ongoing_item_journal_path, logger)
 
     def config_file_exists(self):
         return self.ongoing_item_config.config_file_exists()
@@ -84,11 +88,23 @@ class OnGoingItemConfig(object):
 
     def get_current_slice_index(self):
         current_slice_index_value = self.ongoing_item_config.get_config(CommonVariables.OngoingItemCurrentSliceIndexKey)
+        journal_generation = self.get_journal_generation()
+        if journal_generation is not None:
+            journal_slice_index = self.progress_journal.get_last_slice_index(journal_generation)
+            if journal_slice_index is not None:
+                return long(journal_slice_index)
         if current_slice_index_value is None or current_slice_index_value == "":
             return None
         else:
             return long(current_slice_index_value)
 
+    def get_journal_generation(self):
+        journal_generation_value = self.ongoing_item_config.get_config(CommonVariables.OngoingItemJournalGenerationKey)
+        if journal_generation_value is None or journal_generation_value == "":
+            return None
+        else:
+            return long(journal_generation_value)
+
     def get_from_end(self):
         return self.ongoing_item_config.get_config(CommonVariables.OngoingItemFromEndKey)
 
@@ -132,7 +148,30 @@ class OnGoingItemConfig(object):
         self.current_slice_index = self.get_current_slice_index()
         self.current_destination = self.get_current_destination()
 
+    def commit_slice_index(self, slice_index):
+        """
+        records the progress of the copy, appending to the journal instead of rewriting the config file
+        """
+        self.current_slice_index = slice_index
+        if self.journal_generation is None:
+            self.journal_generation = self.get_journal_generation()
+        if self.journal_generation is None:
+            # the config file predates the journal
+            self.commit()
+        else:
+            self.progress_journal.append(self.journal_generation, slice_index)
+
     def commit(self):
+        """
+        rewrites the config file with a new journal generation and compacts the journal, its progress is in the file now
+        """
+        if self.current_slice_index is None:
+            self.current_slice_index = self.get_current_slice_index()
+        previous_generation = self.get_journal_generation()
+        if previous_generation is None:
+            previous_generation = 0
+        self.journal_generation = previous_generation + 1
+
         key_value_pairs = []
         original_dev_name_path_pair = ConfigKeyValuePair(CommonVariables.OngoingItemOriginalDevNamePathKey, self.original_dev_name_path)
         key_value_pairs.append(original_dev_name_path_pair)
@@ -179,10 +218,24 @@ class OnGoingItemConfig(object):
         current_block_size_pair = ConfigKeyValuePair(CommonVariables.OngoingItemCurrentBlockSizeKey, self.current_block_size)
         key_value_pairs.append(current_block_size_pair)
 
+        journal_generation_pair = ConfigKeyValuePair(CommonVariables.OngoingItemJournalGenerationKey, self.journal_generation)
+        key_value_pairs.append(journal_generation_pair)
+
         self.ongoing_item_config.save_configs(key_value_pairs)
+        # the journal may only go once the config file holding its progress is on disk
+        self.sync_config_file()
+        self.progress_journal.reset()
+
+    def sync_config_file(self):
+        config_fd = os.open(self.encryption_environment.azure_crypt_ongoing_item_config_path, os.O_RDONLY)
+        try:
+            os.fsync(config_fd)
+        finally:
+            os.close(config_fd)
 
     def clear_config(self):
         try:
+            self.progress_journal.reset()
             if os.path.exists(self.encryption_environment.azure_crypt_ongoing_item_config_path):
                 self.logger.log(msg="archive the config file: {0}".format(self.encryption_environment.azure_crypt_ongoing_item_config_path))
                 time_stamp = datetime.datetime.now()
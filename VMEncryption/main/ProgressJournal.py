@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import os.path
+import struct
+import zlib
+from Common import CommonVariables
+
+
+class ProgressJournal(object):
+    """
+    Append only journal of the slice index of the ongoing item, one fixed size record per copied slice,
+    so the progress of a copy does not rewrite the whole ongoing item config file.
+    A record holds a magic, the generation, the slice index and the crc32 of these. Reading stops at the
+    first record that is torn or does not check out, the next append cuts the journal back to there.
+    The generation ties records to one commit of the ongoing item config, records of older ones are ignored.
+    """
+    record_format = '<4sQQI'
+    record_size = struct.calcsize(record_format)
+    record_magic = b'ADEJ'
+
+    def __init__(self, journal_path, logger):
+        self.journal_path = journal_path
+        self.logger = logger
+        self.fd = None
+        self.valid_size = None
+
+    def pack_record(self, generation, slice_index):
+        data = struct.pack('<4sQQ', ProgressJournal.record_magic, generation, slice_index)
+        return data + struct.pack('<I', zlib.crc32(data) & 0xffffffff)
+
+    def unpack_record(self, record):
+        """
+        returns (generation, slice_index) of a record, None if it does not check out
+        """
+        if len(record) != ProgressJournal.record_size:
+            return None
+        magic, generation, slice_index, checksum = struct.unpack(ProgressJournal.record_format, record)
+        if magic != ProgressJournal.record_magic:
+            return None
+        if zlib.crc32(record[:-4]) & 0xffffffff != checksum:
+            return None
+        return generation, slice_index
+
+    def get_last_slice_index(self, generation):
+        """
+        replays the journal, returns the slice index of the last valid record of generation, None if there is none
+        """
+        self.valid_size = 0
+        if not os.path.exists(self.journal_path):
+            return None
+        last_slice_index = None
+        with open(self.journal_path, 'rb') as journal_file:
+            while True:
+                record = self.unpack_record(journal_file.read(ProgressJournal.record_size))
+                if record is None:
+                    break
+                self.valid_size += ProgressJournal.record_size
+                if record[0] == generation:
+                    last_slice_index = record[1]
+        if self.valid_size != os.path.getsize(self.journal_path):
+            self.logger.log(msg="the progress journal {0} has a torn or corrupted record at {1}, ignoring the rest of it".format(self.journal_path, self.valid_size),
+                            level=CommonVariables.WarningLevel)
+        return last_slice_index
+
+    def append(self, generation, slice_index):
+        if self.fd is None:
+            if self.valid_size is None:
+                self.get_last_slice_index(generation)
+            self.fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT, 0o600)
+            # drop what a crash left after the last valid record
+            os.ftruncate(self.fd, self.valid_size)
+            os.lseek(self.fd, self.valid_size, os.SEEK_SET)
+        os.write(self.fd, self.pack_record(generation, slice_index))
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(self.fd)
+        else:
+            os.fsync(self.fd)
+        self.valid_size += ProgressJournal.record_size
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def reset(self):
+        """
+        compacts the journal to nothing, once its progress is in the ongoing item config
+        """
+        self.close()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.valid_size = 0
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# VMEncryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from Common import CommonVariables
+from CopyEngine import CopyEngine
+
+
+class SliceSizeTuner(object):
+    """
+    Picks the block size of the slices of a TransactionalCopyTask.
+    A slice is held in memory while it is copied, in the buffer of the copy engine or in the tmpfs slice file,
+    so it is kept under a 1/memory_fraction of the available memory and under the tmpfs size.
+    The block size is doubled while the throughput of samples_per_block_size slices keeps improving by
+    throughput_improvement, goes back to the best one once it does not, and is halved under memory pressure.
+    Block sizes only ever double or halve, so the copied range always ends on a slice of the new size soon.
+    """
+    memory_fraction = 4
+    samples_per_block_size = 3
+    throughput_improvement = 1.1
+
+    def __init__(self, logger, memory_info_path='/proc/meminfo'):
+        self.logger = logger
+        self.memory_info_path = memory_info_path
+        self.min_block_size = CommonVariables.min_block_size
+        self.max_block_size = CommonVariables.max_block_size
+        self.tmpfs_size = None
+        self.growing = True
+        self.best_throughput = None
+        self.best_block_size = None
+        self.sample_block_size = None
+        self.sample_size = 0
+        self.sample_time = 0.0
+        self.sample_count = 0
+
+    def get_available_memory(self):
+        """
+        returns the bytes of memory available without swapping, None if they are not known
+        """
+        memory_info = {}
+        try:
+            with open(self.memory_info_path, 'r') as memory_info_file:
+                for line in memory_info_file:
+                    fields = line.split()
+                    if len(fields) >= 2 and fields[1].isdigit():
+                        memory_info[fields[0].rstrip(':')] = int(fields[1]) * 1024
+        except IOError as e:
+            self.logger.log("failed to read {0}: {1}".format(self.memory_info_path, e))
+            return None
+        if 'MemAvailable' in memory_info:
+            return memory_info['MemAvailable']
+        # kernels before 3.14 do not estimate it
+        if 'MemFree' in memory_info:
+            return memory_info['MemFree'] + memory_info.get('Buffers', 0) + memory_info.get('Cached', 0)
+        return None
+
+    def get_block_size_limit(self, block_size_in_use):
+        """
+        block_size_in_use is the memory the copy holds already, it is not available but may be used again
+        """
+        block_size_limit = self.max_block_size
+        available_memory = self.get_available_memory()
+        if available_memory is not None:
+            block_size_limit = min(block_size_limit, (available_memory + block_size_in_use) // SliceSizeTuner.memory_fraction)
+        if self.tmpfs_size is not None:
+            block_size_limit = min(block_size_limit, self.tmpfs_size)
+        return block_size_limit
+
+    def can_halve(self, block_size):
+        half_block_size = block_size // 2
+        return half_block_size >= self.min_block_size and half_block_size % CopyEngine.direct_io_alignment == 0
+
+    def get_initial_block_size(self, block_size):
+        block_size_limit = self.get_block_size_limit(0)
+        while block_size > block_size_limit and self.can_halve(block_size):
+            block_size //= 2
+        return block_size
+
+    def add_sample(self, block_size, copied_size, elapsed):
+        """
+        records the copy of a slice of block_size, returns the block size of the next slices
+        """
+        if block_size != self.sample_block_size:
+            self.sample_block_size = block_size
+            self.sample_size = 0
+            self.sample_time = 0.0
+            self.sample_count = 0
+        self.sample_size += copied_size
+        self.sample_time += elapsed
+        self.sample_count += 1
+
+        block_size_limit = self.get_block_size_limit(block_size)
+        if block_size > block_size_limit and self.can_halve(block_size):
+            self.logger.log(msg="memory pressure, slices of {0} bytes are above the limit of {1}".format(block_size, block_size_limit),
+                            level=CommonVariables.WarningLevel)
+            self.growing = False
+            return block_size // 2
+
+        if not self.growing or self.sample_count < SliceSizeTuner.samples_per_block_size:
+            return block_size
+
+        throughput = self.sample_size / max(self.sample_time, 0.001)
+        self.logger.log("slices of {0} bytes copied at {1:.1f} MB/s".format(block_size, throughput / (1024 * 1024)))
+        if self.best_throughput is None or throughput > self.best_throughput * SliceSizeTuner.throughput_improvement:
+            self.best_throughput = throughput
+            self.best_block_size = block_size
+            if block_size * 2 <= block_size_limit:
+                return block_size * 2
+            self.growing = False
+            return block_size
+
+        # the bigger slices are no faster
+        self.growing = False
+        return self.best_block_size
@@ -21,8 +21,11 @@ import os
 import os.path
 import sys
 import shlex
+import struct
+import time
 from subprocess import *
 from CommandExecutor import CommandExecutor
+from CopyEngine import CopyEngine
 from Common import CommonVariables
 from ConfigUtil import ConfigUtil
 from OnGoingItemConfig import *
@@ -32,8 +35,22 @@ class TransactionalCopyTask(object):
     """
     copy_total_size is in byte, skip_target_size is also in byte
     slice_size is in byte 50M
+    each slice is read once into memory, written to the slice item backup file, which is complete and flushed
+    before the destination is written, and then to the destination. the backup file is removed once the next
+    slice index is committed, so a crash at any point is recovered by resume_copy.
+    the backup file starts with a header holding the offset and size of its slice, resume_copy replays it only
+    onto that slice: after a crash between the commit and the removal it is the backup of the slice before.
+    use_dd copies through a tmpfs slice file with dd processes instead, as before the in-process copy engine.
+    max_bytes_per_second is the IO budget of the copy, devices encrypted in parallel each get their own.
+    With a slice_size_tuner the block size changes between slices, the new one is committed with the
+    slice index rebased to it.
     """
-    def __init__(self, logger, hutil, disk_util, ongoing_item_config, patching, encryption_environment, status_prefix=''):
+    backup_header_format = '<8sQQ'
+    backup_header_magic = b'ADESLICE'
+    # the slice follows the header aligned, so it can be written with O_DIRECT
+    backup_header_size = CopyEngine.direct_io_alignment
+
+    def __init__(self, logger, hutil, disk_util, ongoing_item_config, patching, encryption_environment, status_prefix='', use_dd=False, use_direct_io=False, max_bytes_per_second=None, slice_size_tuner=None):
         """
         copy_total_size is in bytes.
         """
@@ -59,8 +76,110 @@ class TransactionalCopyTask(object):
         self.tmpfs_mount_point = "/mnt/azure_encrypt_tmpfs"
         self.slice_file_path = self.tmpfs_mount_point + "/slice_file"
         self.copy_command = self.patching.dd_path
+        self.last_status_report_time = None
+        self.max_bytes_per_second = max_bytes_per_second
+        self.throttle_start_time = None
+        self.throttled_size = 0
+        self.slice_size_tuner = slice_size_tuner
+        self.pending_block_size = None
+        if use_dd:
+            self.copy_engine = None
+        else:
+            self.copy_engine = CopyEngine(logger, use_direct_io=use_direct_io)
+
+    def remove_slice_item_backup_file(self):
+        if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
+            self.logger.log(msg = "clean up the backup file")
+            os.remove(self.encryption_environment.copy_slice_item_backup_file)
+
+    def report_progress(self):
+        """
+        a slice takes well under a second on fast disks, the status is reported every
+        copy_status_report_interval seconds and when the copy is done
+        """
+        if not self.status_prefix:
+            return
+        now = time.time()
+        if self.current_slice_index < self.total_slice_size and self.last_status_report_time is not None \
+                and now - self.last_status_report_time < CommonVariables.copy_status_report_interval:
+            return
+        self.last_status_report_time = now
+        msg = self.status_prefix + ': ' \
+            + str(int(self.current_slice_index / (float)(self.total_slice_size) * 100.0)) \
+            + '%'
+
+        self.hutil.do_status_report(operation='DataCopy',
+                                    status=CommonVariables.extension_success_status,
+                                    status_code=str(CommonVariables.success),
+                                    message=msg)
+
+    def throttle(self, copied_size):
+        """
+        sleeps while the copy is ahead of max_bytes_per_second
+        """
+        if not self.max_bytes_per_second:
+            return
+        if self.throttle_start_time is None:
+            self.throttle_start_time = time.time()
+        self.throttled_size += copied_size
+        delay = self.throttle_start_time + float(self.throttled_size) / self.max_bytes_per_second - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def resize_slices(self, block_size):
+        """
+        continues the copy with slices of block_size, the slice index is rebased so the copied range stays the same.
+        returns False if the copied range does not end on a slice of block_size.
+        """
+        if self.from_end.lower() == 'true':
+            if self.current_slice_index == 0:
+                return False
+            # the slices before the copied range are not touched yet
+            copied_range_offset = (self.total_slice_size - self.current_slice_index) * self.block_size
+        else:
+            copied_range_offset = self.current_slice_index * self.block_size
+        if copied_range_offset % block_size != 0:
+            return False
+
+        last_slice_size = self.total_size % block_size
+        total_slice_size = ((self.total_size - last_slice_size) // block_size) + 1
+        if self.from_end.lower() == 'true':
+            current_slice_index = total_slice_size - copied_range_offset // block_size
+        else:
+            current_slice_index = copied_range_offset // block_size
+
+        self.logger.log("slices of {0} bytes instead of {1}, slice index {2} instead of {3}".format(block_size, self.block_size, current_slice_index, self.current_slice_index))
+        if self.copy_engine is not None and block_size < self.block_size:
+            # give the memory back
+            self.copy_engine.release()
+        self.block_size = block_size
+        self.last_slice_size = last_slice_size
+        self.total_slice_size = total_slice_size
+        self.current_slice_index = current_slice_index
+        self.ongoing_item_config.current_block_size = block_size
+        self.ongoing_item_config.current_slice_index = current_slice_index
+        self.ongoing_item_config.commit()
+        return True
+
+    def tune_slice_size(self, copied_size, elapsed):
+        if self.slice_size_tuner is None:
+            return
+        if self.pending_block_size is None:
+            block_size = self.slice_size_tuner.add_sample(self.block_size, copied_size, elapsed)
+            if block_size != self.block_size:
+                self.pending_block_size = block_size
+        # a bigger block size may have to wait for the next slice
+        if self.pending_block_size is not None and self.resize_slices(self.pending_block_size):
+            self.pending_block_size = None
+
+    def commit_slice_index(self):
+        self.ongoing_item_config.commit_slice_index(self.current_slice_index)
+        # only now the slice is never copied again, its backup is not needed any more
+        self.remove_slice_item_backup_file()
 
     def resume_copy_internal(self, copy_slice_item_backup_file_size, skip_block, original_total_copy_size):
+        if self.copy_engine is not None:
+            return self.resume_copy_engine(copy_slice_item_backup_file_size, skip_block, original_total_copy_size)
         block_size_of_slice_item_backup = 512
         #copy the left slice
         if copy_slice_item_backup_file_size <= original_total_copy_size:
@@ -93,16 +212,80 @@ class TransactionalCopyTask(object):
                 return return_code
             else:
                 self.current_slice_index += 1
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
-                if os.path.exists(self.encryption_environment.copy_slice_item_backup_file):
-                    os.remove(self.encryption_environment.copy_slice_item_backup_file)
+                self.commit_slice_index()
                 return return_code
         else:
             self.logger.log(msg="copy_slice_item_backup_file_size is bigger than original_total_copy_size",
                             level=CommonVariables.ErrorLevel)
             return CommonVariables.backup_slice_file_error
 
+    def write_slice_item_backup_file(self, offset, length):
+        """
+        replaces the backup file with the header and length bytes of the slice at offset, which follow it in the buffer
+        """
+        struct.pack_into(TransactionalCopyTask.backup_header_format, self.copy_engine.buffer, 0,
+                         TransactionalCopyTask.backup_header_magic, offset, length)
+        self.copy_engine.write_file(self.encryption_environment.copy_slice_item_backup_file,
+                                    TransactionalCopyTask.backup_header_size + length)
+
+    def read_slice_item_backup_header(self, copy_slice_item_backup_file_size):
+        """
+        returns (offset, length) of the slice in the backup file, None if it has no header because dd wrote it
+        """
+        if copy_slice_item_backup_file_size < TransactionalCopyTask.backup_header_size:
+            return None
+        self.copy_engine.read(self.encryption_environment.copy_slice_item_backup_file, 0, TransactionalCopyTask.backup_header_size)
+        magic, offset, length = struct.unpack_from(TransactionalCopyTask.backup_header_format, self.copy_engine.buffer, 0)
+        if magic != TransactionalCopyTask.backup_header_magic:
+            return None
+        return offset, length
+
+    def resume_copy_engine(self, copy_slice_item_backup_file_size, skip_block, original_total_copy_size):
+        """
+        the backup file of the copy engine is always complete, the destination may be partly written.
+        a backup file of another slice is discarded, that slice is copied and its slice index committed.
+        one without header was left by dd, the source of the rest of the slice was not overwritten yet,
+        it is completed and given a header before the destination is written.
+        """
+        offset = self.block_size * skip_block
+        header_size = TransactionalCopyTask.backup_header_size
+        backup_file = self.encryption_environment.copy_slice_item_backup_file
+        try:
+            header = self.read_slice_item_backup_header(copy_slice_item_backup_file_size)
+            if header is not None:
+                backup_offset, length = header
+                if backup_offset != offset:
+                    self.logger.log(msg="the slice item backup file is of the slice at {0}, not of the slice at {1}, discarding it".format(backup_offset, offset),
+                                    level=CommonVariables.WarningLevel)
+                    self.remove_slice_item_backup_file()
+                    return CommonVariables.process_success
+                if length > original_total_copy_size or copy_slice_item_backup_file_size != header_size + length:
+                    self.logger.log(msg="the slice item backup file holds {0} bytes for a {1} bytes slice of {2} bytes".format(copy_slice_item_backup_file_size - header_size, length, original_total_copy_size),
+                                    level=CommonVariables.ErrorLevel)
+                    return CommonVariables.backup_slice_file_error
+                self.copy_engine.read(backup_file, header_size, length, buffer_offset=header_size)
+            else:
+                if copy_slice_item_backup_file_size > original_total_copy_size:
+                    self.logger.log(msg="copy_slice_item_backup_file_size is bigger than original_total_copy_size",
+                                    level=CommonVariables.ErrorLevel)
+                    return CommonVariables.backup_slice_file_error
+                length = original_total_copy_size
+                self.copy_engine.read(backup_file, 0, copy_slice_item_backup_file_size, buffer_offset=header_size)
+                if copy_slice_item_backup_file_size < length:
+                    self.copy_engine.read(self.source_dev_full_path,
+                                          offset + copy_slice_item_backup_file_size,
+                                          length - copy_slice_item_backup_file_size,
+                                          buffer_offset=header_size + copy_slice_item_backup_file_size)
+                self.write_slice_item_backup_file(offset, length)
+            self.copy_engine.write(self.destination, offset, length, header_size)
+        except (IOError, OSError) as e:
+            self.logger.log(msg="failed to resume the slice at {0} from the backup file: {1}".format(offset, e),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
+        self.current_slice_index += 1
+        self.commit_slice_index()
+        return CommonVariables.process_success
+
     def resume_copy(self):
         if self.from_end.lower() == 'true':
             skip_block = (self.total_slice_size - self.current_slice_index - 1)
@@ -150,10 +333,16 @@ class TransactionalCopyTask(object):
         """
         check the device_item size first, cut it
         """
+        self.throttle_start_time = time.time()
         self.resume_copy()
+        if self.slice_size_tuner is not None:
+            block_size = self.slice_size_tuner.get_initial_block_size(self.block_size)
+            if block_size != self.block_size and not self.resize_slices(block_size):
+                self.pending_block_size = block_size
         if self.from_end.lower() == 'true':
             while self.current_slice_index < self.total_slice_size:
                 skip_block = (self.total_slice_size - self.current_slice_index - 1)
+                copied_size = 0
 
                 if self.current_slice_index == 0:
                     if self.last_slice_size > 0:
@@ -163,6 +352,7 @@ class TransactionalCopyTask(object):
                     else:
                         self.logger.log(msg = "the last slice size is zero, so skip the 0 index.")
                 else:
+                    slice_start_time = time.time()
                     copy_result = self.copy_internal(from_device=self.source_dev_full_path,
                                                      to_device=self.destination,
                                                      skip=skip_block,
@@ -171,26 +361,19 @@ class TransactionalCopyTask(object):
 
                     if copy_result != CommonVariables.process_success:
                         return copy_result
+                    copied_size = self.block_size
 
                 self.current_slice_index += 1
-
-                if self.status_prefix:
-                    msg = self.status_prefix + ': ' \
-                        + str(int(self.current_slice_index / (float)(self.total_slice_size) * 100.0)) \
-                        + '%'
-
-                    self.hutil.do_status_report(operation='DataCopy',
-                                                status=CommonVariables.extension_success_status,
-                                                status_code=str(CommonVariables.success),
-                                                message=msg)
-
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
+                self.commit_slice_index()
+                self.report_progress()
+                if copied_size:
+                    self.tune_slice_size(copied_size, time.time() - slice_start_time)
 
             return CommonVariables.process_success
         else:
             while self.current_slice_index < self.total_slice_size:
                 skip_block = self.current_slice_index
+                copied_size = 0
 
                 if self.current_slice_index == (self.total_slice_size - 1):
                     if self.last_slice_size > 0:
@@ -200,6 +383,7 @@ class TransactionalCopyTask(object):
                     else:
                         self.logger.log(msg = "the last slice size is zero, so skip the last slice index.")
                 else:
+                    slice_start_time = time.time()
                     copy_result = self.copy_internal(from_device=self.source_dev_full_path,
                                                      to_device=self.destination,
                                                      skip=skip_block,
@@ -208,32 +392,48 @@ class TransactionalCopyTask(object):
 
                     if copy_result != CommonVariables.process_success:
                         return copy_result
+                    copied_size = self.block_size
 
                 self.current_slice_index += 1
+                self.commit_slice_index()
+                self.report_progress()
+                if copied_size:
+                    self.tune_slice_size(copied_size, time.time() - slice_start_time)
+            return CommonVariables.process_success
 
-                if self.status_prefix:
-                    msg = self.status_prefix + ': ' \
-                        + str(int(self.current_slice_index / (float)(self.total_slice_size) * 100.0)) \
-                        + '%'
-
-                    self.hutil.do_status_report(operation='DataCopy',
-                                                status=CommonVariables.extension_success_status,
-                                                status_code=str(CommonVariables.success),
-                                                message=msg)
-
-                self.hutil.do_status_report(operation='DataCopy',
-                                            status=CommonVariables.extension_success_status,
-                                            status_code=str(CommonVariables.success),
-                                            message=msg)
+    def copy_internal(self, from_device, to_device,  block_size, skip=0, seek=0, count=1):
+        if self.copy_engine is None:
+            copy_result = self.copy_internal_dd(from_device, to_device, block_size, skip, seek, count)
+        else:
+            copy_result = self.copy_internal_engine(from_device, to_device, block_size, skip, seek, count)
+        if copy_result == CommonVariables.process_success:
+            self.throttle(block_size * count)
+        return copy_result
 
-                self.ongoing_item_config.current_slice_index = self.current_slice_index
-                self.ongoing_item_config.commit()
-            return CommonVariables.process_success
+    def copy_internal_engine(self, from_device, to_device, block_size, skip, seek, count):
+        """
+        the slice is read once into memory after the backup header, the backup file is written and flushed
+        before the target device is touched. the backup file stays until commit_slice_index.
+        """
+        length = block_size * count
+        header_size = TransactionalCopyTask.backup_header_size
+        try:
+            read_size = self.copy_engine.read(from_device, skip * block_size, length, buffer_offset=header_size)
+            if read_size != length:
+                self.logger.log(msg="read {0} bytes of the {1} bytes slice at {2} of {3}".format(read_size, length, skip * block_size, from_device),
+                                level=CommonVariables.WarningLevel)
+            self.write_slice_item_backup_file(seek * block_size, read_size)
+            self.copy_engine.write(to_device, seek * block_size, read_size, header_size)
+        except (IOError, OSError) as e:
+            self.logger.log(msg="failed to copy the slice at {0} of {1} to {2}: {3}".format(skip * block_size, from_device, to_device, e),
+                            level=CommonVariables.ErrorLevel)
+            return CommonVariables.copy_data_error
+        return CommonVariables.process_success
 
     """
     TODO: if the copy failed?
     """
-    def copy_internal(self, from_device, to_device,  block_size, skip=0, seek=0, count=1):
+    def copy_internal_dd(self, from_device, to_device,  block_size, skip=0, seek=0, count=1):
         """
         first, copy the data to the middle cache
         """
@@ -282,13 +482,24 @@ class TransactionalCopyTask(object):
             return return_code
 
     def prepare_mem_fs(self):
+        if self.copy_engine is not None:
+            # the copy engine keeps the slice in its own buffer
+            return CommonVariables.process_success
         self.disk_util.make_sure_path_exists(self.tmpfs_mount_point)
-        commandToExecute = self.patching.mount_path + " -t tmpfs -o size=" + str(self.block_size + 1024) + " tmpfs " + self.tmpfs_mount_point
+        tmpfs_size = self.block_size
+        if self.slice_size_tuner is not None:
+            # the slices can only grow into the tmpfs mounted now
+            tmpfs_size = max(tmpfs_size, self.slice_size_tuner.get_block_size_limit(0))
+            self.slice_size_tuner.tmpfs_size = tmpfs_size
+        commandToExecute = self.patching.mount_path + " -t tmpfs -o size=" + str(tmpfs_size + 1024) + " tmpfs " + self.tmpfs_mount_point
         self.logger.log("prepare mem fs script is: {0}".format(commandToExecute))
         return_code = self.command_executer.Execute(commandToExecute)
         return return_code
 
     def clear_mem_fs(self):
+        if self.copy_engine is not None:
+            self.copy_engine.release()
+            return CommonVariables.process_success
         commandToExecute = self.patching.umount_path + " " + self.tmpfs_mount_point
         return_code = self.command_executer.Execute(commandToExecute)
         return return_code
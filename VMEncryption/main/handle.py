@@ -17,6 +17,7 @@
 # limitations under the License.
 
 import filecmp
+import functools
 import json
 import os
 import os.path
@@ -25,12 +26,13 @@ import subprocess
 import sys
 import time
 import tempfile
+import threading
 import traceback
 import uuid
 import shutil
 
 from Utils import HandlerUtil
-from Common import CommonVariables, CryptItem
+from Common import CommonVariables, CryptItem, DeviceItem
 from ExtensionParameter import ExtensionParameter
 from DiskUtil import DiskUtil
 from ResourceDiskUtil import ResourceDiskUtil
@@ -43,6 +45,7 @@ from check_util import CheckUtil
 from DecryptionMarkConfig import DecryptionMarkConfig
 from EncryptionMarkConfig import EncryptionMarkConfig
 from EncryptionEnvironment import EncryptionEnvironment
+from EncryptionScheduler import EncryptionScheduler, SynchronizedHandlerUtil
 from OnGoingItemConfig import OnGoingItemConfig
 from ProcessLock import ProcessLock
 from CommandExecutor import CommandExecutor, ProcessCommunicator
@@ -397,15 +400,28 @@ def none_or_empty(obj):
         return False
 
 
+se_linux_toggle_lock = threading.Lock()
+se_linux_disable_count = 0
+
+
 def toggle_se_linux_for_centos7(disable):
+    """
+    data volumes encrypted in parallel each disable se linux while they need it, it is enabled once none does
+    """
+    global se_linux_disable_count
     if DistroPatcher.distro_info[0].lower() == 'centos' and DistroPatcher.distro_info[1].startswith('7.0'):
-        if disable:
-            se_linux_status = encryption_environment.get_se_linux()
-            if se_linux_status.lower() == 'enforcing':
-                encryption_environment.disable_se_linux()
-                return True
-        else:
-            encryption_environment.enable_se_linux()
+        with se_linux_toggle_lock:
+            if disable:
+                se_linux_disable_count += 1
+                if se_linux_disable_count == 1:
+                    se_linux_status = encryption_environment.get_se_linux()
+                    if se_linux_status.lower() == 'enforcing':
+                        encryption_environment.disable_se_linux()
+                        return True
+            else:
+                se_linux_disable_count = max(0, se_linux_disable_count - 1)
+                if se_linux_disable_count == 0:
+                    encryption_environment.enable_se_linux()
     return False
 
 
@@ -483,11 +499,13 @@ def main():
             daemon()
 
 
-def mark_encryption(command, volume_type, disk_format_query):
+def mark_encryption(command, volume_type, disk_format_query, max_parallel_encryptions=None, io_budget=None):
     encryption_marker = EncryptionMarkConfig(logger, encryption_environment)
     encryption_marker.command = command
     encryption_marker.volume_type = volume_type
     encryption_marker.diskFormatQuery = disk_format_query
+    encryption_marker.max_parallel_encryptions = max_parallel_encryptions
+    encryption_marker.io_budget = io_budget
     encryption_marker.commit()
     return encryption_marker
 
@@ -688,7 +706,9 @@ def enable_encryption():
                 logger.log(msg="config file exists and passphrase file exists.", level=CommonVariables.WarningLevel)
                 encryption_marker = mark_encryption(command=extension_parameter.command,
                                                     volume_type=extension_parameter.VolumeType,
-                                                    disk_format_query=extension_parameter.DiskFormatQuery)
+                                                    disk_format_query=extension_parameter.DiskFormatQuery,
+                                                    max_parallel_encryptions=extension_parameter.MaxParallelEncryptions,
+                                                    io_budget=extension_parameter.EncryptionIOBudget)
                 start_daemon('EnableEncryption')
             else:
                 """
@@ -763,7 +783,9 @@ def enable_encryption():
 
                 encryption_marker = mark_encryption(command=extension_parameter.command,
                                                     volume_type=extension_parameter.VolumeType,
-                                                    disk_format_query=extension_parameter.DiskFormatQuery)
+                                                    disk_format_query=extension_parameter.DiskFormatQuery,
+                                                    max_parallel_encryptions=extension_parameter.MaxParallelEncryptions,
+                                                    io_budget=extension_parameter.EncryptionIOBudget)
 
                 if kek_secret_id_created:
                     hutil.do_exit(exit_code=0,
@@ -896,7 +918,7 @@ def encrypt_inplace_without_seperate_header_file(passphrase_file,
     logger.log("encrypt_inplace_without_seperate_header_file")
     current_phase = CommonVariables.EncryptionPhaseBackupHeader
     if ongoing_item_config is None:
-        ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment, logger=logger)
+        ongoing_item_config = OnGoingItemConfig(encryption_environment=disk_util.encryption_environment, logger=logger)
         ongoing_item_config.current_block_size = CommonVariables.default_block_size
         ongoing_item_config.current_slice_index = 0
         ongoing_item_config.device_size = device_item.size
@@ -957,15 +979,15 @@ def encrypt_inplace_without_seperate_header_file(passphrase_file,
             else:
                 ongoing_item_config.current_slice_index = 0
                 ongoing_item_config.current_source_path = original_dev_path
-                ongoing_item_config.current_destination = encryption_environment.copy_header_slice_file_path
+                ongoing_item_config.current_destination = disk_util.encryption_environment.copy_header_slice_file_path
                 ongoing_item_config.current_total_copy_size = CommonVariables.default_block_size
                 ongoing_item_config.from_end = False
-                ongoing_item_config.header_slice_file_path = encryption_environment.copy_header_slice_file_path
+                ongoing_item_config.header_slice_file_path = disk_util.encryption_environment.copy_header_slice_file_path
                 ongoing_item_config.original_dev_path = original_dev_path
                 ongoing_item_config.commit()
-                if os.path.exists(encryption_environment.copy_header_slice_file_path):
+                if os.path.exists(disk_util.encryption_environment.copy_header_slice_file_path):
                     logger.log(msg="the header slice file is there, remove it.", level=CommonVariables.WarningLevel)
-                    os.remove(encryption_environment.copy_header_slice_file_path)
+                    os.remove(disk_util.encryption_environment.copy_header_slice_file_path)
 
                 copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix)
 
@@ -1062,8 +1084,8 @@ def encrypt_inplace_without_seperate_header_file(passphrase_file,
                     logger.log(msg=original_dev_name_path + " is not defined in fstab, no need to update",
                                level=CommonVariables.InfoLevel)
 
-                if os.path.exists(encryption_environment.copy_header_slice_file_path):
-                    os.remove(encryption_environment.copy_header_slice_file_path)
+                if os.path.exists(disk_util.encryption_environment.copy_header_slice_file_path):
+                    os.remove(disk_util.encryption_environment.copy_header_slice_file_path)
 
                 current_phase = CommonVariables.EncryptionPhaseDone
                 ongoing_item_config.phase = current_phase
@@ -1098,7 +1120,7 @@ def encrypt_inplace_with_seperate_header_file(passphrase_file,
     logger.log("encrypt_inplace_with_seperate_header_file")
     current_phase = CommonVariables.EncryptionPhaseEncryptDevice
     if ongoing_item_config is None:
-        ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment,
+        ongoing_item_config = OnGoingItemConfig(encryption_environment=disk_util.encryption_environment,
                                                 logger=logger)
         mapper_name = str(uuid.uuid4())
         ongoing_item_config.current_block_size = CommonVariables.default_block_size
@@ -1424,14 +1446,82 @@ def find_all_devices_to_encrypt(encryption_marker, disk_util, bek_util):
     return device_items_to_encrypt
 
 
-def enable_encryption_all_in_place(passphrase_file, encryption_marker, disk_util, bek_util):
+def encrypt_device_item_in_place(passphrase_file, device_item, disk_util, bek_util, status_prefix, ongoing_item_config=None):
+    """
+    encrypts one data volume, or resumes it if ongoing_item_config is not None.
+    returns False if the encryption failed, a volume that can not be unmounted is skipped.
+    """
+    if ongoing_item_config is None:
+        mount_point = device_item.mount_point
+    else:
+        mount_point = ongoing_item_config.get_mount_point()
+
+    umount_status_code = CommonVariables.success
+    if not none_or_empty(mount_point):
+        umount_status_code = disk_util.umount(mount_point)
+    if umount_status_code != CommonVariables.success:
+        logger.log("error occured when do the umount for: {0} with code: {1}".format(mount_point, umount_status_code))
+        if ongoing_item_config is None:
+            return True
+
+    if ongoing_item_config is None:
+        logger.log(msg=("encrypting: {0}".format(device_item)))
+        no_header_file_support = not_support_header_option_distro(DistroPatcher)
+    else:
+        logger.log(msg=("resuming the encryption of: {0}".format(ongoing_item_config.get_original_dev_name_path())))
+        no_header_file_support = none_or_empty(ongoing_item_config.get_header_file_path())
+
+    # TODO check the file system before encrypting it.
+    if no_header_file_support:
+        logger.log(msg="this is the centos 6 or redhat 6 or sles 11 series, need to resize data drive",
+                   level=CommonVariables.WarningLevel)
+
+        encryption_result_phase = encrypt_inplace_without_seperate_header_file(passphrase_file=passphrase_file,
+                                                                               device_item=device_item,
+                                                                               disk_util=disk_util,
+                                                                               bek_util=bek_util,
+                                                                               status_prefix=status_prefix,
+                                                                               ongoing_item_config=ongoing_item_config)
+    else:
+        encryption_result_phase = encrypt_inplace_with_seperate_header_file(passphrase_file=passphrase_file,
+                                                                            device_item=device_item,
+                                                                            disk_util=disk_util,
+                                                                            bek_util=bek_util,
+                                                                            status_prefix=status_prefix,
+                                                                            ongoing_item_config=ongoing_item_config)
+
+    return encryption_result_phase == CommonVariables.EncryptionPhaseDone
+
+
+def ongoing_items_exist():
+    """
+    a data volume is half encrypted in place while the ongoing item config or one of the devices exists
+    """
+    ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment, logger=logger)
+    return ongoing_item_config.config_file_exists() or len(encryption_environment.get_device_environments()) > 0
+
+
+def enable_encryption_all_in_place(passphrase_file, encryption_marker, disk_util, bek_util, resume_only=False):
     """
     if return None for the success case, or return the device item which failed.
+    the data volumes are encrypted in parallel, each with an ongoing item config of its own that
+    the next daemon run resumes from, volumes of one volume group one after another.
+    with resume_only only the volumes with an ongoing item config are encrypted.
     """
     logger.log(msg="executing the enable_encryption_all_in_place command.")
 
-    device_items_to_encrypt = find_all_devices_to_encrypt(encryption_marker, disk_util, bek_util)
-    msg = 'Encrypting {0} data volumes'.format(len(device_items_to_encrypt))
+    device_environments = encryption_environment.get_device_environments()
+    resumed_device_names = [device_environment.device_name for device_environment in device_environments]
+    if resume_only:
+        device_items_to_encrypt = []
+    else:
+        device_items_to_encrypt = [device_item for device_item in find_all_devices_to_encrypt(encryption_marker, disk_util, bek_util)
+                                   if device_item.name not in resumed_device_names]
+    volume_count = len(device_environments) + len(device_items_to_encrypt)
+    if resume_only:
+        msg = 'Resuming the encryption of {0} data volumes'.format(volume_count)
+    else:
+        msg = 'Encrypting {0} data volumes'.format(volume_count)
     logger.log(msg)
 
     hutil.do_status_report(operation='EnableEncryption',
@@ -1439,40 +1529,40 @@ def enable_encryption_all_in_place(passphrase_file, encryption_marker, disk_util
                            status_code=str(CommonVariables.success),
                            message=msg)
 
-    for device_num, device_item in enumerate(device_items_to_encrypt):
-        umount_status_code = CommonVariables.success
-        if device_item.mount_point is not None and device_item.mount_point != "":
-            umount_status_code = disk_util.umount(device_item.mount_point)
-        if umount_status_code != CommonVariables.success:
-            logger.log("error occured when do the umount for: {0} with code: {1}".format(device_item.mount_point, umount_status_code))
-        else:
-            logger.log(msg=("encrypting: {0}".format(device_item)))
-            no_header_file_support = not_support_header_option_distro(DistroPatcher)
-            status_prefix = "Encrypting data volume {0}/{1}".format(device_num + 1,
-                                                                    len(device_items_to_encrypt))
-
-            # TODO check the file system before encrypting it.
-            if no_header_file_support:
-                logger.log(msg="this is the centos 6 or redhat 6 or sles 11 series, need to resize data drive",
-                           level=CommonVariables.WarningLevel)
-
-                encryption_result_phase = encrypt_inplace_without_seperate_header_file(passphrase_file=passphrase_file,
-                                                                                       device_item=device_item,
-                                                                                       disk_util=disk_util,
-                                                                                       bek_util=bek_util,
-                                                                                       status_prefix=status_prefix)
-            else:
-                encryption_result_phase = encrypt_inplace_with_seperate_header_file(passphrase_file=passphrase_file,
-                                                                                    device_item=device_item,
-                                                                                    disk_util=disk_util,
-                                                                                    bek_util=bek_util,
-                                                                                    status_prefix=status_prefix)
-
-            if encryption_result_phase == CommonVariables.EncryptionPhaseDone:
-                continue
-            else:
-                # do exit to exit from this round
-                return device_item
+    io_budget = encryption_marker.get_io_budget()
+    status_hutil = SynchronizedHandlerUtil(hutil)
+    pv_vg_names = disk_util.get_pv_vg_names()
+    scheduler = EncryptionScheduler(logger, encryption_marker.get_max_parallel_encryptions())
+
+    for device_environment in device_environments:
+        ongoing_item_config = OnGoingItemConfig(encryption_environment=device_environment, logger=logger)
+        ongoing_item_config.load_value_from_file()
+        device_item = DeviceItem()
+        device_item.name = device_environment.device_name
+        device_disk_util = DiskUtil(hutil=status_hutil, patching=DistroPatcher, logger=logger,
+                                    encryption_environment=device_environment, io_budget=io_budget)
+        status_prefix = "Resuming encryption of data volume {0}/{1}".format(len(scheduler.jobs) + 1, volume_count)
+        scheduler.add_job(name=device_item.name,
+                          lock_keys=disk_util.get_device_lock_keys(device_item, pv_vg_names),
+                          target=functools.partial(encrypt_device_item_in_place, passphrase_file, device_item,
+                                                   device_disk_util, bek_util, status_prefix, ongoing_item_config),
+                          item=device_item)
+
+    for device_item in device_items_to_encrypt:
+        device_disk_util = DiskUtil(hutil=status_hutil, patching=DistroPatcher, logger=logger,
+                                    encryption_environment=encryption_environment.get_device_environment(device_item.name),
+                                    io_budget=io_budget)
+        status_prefix = "Encrypting data volume {0}/{1}".format(len(scheduler.jobs) + 1, volume_count)
+        scheduler.add_job(name=device_item.name,
+                          lock_keys=disk_util.get_device_lock_keys(device_item, pv_vg_names),
+                          target=functools.partial(encrypt_device_item_in_place, passphrase_file, device_item,
+                                                   device_disk_util, bek_util, status_prefix),
+                          item=device_item)
+
+    failed_job = scheduler.run()
+    if failed_job is not None:
+        # do exit to exit from this round
+        return failed_job.item
     return None
 
 
@@ -1787,6 +1877,17 @@ def daemon_encrypt_data_volumes(encryption_marker, encryption_config, disk_util,
             logger.log("OngoingItemConfig does not exist")
             failed_item = None
 
+            # volumes left half encrypted in place are resumed first, whatever command is marked now
+            if len(encryption_environment.get_device_environments()) > 0:
+                failed_item = enable_encryption_all_in_place(passphrase_file=bek_passphrase_file,
+                                                             encryption_marker=encryption_marker,
+                                                             disk_util=disk_util,
+                                                             bek_util=bek_util,
+                                                             resume_only=True)
+                if failed_item:
+                    message = 'EnableEncryption: resuming encryption for {0} failed'.format(failed_item)
+                    raise Exception(message)
+
             if not encryption_marker.config_file_exists():
                 logger.log("Data volumes are not marked for encryption")
                 return True
@@ -1843,9 +1944,7 @@ def daemon_decrypt():
 
     # at this point all the /dev/mapper/* crypt devices should be open
 
-    ongoing_item_config = OnGoingItemConfig(encryption_environment=encryption_environment, logger=logger)
-
-    if ongoing_item_config.config_file_exists():
+    if ongoing_items_exist():
         logger.log("ongoing item config exists.")
     else:
         logger.log("ongoing item config does not exist.")
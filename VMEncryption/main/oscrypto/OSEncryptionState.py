@@ -30,6 +30,7 @@ from CommandExecutor import *
 from BekUtil import *
 from DiskUtil import *
 from EncryptionConfig import *
+from BlockDeviceCopier import *
 
 class OSEncryptionState(object):
     def __init__(self, state_name, context):
@@ -161,6 +162,17 @@ class OSEncryptionState(object):
         if matches:
             return matches[0]
 
+    def _get_block_device_copier(self, sparse=True):
+        self.disk_util.make_sure_path_exists(self.context.encryption_environment.os_encryption_markers_path)
+
+        return BlockDeviceCopier(logger=self.context.logger,
+                                 hutil=self.context.hutil,
+                                 source=self.rootfs_block_device,
+                                 destination='/dev/mapper/osencrypt',
+                                 total_size=self._get_block_device_size(self.rootfs_block_device),
+                                 state_path=self.state_marker,
+                                 sparse=sparse)
+
     def _get_block_device_size(self, dev):
         if not os.path.exists(dev):
             return 0
@@ -50,15 +50,22 @@ class EncryptBlockDeviceState(OSEncryptionState):
         self.command_executor.Execute('service udev restart', False)
 
         # self._find_bek_and_execute_action('_dump_passphrase')
-        self._find_bek_and_execute_action('_luks_format')
-        self._find_bek_and_execute_action('_luks_open')
+        copier = self._get_block_device_copier()
+        if copier.has_checkpoint():
+            self.context.logger.log("Resuming the encryption of {0} from its checkpoint".format(self.rootfs_block_device))
+            if not os.path.exists('/dev/mapper/osencrypt'):
+                self._find_bek_and_execute_action('_luks_open')
+        else:
+            self._find_bek_and_execute_action('_luks_format')
+            self._find_bek_and_execute_action('_luks_open')
 
         self.context.hutil.do_status_report(operation='EnableEncryptionDataVolumes',
                                             status=CommonVariables.extension_success_status,
                                             status_code=str(CommonVariables.success),
                                             message='OS disk encryption started')
 
-        self.command_executor.Execute('dd if={0} of=/dev/mapper/osencrypt conv=sparse bs=64K'.format(self.rootfs_block_device), True)
+        if copier.copy() != CommonVariables.process_success:
+            raise Exception("Failed to copy {0} to /dev/mapper/osencrypt".format(self.rootfs_block_device))
 
     def should_exit(self):
         self.context.logger.log("Verifying if machine should exit encrypt_block_device state")
@@ -69,7 +76,11 @@ class EncryptBlockDeviceState(OSEncryptionState):
         self.command_executor.Execute('mount /dev/mapper/osencrypt /oldroot', True)
         self.command_executor.Execute('umount /oldroot', True)
 
-        return super(EncryptBlockDeviceState, self).should_exit()
+        state_executed = super(EncryptBlockDeviceState, self).should_exit()
+
+        self._get_block_device_copier().clear()
+
+        return state_executed
 
     def _luks_format(self, bek_path):
         self.command_executor.Execute('rm -rf /boot/luks', True)
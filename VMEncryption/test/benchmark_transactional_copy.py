@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+"""
+Throughput of TransactionalCopyTask.begin_copy between two loop devices, for the dd processes through a tmpfs
+slice file and for the in-process copy engine, with and without O_DIRECT. Needs root for losetup, with --files
+plain files are used instead. The destination is compared with the source after every run.
+
+To run (from the VMEncryption folder):
+python test/benchmark_transactional_copy.py --size-mb 1024 --slice-mb 50
+"""
+
+import hashlib
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+
+from Common import CommonVariables
+from TransactionalCopyTask import TransactionalCopyTask
+
+
+class StubLogger(object):
+    def log(self, msg, level='Info'):
+        if level == CommonVariables.ErrorLevel:
+            print(msg)
+
+
+class StubHandlerUtil(object):
+    def do_status_report(self, operation, status, status_code, message):
+        pass
+
+
+class StubOnGoingItemConfig(object):
+    def __init__(self, source, destination, total_size, block_size):
+        self.source = source
+        self.destination = destination
+        self.total_size = total_size
+        self.block_size = block_size
+        self.current_slice_index = 0
+
+    def get_current_total_copy_size(self):
+        return self.total_size
+
+    def get_current_block_size(self):
+        return self.block_size
+
+    def get_current_source_path(self):
+        return self.source
+
+    def get_current_destination(self):
+        return self.destination
+
+    def get_current_slice_index(self):
+        return 0
+
+    def get_from_end(self):
+        return 'True'
+
+    def commit(self):
+        pass
+
+    def commit_slice_index(self, slice_index):
+        self.current_slice_index = slice_index
+
+
+class StubPatching(object):
+    dd_path = 'dd'
+
+
+class StubEncryptionEnvironment(object):
+    def __init__(self, folder):
+        self.copy_slice_item_backup_file = os.path.join(folder, 'copy_slice_item.bak')
+
+
+def attach(path, use_files):
+    if use_files:
+        return path
+    return subprocess.check_output(['losetup', '-f', '--show', path]).decode('utf-8').strip()
+
+
+def detach(device, use_files):
+    if not use_files:
+        subprocess.call(['losetup', '-d', device])
+
+
+def get_hash(path, size):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        left = size
+        while left > 0:
+            data = f.read(min(left, 4 * 1024 * 1024))
+            if not data:
+                break
+            digest.update(data)
+            left -= len(data)
+    return digest.hexdigest()
+
+
+def drop_caches():
+    try:
+        subprocess.call(['sync'])
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3')
+    except (IOError, OSError):
+        pass
+
+
+def run(name, source, destination, size, block_size, folder, slice_folder):
+    use_dd = name == 'dd'
+    copy_task = TransactionalCopyTask(StubLogger(), StubHandlerUtil(), None,
+                                      StubOnGoingItemConfig(source, destination, size, block_size),
+                                      StubPatching(), StubEncryptionEnvironment(folder),
+                                      use_dd=use_dd, use_direct_io=(name == 'engine+odirect'))
+    # the dd path writes its slice file to a tmpfs folder instead of mounting one
+    copy_task.slice_file_path = os.path.join(slice_folder, 'slice_file')
+    drop_caches()
+    start = time.time()
+    result = copy_task.begin_copy()
+    elapsed = time.time() - start
+    if copy_task.copy_engine is not None:
+        copy_task.clear_mem_fs()
+    return result, elapsed
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--size-mb', type='int', default=512)
+    parser.add_option('--slice-mb', type='int', default=CommonVariables.default_block_size // (1024 * 1024))
+    parser.add_option('--iterations', type='int', default=2)
+    parser.add_option('--folder', default=None, help='folder of the backing files and the slice backup file')
+    parser.add_option('--files', action='store_true', default=False, help='plain files instead of loop devices')
+    options, args = parser.parse_args()
+
+    size = options.size_mb * 1024 * 1024
+    block_size = options.slice_mb * 1024 * 1024
+    folder = tempfile.mkdtemp(dir=options.folder)
+    slice_folder = tempfile.mkdtemp(dir='/dev/shm')
+    source_file = os.path.join(folder, 'source.img')
+    destination_file = os.path.join(folder, 'destination.img')
+    subprocess.check_call(['dd', 'if=/dev/urandom', 'of=' + source_file, 'bs=1M', 'count=' + str(options.size_mb)],
+                          stderr=open(os.devnull, 'w'))
+    subprocess.check_call(['truncate', '-s', str(size), destination_file])
+    source = attach(source_file, options.files)
+    destination = attach(destination_file, options.files)
+    source_hash = get_hash(source, size)
+    try:
+        print('size={0}MB slice={1}MB source={2} destination={3}'.format(options.size_mb, options.slice_mb, source, destination))
+        print('{0:<16} {1:>10} {2:>10} {3:>8}'.format('path', 'seconds', 'MB/s', 'same'))
+        for name in ['dd', 'engine', 'engine+odirect']:
+            for i in range(options.iterations):
+                subprocess.check_call(['dd', 'if=/dev/zero', 'of=' + destination, 'bs=1M', 'count=' + str(options.size_mb), 'conv=notrunc'],
+                                      stderr=open(os.devnull, 'w'))
+                result, elapsed = run(name, source, destination, size, block_size, folder, slice_folder)
+                same = result == CommonVariables.process_success and get_hash(destination, size) == source_hash
+                print('{0:<16} {1:>10.2f} {2:>10.1f} {3:>8}'.format(name, elapsed, options.size_mb / elapsed, str(same)))
+    finally:
+        detach(source, options.files)
+        detach(destination, options.files)
+        shutil.rmtree(folder)
+        shutil.rmtree(slice_folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+""" Unit tests for the BlockDeviceCopier module """
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+try:
+    import unittest.mock as mock # python 3+
+except ImportError:
+    import mock # python 2
+
+from main.Common import CommonVariables
+from main.BlockDeviceCopier import BlockDeviceCopier
+from console_logger import ConsoleLogger
+
+
+class TestBlockDeviceCopier(unittest.TestCase):
+    chunk_size = 16384
+
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.hutil = mock.MagicMock()
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'rootfs')
+        self.destination = os.path.join(self.folder, 'osencrypt')
+        self.state_path = os.path.join(self.folder, 'EncryptBlockDeviceState')
+        chunk_patcher = mock.patch.object(BlockDeviceCopier, 'chunk_size', TestBlockDeviceCopier.chunk_size)
+        chunk_patcher.start()
+        self.addCleanup(chunk_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_file(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read_file(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def get_copier(self, total_size, sparse=True):
+        return BlockDeviceCopier(self.logger, self.hutil, self.source, self.destination, total_size,
+                                 self.state_path, sparse=sparse, use_direct_io=False)
+
+    def test_copy(self):
+        data = os.urandom(3 * TestBlockDeviceCopier.chunk_size + 1000)
+        self.write_file(self.source, data)
+        self.write_file(self.destination, b'\xff' * len(data))
+
+        copier = self.get_copier(len(data))
+        self.assertFalse(copier.has_checkpoint())
+        self.assertEqual(CommonVariables.process_success, copier.copy())
+
+        self.assertEqual(data, self.read_file(self.destination))
+        self.assertTrue(copier.has_checkpoint())
+        self.assertEqual('{0} {1} {0}'.format(len(data), len(data)), self.read_file(copier.checkpoint_path).decode('utf-8').strip())
+        self.assertTrue(self.hutil.do_status_report.called)
+        self.assertIn('100%', self.hutil.do_status_report.call_args[1]['message'])
+
+        copier.clear()
+        self.assertFalse(copier.has_checkpoint())
+
+    def test_zero_chunks_skipped_when_sparse(self):
+        chunk_size = TestBlockDeviceCopier.chunk_size
+        data = os.urandom(chunk_size) + b'\0' * chunk_size + os.urandom(chunk_size)
+        self.write_file(self.source, data)
+        self.write_file(self.destination, b'\xff' * len(data))
+
+        copier = self.get_copier(len(data))
+        self.assertEqual(CommonVariables.process_success, copier.copy())
+
+        copied = self.read_file(self.destination)
+        self.assertEqual(data[:chunk_size], copied[:chunk_size])
+        self.assertEqual(b'\xff' * chunk_size, copied[chunk_size:2 * chunk_size])
+        self.assertEqual(data[2 * chunk_size:], copied[2 * chunk_size:])
+        self.assertEqual(2 * chunk_size, copier.written_size)
+
+        self.write_file(self.destination, b'\xff' * len(data))
+        copier.clear()
+        self.assertEqual(CommonVariables.process_success, self.get_copier(len(data), sparse=False).copy())
+        self.assertEqual(data, self.read_file(self.destination))
+
+    def test_resume_writes_the_backup_chunk_again(self):
+        chunk_size = TestBlockDeviceCopier.chunk_size
+        data = os.urandom(4 * chunk_size)
+        self.write_file(self.source, data)
+        self.write_file(self.destination, b'\xff' * len(data))
+        # crashed while writing the second chunk: checkpointed after the first one, the second one is backed up
+        # and the source at the second chunk was already overwritten
+        self.write_file(self.destination, data[:chunk_size] + b'\xff' * (len(data) - chunk_size))
+        self.write_file(self.state_path + '.checkpoint', '{0} {0} {1}\n'.format(chunk_size, len(data)).encode('utf-8'))
+        self.write_file(self.state_path + '.chunk',
+                        struct.pack(BlockDeviceCopier.header_format, chunk_size, chunk_size).ljust(BlockDeviceCopier.header_size, b'\0') +
+                        data[chunk_size:2 * chunk_size])
+        with open(self.source, 'r+b') as source_file:
+            source_file.seek(chunk_size)
+            source_file.write(b'\xee' * chunk_size)
+
+        copier = self.get_copier(len(data))
+        self.assertTrue(copier.has_checkpoint())
+        self.assertEqual(CommonVariables.process_success, copier.copy())
+
+        self.assertEqual(data, self.read_file(self.destination))
+
+    def test_short_source(self):
+        chunk_size = TestBlockDeviceCopier.chunk_size
+        data = os.urandom(chunk_size)
+        self.write_file(self.source, data)
+
+        copier = self.get_copier(2 * chunk_size)
+        self.assertEqual(CommonVariables.copy_data_error, copier.copy())
+        self.assertEqual('{0} {0} {1}'.format(chunk_size, 2 * chunk_size), self.read_file(copier.checkpoint_path).decode('utf-8').strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
 import unittest
 import mock
 
-from main.Common import CryptItem
+from main.Common import CryptItem, DeviceItem
 from main.EncryptionEnvironment import EncryptionEnvironment
 from main.DiskUtil import DiskUtil
 from console_logger import ConsoleLogger
@@ -57,6 +57,30 @@ class TestDiskUtil(unittest.TestCase):
         crypt_item.current_luks_slot = current_luks_slot
         return crypt_item
 
+    @mock.patch('main.DiskUtil.ProcessCommunicator')
+    def test_get_pv_vg_names(self, pc_mock):
+        self.disk_util.command_executor = mock.Mock()
+        self.disk_util.command_executor.Execute.return_value = 0
+        pc_mock.return_value.stdout = "  LVM2_PV_NAME=/dev/sdc1 LVM2_VG_NAME=datavg\n  LVM2_PV_NAME=/dev/sdd1 LVM2_VG_NAME=datavg\n  LVM2_PV_NAME=/dev/sde LVM2_VG_NAME=\n"
+
+        self.assertEqual({'/dev/sdc1': 'datavg', '/dev/sdd1': 'datavg'}, self.disk_util.get_pv_vg_names())
+
+    def test_get_device_lock_keys(self):
+        pv_vg_names = {'/dev/sdc1': 'datavg'}
+        logical_volume = DeviceItem()
+        logical_volume.name = 'datavg/lv1'
+        logical_volume.type = 'lvm'
+        physical_volume = DeviceItem()
+        physical_volume.name = 'sdc1'
+        physical_volume.type = 'part'
+        partition = DeviceItem()
+        partition.name = 'sdd1'
+        partition.type = 'part'
+
+        self.assertEqual(['datavg/lv1', 'vg:datavg'], self.disk_util.get_device_lock_keys(logical_volume, pv_vg_names))
+        self.assertEqual(['sdc1', 'vg:datavg'], self.disk_util.get_device_lock_keys(physical_volume, pv_vg_names))
+        self.assertEqual(['sdd1'], self.disk_util.get_device_lock_keys(partition, pv_vg_names))
+
     def test_parse_crypttab_line(self):
         # empty line
         line = ""
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+""" Unit tests for the EncryptionScheduler module and the per device encryption environments """
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import mock
+
+from main.EncryptionEnvironment import EncryptionEnvironment
+from main.EncryptionScheduler import DeviceLockTable, EncryptionScheduler, SynchronizedHandlerUtil
+from main.OnGoingItemConfig import OnGoingItemConfig
+from console_logger import ConsoleLogger
+
+
+class TestEncryptionScheduler(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.lock = threading.Lock()
+        self.running = set()
+        self.max_running = 0
+        self.overlaps = []
+
+    def _job(self, name, exclusive_with=(), result=True, duration=0.05):
+        def target():
+            with self.lock:
+                self.overlaps.extend((name, other) for other in exclusive_with if other in self.running)
+                self.running.add(name)
+                self.max_running = max(self.max_running, len(self.running))
+            time.sleep(duration)
+            with self.lock:
+                self.running.remove(name)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return target
+
+    def test_runs_up_to_max_workers(self):
+        scheduler = EncryptionScheduler(self.logger, max_workers=3)
+        for i in range(8):
+            scheduler.add_job(name='sd' + str(i), lock_keys=['sd' + str(i)], target=self._job('sd' + str(i)))
+
+        self.assertEqual(None, scheduler.run())
+        self.assertEqual(3, self.max_running)
+        self.assertTrue(all(job.succeeded for job in scheduler.jobs))
+
+    def test_shared_lock_key_serializes(self):
+        scheduler = EncryptionScheduler(self.logger, max_workers=4)
+        scheduler.add_job(name='vg/lv1', lock_keys=['vg/lv1', 'vg:vg'], target=self._job('vg/lv1', ['vg/lv2']))
+        scheduler.add_job(name='vg/lv2', lock_keys=['vg/lv2', 'vg:vg'], target=self._job('vg/lv2', ['vg/lv1']))
+        scheduler.add_job(name='sdd', lock_keys=['sdd'], target=self._job('sdd'))
+
+        self.assertEqual(None, scheduler.run())
+        self.assertEqual([], self.overlaps)
+        self.assertEqual(2, self.max_running)
+
+    def test_failure_stops_new_jobs(self):
+        scheduler = EncryptionScheduler(self.logger, max_workers=1)
+        scheduler.add_job(name='sdc', lock_keys=['sdc'], target=self._job('sdc'))
+        failing_job = scheduler.add_job(name='sdd', lock_keys=['sdd'], target=self._job('sdd', result=False), item='sdd item')
+        never_started_job = scheduler.add_job(name='sde', lock_keys=['sde'], target=self._job('sde'))
+
+        self.assertTrue(failing_job is scheduler.run())
+        self.assertEqual('sdd item', failing_job.item)
+        self.assertEqual(None, never_started_job.succeeded)
+
+    def test_exception_fails_job(self):
+        scheduler = EncryptionScheduler(self.logger, max_workers=2)
+        failing_job = scheduler.add_job(name='sdc', lock_keys=['sdc'], target=self._job('sdc', result=Exception('copy failed')))
+
+        self.assertTrue(failing_job is scheduler.run())
+        self.assertFalse(failing_job.succeeded)
+
+    def test_lock_table(self):
+        lock_table = DeviceLockTable()
+        self.assertTrue(lock_table.try_acquire(['vg/lv1', 'vg:vg']))
+        self.assertFalse(lock_table.try_acquire(['sdc1', 'vg:vg']))
+        self.assertTrue(lock_table.try_acquire(['sdd']))
+        lock_table.release(['vg/lv1', 'vg:vg'])
+        self.assertTrue(lock_table.try_acquire(['sdc1', 'vg:vg']))
+
+    def test_synchronized_handler_util(self):
+        hutil = mock.Mock()
+        status_hutil = SynchronizedHandlerUtil(hutil)
+        status_hutil.do_status_report(operation='DataCopy', status='success', status_code='0', message='50%')
+        status_hutil.log('message')
+
+        hutil.do_status_report.assert_called_once_with(operation='DataCopy', status='success', status_code='0', message='50%')
+        hutil.log.assert_called_once_with('message')
+
+
+class TestDeviceEnvironment(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.folder = tempfile.mkdtemp()
+        self.encryption_environment = EncryptionEnvironment(None, self.logger)
+        self.encryption_environment.device_ongoing_items_path = os.path.join(self.folder, 'ongoing_items')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_device_environment_paths(self):
+        first = self.encryption_environment.get_device_environment('vg/lv1')
+        second = self.encryption_environment.get_device_environment('sdc1')
+
+        self.assertEqual('vg/lv1', first.device_name)
+        self.assertNotEqual(first.azure_crypt_ongoing_item_config_path, second.azure_crypt_ongoing_item_config_path)
+        self.assertNotEqual(first.copy_slice_item_backup_file, second.copy_slice_item_backup_file)
+        self.assertNotEqual(first.copy_header_slice_file_path, second.copy_header_slice_file_path)
+        self.assertTrue(os.path.isdir(os.path.dirname(first.azure_crypt_ongoing_item_journal_path)))
+        # the crypt items stay shared
+        self.assertEqual(self.encryption_environment.azure_crypt_mount_config_path, first.azure_crypt_mount_config_path)
+        self.assertEqual(None, self.encryption_environment.device_name)
+
+    def test_device_environments_to_resume(self):
+        for device_name in ['vg/lv1', 'sdc1']:
+            ongoing_item_config = OnGoingItemConfig(self.encryption_environment.get_device_environment(device_name), self.logger)
+            ongoing_item_config.phase = 'encrypt_copy_data'
+            ongoing_item_config.commit()
+        self.encryption_environment.get_device_environment('sdd1')
+        ongoing_item_config = OnGoingItemConfig(self.encryption_environment.get_device_environment('sde1'), self.logger)
+        ongoing_item_config.commit()
+        ongoing_item_config.clear_config()
+
+        device_names = [device_environment.device_name for device_environment in self.encryption_environment.get_device_environments()]
+        self.assertEqual(['sdc1', 'vg/lv1'], device_names)
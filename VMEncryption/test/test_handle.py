@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+""" Unit tests for the ongoing item handling of the handle module daemon """
+
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from main import handle
+from main.Common import CommonVariables
+from main.EncryptionEnvironment import EncryptionEnvironment
+from console_logger import ConsoleLogger
+
+
+class TestHandleOngoingItems(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.folder = tempfile.mkdtemp()
+        self.encryption_environment = EncryptionEnvironment(None, self.logger)
+        self.encryption_environment.azure_crypt_ongoing_item_config_path = os.path.join(self.folder, 'azure_crypt_ongoing_item.ini')
+        self.encryption_environment.device_ongoing_items_path = os.path.join(self.folder, 'ongoing_items')
+        for name, value in [('logger', self.logger), ('hutil', mock.Mock()),
+                            ('encryption_environment', self.encryption_environment), ('DistroPatcher', mock.Mock())]:
+            patcher = mock.patch.object(handle, name, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _touch(self, path):
+        with open(path, 'w') as f:
+            f.write('[azure_crypt_ongoing_item_config]\n')
+
+    def _add_device_ongoing_item(self, device_name):
+        device_environment = self.encryption_environment.get_device_environment(device_name)
+        self._touch(device_environment.azure_crypt_ongoing_item_config_path)
+
+    def test_ongoing_items_exist(self):
+        self.assertFalse(handle.ongoing_items_exist())
+        # the folder of a device is created before its ongoing item config
+        self.encryption_environment.get_device_environment('sdc1')
+        self.assertFalse(handle.ongoing_items_exist())
+        self._add_device_ongoing_item('sdc1')
+        self.assertTrue(handle.ongoing_items_exist())
+
+        shutil.rmtree(self.encryption_environment.device_ongoing_items_path)
+        self._touch(self.encryption_environment.azure_crypt_ongoing_item_config_path)
+        self.assertTrue(handle.ongoing_items_exist())
+
+    def _daemon_decrypt(self):
+        decryption_marker = mock.Mock()
+        decryption_marker.config_file_exists.return_value = True
+        decryption_marker.get_current_command.return_value = CommonVariables.DisableEncryption
+        with mock.patch.object(handle, 'DecryptionMarkConfig', return_value=decryption_marker), \
+                mock.patch.object(handle, 'DiskUtil'), \
+                mock.patch.object(handle, 'EncryptionConfig') as encryption_config_class, \
+                mock.patch.object(handle, 'mount_encrypted_disks'), \
+                mock.patch.object(handle, 'disable_encryption_all_in_place', return_value=None) as disable_mock:
+            handle.daemon_decrypt()
+        return disable_mock, encryption_config_class.return_value
+
+    def test_decrypt_waits_for_device_ongoing_item(self):
+        self._add_device_ongoing_item('sdc1')
+        disable_mock, encryption_config = self._daemon_decrypt()
+        self.assertFalse(disable_mock.called)
+        self.assertFalse(encryption_config.clear_config.called)
+
+    def test_decrypt_without_ongoing_item(self):
+        disable_mock, encryption_config = self._daemon_decrypt()
+        self.assertTrue(disable_mock.called)
+        self.assertTrue(encryption_config.clear_config.called)
+
+    def _daemon_encrypt_data_volumes(self, command, resume_result):
+        encryption_marker = mock.Mock()
+        encryption_marker.config_file_exists.return_value = True
+        encryption_marker.get_current_command.return_value = command
+        disk_util = mock.Mock()
+        disk_util.mount_all.return_value = CommonVariables.process_success
+        calls = mock.Mock()
+        calls.enable_encryption_all_in_place.return_value = resume_result
+        calls.enable_encryption_format.return_value = None
+        with mock.patch.object(handle, 'enable_encryption_all_in_place', calls.enable_encryption_all_in_place), \
+                mock.patch.object(handle, 'enable_encryption_format', calls.enable_encryption_format):
+            result = handle.daemon_encrypt_data_volumes(encryption_marker=encryption_marker,
+                                                        encryption_config=mock.Mock(),
+                                                        disk_util=disk_util,
+                                                        bek_util=mock.Mock(),
+                                                        bek_passphrase_file='/mnt/azure_bek_disk/LinuxPassPhraseFileName')
+        return result, calls
+
+    def test_device_ongoing_item_resumed_before_format(self):
+        self._add_device_ongoing_item('sdc1')
+        result, calls = self._daemon_encrypt_data_volumes(CommonVariables.EnableEncryptionFormat, None)
+
+        self.assertTrue(result)
+        self.assertEqual(['enable_encryption_all_in_place', 'enable_encryption_format'], [call[0] for call in calls.method_calls])
+        self.assertTrue(calls.enable_encryption_all_in_place.call_args[1]['resume_only'])
+
+    def test_format_not_run_when_resume_fails(self):
+        self._add_device_ongoing_item('sdc1')
+        self.assertRaises(Exception, self._daemon_encrypt_data_volumes, CommonVariables.EnableEncryptionFormatAll, 'sdc1')
+
+    def test_nothing_resumed_without_device_ongoing_item(self):
+        result, calls = self._daemon_encrypt_data_volumes(CommonVariables.EnableEncryptionFormat, None)
+
+        self.assertTrue(result)
+        self.assertEqual(['enable_encryption_format'], [call[0] for call in calls.method_calls])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+""" Unit tests for the ProgressJournal module and its use by OnGoingItemConfig """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from main.EncryptionEnvironment import EncryptionEnvironment
+from main.OnGoingItemConfig import OnGoingItemConfig
+from main.ProgressJournal import ProgressJournal
+from console_logger import ConsoleLogger
+
+
+class TestProgressJournal(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.folder = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.folder, 'ongoing_item.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_append_and_replay(self):
+        journal = ProgressJournal(self.journal_path, self.logger)
+        self.assertEqual(None, journal.get_last_slice_index(1))
+        for slice_index in range(1, 6):
+            journal.append(1, slice_index)
+        journal.close()
+
+        self.assertEqual(5 * ProgressJournal.record_size, os.path.getsize(self.journal_path))
+        self.assertEqual(5, ProgressJournal(self.journal_path, self.logger).get_last_slice_index(1))
+
+    def test_records_of_other_generation_ignored(self):
+        journal = ProgressJournal(self.journal_path, self.logger)
+        journal.append(1, 7)
+        journal.close()
+
+        self.assertEqual(None, ProgressJournal(self.journal_path, self.logger).get_last_slice_index(2))
+
+    def test_torn_record_cut_on_append(self):
+        journal = ProgressJournal(self.journal_path, self.logger)
+        journal.append(3, 1)
+        journal.append(3, 2)
+        journal.close()
+        # a crash in the middle of the third record
+        with open(self.journal_path, 'ab') as journal_file:
+            journal_file.write(journal.pack_record(3, 3)[:10])
+
+        journal = ProgressJournal(self.journal_path, self.logger)
+        self.assertEqual(2, journal.get_last_slice_index(3))
+        journal.append(3, 3)
+        journal.close()
+        self.assertEqual(3 * ProgressJournal.record_size, os.path.getsize(self.journal_path))
+        self.assertEqual(3, ProgressJournal(self.journal_path, self.logger).get_last_slice_index(3))
+
+    def test_corrupted_record_ends_replay(self):
+        journal = ProgressJournal(self.journal_path, self.logger)
+        journal.append(1, 1)
+        journal.append(1, 2)
+        journal.close()
+        with open(self.journal_path, 'r+b') as journal_file:
+            journal_file.seek(ProgressJournal.record_size + 12)
+            journal_file.write(b'\xff')
+
+        self.assertEqual(1, ProgressJournal(self.journal_path, self.logger).get_last_slice_index(1))
+
+
+class TestOnGoingItemConfigJournal(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.folder = tempfile.mkdtemp()
+        self.encryption_environment = EncryptionEnvironment(None, self.logger)
+        self.encryption_environment.azure_crypt_ongoing_item_config_path = os.path.join(self.folder, 'azure_crypt_ongoing_item.ini')
+        self.encryption_environment.azure_crypt_ongoing_item_journal_path = os.path.join(self.folder, 'azure_crypt_ongoing_item.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _create_config(self):
+        ongoing_item_config = OnGoingItemConfig(self.encryption_environment, self.logger)
+        ongoing_item_config.original_dev_path = '/dev/sdc1'
+        ongoing_item_config.phase = 'encrypt_copy_data'
+        ongoing_item_config.current_block_size = 52428800
+        ongoing_item_config.current_slice_index = 0
+        ongoing_item_config.commit()
+        return ongoing_item_config
+
+    def _read_config_file(self):
+        with open(self.encryption_environment.azure_crypt_ongoing_item_config_path, 'rb') as config_file:
+            return config_file.read()
+
+    def test_slice_index_goes_to_journal(self):
+        ongoing_item_config = self._create_config()
+        config_file_content = self._read_config_file()
+
+        for slice_index in range(1, 4):
+            ongoing_item_config.commit_slice_index(slice_index)
+        ongoing_item_config.progress_journal.close()
+
+        # the config file is not rewritten per slice
+        self.assertEqual(config_file_content, self._read_config_file())
+        self.assertEqual(3, OnGoingItemConfig(self.encryption_environment, self.logger).get_current_slice_index())
+
+    def test_commit_compacts_journal(self):
+        ongoing_item_config = self._create_config()
+        ongoing_item_config.commit_slice_index(5)
+        ongoing_item_config.phase = 'encrypt_done'
+        ongoing_item_config.commit()
+
+        self.assertFalse(os.path.exists(self.encryption_environment.azure_crypt_ongoing_item_journal_path))
+        reloaded_config = OnGoingItemConfig(self.encryption_environment, self.logger)
+        self.assertEqual(5, reloaded_config.get_current_slice_index())
+        self.assertEqual(2, reloaded_config.get_journal_generation())
+
+    def test_stale_journal_ignored_after_commit(self):
+        # a crash after the config file of the next generation was written, before the journal was removed
+        ongoing_item_config = self._create_config()
+        ongoing_item_config.commit_slice_index(9)
+        ongoing_item_config.progress_journal.close()
+        journal_content = open(self.encryption_environment.azure_crypt_ongoing_item_journal_path, 'rb').read()
+        ongoing_item_config.current_slice_index = 2
+        ongoing_item_config.commit()
+        with open(self.encryption_environment.azure_crypt_ongoing_item_journal_path, 'wb') as journal_file:
+            journal_file.write(journal_content)
+
+        self.assertEqual(2, OnGoingItemConfig(self.encryption_environment, self.logger).get_current_slice_index())
+
+    def test_config_without_generation_commits(self):
+        ongoing_item_config = OnGoingItemConfig(self.encryption_environment, self.logger)
+        with open(self.encryption_environment.azure_crypt_ongoing_item_config_path, 'w') as config_file:
+            config_file.write('[azure_crypt_ongoing_item_config]\ncurrentsliceindex = 4\n')
+
+        ongoing_item_config.commit_slice_index(5)
+        self.assertEqual(5, ongoing_item_config.get_current_slice_index())
+        self.assertEqual(1, ongoing_item_config.get_journal_generation())
+
+    def test_clear_config_removes_journal(self):
+        ongoing_item_config = self._create_config()
+        ongoing_item_config.commit_slice_index(1)
+        ongoing_item_config.clear_config()
+
+        self.assertFalse(os.path.exists(self.encryption_environment.azure_crypt_ongoing_item_journal_path))
+        self.assertFalse(os.path.exists(self.encryption_environment.azure_crypt_ongoing_item_config_path))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+""" Unit tests for the SliceSizeTuner module """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from main.Common import CommonVariables
+from main.SliceSizeTuner import SliceSizeTuner
+from console_logger import ConsoleLogger
+
+MB = 1024 * 1024
+
+
+class TestSliceSizeTuner(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.folder = tempfile.mkdtemp()
+        self.memory_info_path = os.path.join(self.folder, 'meminfo')
+        self.tuner = SliceSizeTuner(self.logger, memory_info_path=self.memory_info_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _set_available_memory(self, size):
+        with open(self.memory_info_path, 'w') as f:
+            f.write("MemTotal:       16384000 kB\nMemFree:          100000 kB\nMemAvailable:   {0} kB\nCached:          200000 kB\n".format(size // 1024))
+
+    def _add_samples(self, block_size, throughput):
+        for i in range(SliceSizeTuner.samples_per_block_size):
+            next_block_size = self.tuner.add_sample(block_size, block_size, float(block_size) / throughput)
+        return next_block_size
+
+    def test_available_memory(self):
+        self._set_available_memory(8192 * MB)
+        self.assertEqual(8192 * MB, self.tuner.get_available_memory())
+        # kernels without MemAvailable
+        with open(self.memory_info_path, 'w') as f:
+            f.write("MemTotal: 4000 kB\nMemFree: 1000 kB\nBuffers: 100 kB\nCached: 200 kB\n")
+        self.assertEqual(1300 * 1024, self.tuner.get_available_memory())
+        os.remove(self.memory_info_path)
+        self.assertEqual(None, self.tuner.get_available_memory())
+
+    def test_initial_block_size_fits_memory(self):
+        self._set_available_memory(64 * MB)
+        self.assertEqual(CommonVariables.default_block_size // 4, self.tuner.get_initial_block_size(CommonVariables.default_block_size))
+        self._set_available_memory(8192 * MB)
+        self.assertEqual(CommonVariables.default_block_size, self.tuner.get_initial_block_size(CommonVariables.default_block_size))
+
+    def test_grows_while_throughput_improves(self):
+        self._set_available_memory(8192 * MB)
+        block_size = CommonVariables.default_block_size
+        self.assertEqual(block_size * 2, self._add_samples(block_size, 100 * MB))
+        self.assertEqual(block_size * 4, self._add_samples(block_size * 2, 150 * MB))
+        # no better, back to the best block size and stay there
+        self.assertEqual(block_size * 2, self._add_samples(block_size * 4, 155 * MB))
+        self.assertEqual(block_size * 2, self._add_samples(block_size * 2, 300 * MB))
+
+    def test_grows_up_to_limit(self):
+        self._set_available_memory(8192 * MB)
+        self.tuner.tmpfs_size = CommonVariables.default_block_size * 2
+        block_size = CommonVariables.default_block_size
+        self.assertEqual(block_size * 2, self._add_samples(block_size, 100 * MB))
+        self.assertEqual(block_size * 2, self._add_samples(block_size * 2, 200 * MB))
+
+    def test_shrinks_under_memory_pressure(self):
+        self._set_available_memory(8192 * MB)
+        block_size = CommonVariables.default_block_size * 4
+        self.assertEqual(block_size, self.tuner.add_sample(block_size, block_size, 1.0))
+        self._set_available_memory(200 * MB)
+        self.assertEqual(block_size // 2, self.tuner.add_sample(block_size, block_size, 1.0))
+        # and does not grow again
+        self._set_available_memory(8192 * MB)
+        self.assertEqual(block_size // 2, self._add_samples(block_size // 2, 100 * MB))
+
+    def test_never_below_min_block_size(self):
+        self._set_available_memory(1 * MB)
+        block_size = CommonVariables.default_block_size
+        while self.tuner.can_halve(block_size):
+            block_size //= 2
+        self.assertTrue(block_size >= CommonVariables.min_block_size)
+        self.assertEqual(block_size, self.tuner.add_sample(block_size, block_size, 1.0))
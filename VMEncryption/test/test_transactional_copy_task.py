@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+""" Unit tests for the TransactionalCopyTask and CopyEngine modules """
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import mock
+
+from main.Common import CommonVariables
+from main.CopyEngine import CopyEngine
+from main.EncryptionEnvironment import EncryptionEnvironment
+from main.TransactionalCopyTask import TransactionalCopyTask
+from console_logger import ConsoleLogger
+from test_utils import MockDistroPatcher
+
+
+class TestTransactionalCopyTask(unittest.TestCase):
+    """ the devices are plain files in a temporary folder """
+    block_size = 64 * 1024
+
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'source')
+        self.destination = os.path.join(self.folder, 'destination')
+        self.encryption_environment = EncryptionEnvironment(None, self.logger)
+        self.encryption_environment.copy_slice_item_backup_file = os.path.join(self.folder, 'copy_slice_item.bak')
+        self.hutil = mock.Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write_source(self, size):
+        data = os.urandom(size)
+        with open(self.source, 'wb') as f:
+            f.write(data)
+        with open(self.destination, 'wb') as f:
+            f.write(b'\0' * size)
+        return data
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _create_task(self, total_size, from_end, slice_index=0, use_dd=False):
+        ongoing_item_config = mock.Mock()
+        ongoing_item_config.get_current_total_copy_size.return_value = total_size
+        ongoing_item_config.get_current_block_size.return_value = self.block_size
+        ongoing_item_config.get_current_source_path.return_value = self.source
+        ongoing_item_config.get_current_destination.return_value = self.destination
+        ongoing_item_config.get_current_slice_index.return_value = slice_index
+        ongoing_item_config.get_from_end.return_value = from_end
+        patching = MockDistroPatcher('Ubuntu', '16.04', '4.15')
+        patching.dd_path = 'dd'
+        copy_task = TransactionalCopyTask(self.logger, self.hutil, None, ongoing_item_config,
+                                          patching, self.encryption_environment,
+                                          status_prefix='Encrypting', use_dd=use_dd)
+        copy_task.slice_file_path = os.path.join(self.folder, 'slice_file')
+        return copy_task
+
+    def test_begin_copy_from_end(self):
+        size = self.block_size * 3 + 4096
+        data = self._write_source(size)
+        copy_task = self._create_task(size, 'True')
+
+        self.assertEqual(CommonVariables.process_success, copy_task.prepare_mem_fs())
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        copy_task.clear_mem_fs()
+
+        self.assertEqual(data, self._read(self.destination))
+        self.assertEqual(4, copy_task.current_slice_index)
+        self.assertEqual(4, copy_task.ongoing_item_config.commit_slice_index.call_count)
+        # the status is reported for the first slice and when the copy is done
+        self.assertEqual(2, self.hutil.do_status_report.call_count)
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+        # the slices are read once each
+        self.assertEqual(size, copy_task.copy_engine.bytes_read)
+
+    def test_begin_copy_from_start(self):
+        size = self.block_size * 2 + 512
+        data = self._write_source(size)
+        copy_task = self._create_task(size, 'False')
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(data, self._read(self.destination))
+        self.assertEqual(3, copy_task.current_slice_index)
+
+    def test_begin_copy_with_dd(self):
+        # from the start, dd truncates a destination file after the slice it writes
+        size = self.block_size * 3 + 4096
+        data = self._write_source(size)
+        copy_task = self._create_task(size, 'False', use_dd=True)
+
+        self.assertEqual(None, copy_task.copy_engine)
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(data, self._read(self.destination))
+        self.assertEqual(4, copy_task.current_slice_index)
+
+    def _read_backup_offset(self):
+        backup_file = self.encryption_environment.copy_slice_item_backup_file
+        if not os.path.exists(backup_file):
+            return None
+        magic, offset, length = struct.unpack(TransactionalCopyTask.backup_header_format,
+                                              self._read(backup_file)[:struct.calcsize(TransactionalCopyTask.backup_header_format)])
+        self.assertEqual(TransactionalCopyTask.backup_header_magic, magic)
+        return offset
+
+    def test_backup_file_of_slice_exists_until_slice_index_committed(self):
+        size = self.block_size * 2
+        self._write_source(size)
+        copy_task = self._create_task(size, 'True')
+        backup_offsets_at_commit = []
+        copy_task.ongoing_item_config.commit_slice_index.side_effect = lambda slice_index: backup_offsets_at_commit.append(self._read_backup_offset())
+
+        copy_task.begin_copy()
+        # slice 0 is the empty last slice, it has no backup. from the end, slice 1 is the second block
+        self.assertEqual([None, self.block_size, 0], backup_offsets_at_commit)
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+
+    def test_resume_after_crash_between_commit_and_backup_removal(self):
+        size = self.block_size * 3
+        data = self._write_source(size)
+        copy_task = self._create_task(size, 'False')
+        # slice 0 is copied and slice index 1 committed, the backup of slice 0 is not removed yet
+        copy_task.ongoing_item_config.commit_slice_index.side_effect = Exception('crash')
+        copy_task.remove_slice_item_backup_file = mock.Mock()
+        self.assertRaises(Exception, copy_task.begin_copy)
+        self.assertEqual(0, self._read_backup_offset())
+
+        copy_task = self._create_task(size, 'False', slice_index=1)
+        self.assertEqual(CommonVariables.process_success, copy_task.resume_copy())
+        # the backup of slice 0 is not replayed onto slice 1, which is not copied yet
+        self.assertEqual(1, copy_task.current_slice_index)
+        self.assertEqual(0, copy_task.ongoing_item_config.commit_slice_index.call_count)
+        self.assertEqual(b'\0' * self.block_size, self._read(self.destination)[self.block_size:self.block_size * 2])
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(data, self._read(self.destination))
+
+    def test_resume_from_backup_file_with_header(self):
+        # crashed while slice 1 was written to the destination, the source of it may already be overwritten
+        size = self.block_size * 3
+        self._write_source(size)
+        backup_data = os.urandom(self.block_size)
+        header = struct.pack(TransactionalCopyTask.backup_header_format, TransactionalCopyTask.backup_header_magic, self.block_size, self.block_size)
+        with open(self.encryption_environment.copy_slice_item_backup_file, 'wb') as f:
+            f.write(header.ljust(TransactionalCopyTask.backup_header_size, b'\0') + backup_data)
+        copy_task = self._create_task(size, 'False', slice_index=1)
+
+        self.assertEqual(CommonVariables.process_success, copy_task.resume_copy())
+        self.assertEqual(2, copy_task.current_slice_index)
+        self.assertEqual(backup_data, self._read(self.destination)[self.block_size:self.block_size * 2])
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+
+    def test_resume_from_complete_backup_file(self):
+        # a backup file without header was left by dd
+        size = self.block_size * 3
+        self._write_source(size)
+        backup_data = os.urandom(self.block_size)
+        with open(self.encryption_environment.copy_slice_item_backup_file, 'wb') as f:
+            f.write(backup_data)
+        copy_task = self._create_task(size, 'False', slice_index=1)
+
+        self.assertEqual(CommonVariables.process_success, copy_task.resume_copy())
+        self.assertEqual(2, copy_task.current_slice_index)
+        self.assertEqual(backup_data, self._read(self.destination)[self.block_size:self.block_size * 2])
+        self.assertFalse(os.path.exists(self.encryption_environment.copy_slice_item_backup_file))
+
+    def test_resume_from_partial_backup_file(self):
+        # a backup file cut short by dd is completed from the source
+        size = self.block_size * 3
+        data = self._write_source(size)
+        with open(self.encryption_environment.copy_slice_item_backup_file, 'wb') as f:
+            f.write(data[self.block_size:self.block_size + 4096])
+        copy_task = self._create_task(size, 'False', slice_index=1)
+
+        self.assertEqual(CommonVariables.process_success, copy_task.resume_copy())
+        self.assertEqual(data[self.block_size:self.block_size * 2], self._read(self.destination)[self.block_size:self.block_size * 2])
+
+    def test_resume_with_too_big_backup_file(self):
+        size = self.block_size * 3
+        self._write_source(size)
+        with open(self.encryption_environment.copy_slice_item_backup_file, 'wb') as f:
+            f.write(b'\0' * (self.block_size + 512))
+        copy_task = self._create_task(size, 'False', slice_index=1)
+
+        self.assertEqual(CommonVariables.backup_slice_file_error, copy_task.resume_copy())
+        self.assertEqual(1, copy_task.current_slice_index)
+
+    @mock.patch('main.TransactionalCopyTask.time')
+    def test_copy_throttled_to_io_budget(self, time_mock):
+        size = self.block_size * 4
+        self._write_source(size)
+        copy_task = self._create_task(size, 'False')
+        copy_task.max_bytes_per_second = self.block_size * 2
+        # every slice takes no time at all
+        time_mock.time.return_value = 1000.0
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual([mock.call(0.5), mock.call(1.0), mock.call(1.5), mock.call(2.0)], time_mock.sleep.call_args_list)
+
+    def _create_tuned_task(self, total_size, from_end, block_sizes):
+        copy_task = self._create_task(total_size, from_end)
+        copy_task.slice_size_tuner = mock.Mock()
+        copy_task.slice_size_tuner.get_initial_block_size.side_effect = lambda block_size: block_size
+        copy_task.slice_size_tuner.add_sample.side_effect = lambda block_size, copied_size, elapsed: block_sizes.pop(0) if block_sizes else block_size
+        return copy_task
+
+    def test_adaptive_slices_from_end(self):
+        size = self.block_size * 9 + 4096
+        data = self._write_source(size)
+        # grow to 2 blocks, then shrink to half a block
+        copy_task = self._create_tuned_task(size, 'True', [self.block_size * 2, self.block_size // 2])
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(data, self._read(self.destination))
+        self.assertEqual(self.block_size // 2, copy_task.block_size)
+        self.assertEqual(copy_task.total_slice_size, copy_task.current_slice_index)
+        # the block size is committed with the rebased slice index
+        self.assertEqual(self.block_size // 2, copy_task.ongoing_item_config.current_block_size)
+        self.assertEqual(2, copy_task.ongoing_item_config.commit.call_count)
+
+    def test_adaptive_slices_from_start(self):
+        size = self.block_size * 7 + 512
+        data = self._write_source(size)
+        copy_task = self._create_tuned_task(size, 'False', [self.block_size * 2])
+
+        self.assertEqual(CommonVariables.process_success, copy_task.begin_copy())
+        self.assertEqual(data, self._read(self.destination))
+        self.assertEqual(self.block_size * 2, copy_task.block_size)
+
+    def test_resize_slices_rebases_slice_index(self):
+        size = self.block_size * 8 + 4096
+        # from the end, the tail and 3 blocks are copied, 5 blocks are not
+        copy_task = self._create_task(size, 'True', slice_index=4)
+        self.assertFalse(copy_task.resize_slices(self.block_size * 2))
+        copy_task.current_slice_index = 5
+        self.assertTrue(copy_task.resize_slices(self.block_size * 2))
+        # 2 slices of 2 blocks are not copied yet
+        self.assertEqual(2, copy_task.total_slice_size - copy_task.current_slice_index)
+        self.assertEqual(4096, copy_task.last_slice_size)
+        self.assertEqual(copy_task.current_slice_index, copy_task.ongoing_item_config.current_slice_index)
+
+        copy_task = self._create_task(size, 'False', slice_index=3)
+        self.assertFalse(copy_task.resize_slices(self.block_size * 2))
+        self.assertTrue(copy_task.resize_slices(self.block_size // 2))
+        self.assertEqual(6, copy_task.current_slice_index)
+
+    def test_copy_fails_on_missing_source(self):
+        copy_task = self._create_task(self.block_size * 2 + 4096, 'True')
+        self.assertEqual(CommonVariables.copy_data_error, copy_task.begin_copy())
+        self.assertEqual(0, copy_task.ongoing_item_config.commit_slice_index.call_count)
+
+
+class TestCopyEngine(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_copy_to_destinations(self):
+        source = os.path.join(self.folder, 'source')
+        data = os.urandom(10000)
+        with open(source, 'wb') as f:
+            f.write(data)
+        first = os.path.join(self.folder, 'first')
+        second = os.path.join(self.folder, 'second')
+        copy_engine = CopyEngine(self.logger)
+
+        self.assertEqual(5000, copy_engine.copy(source, 2000, 5000, [(first, 0), (second, 100)]))
+        with open(first, 'rb') as f:
+            self.assertEqual(data[2000:7000], f.read())
+        with open(second, 'rb') as f:
+            self.assertEqual(data[2000:7000], f.read()[100:])
+        # short read at the end of the source
+        self.assertEqual(1000, copy_engine.copy(source, 9000, 5000, [(first, 0)]))
+        self.assertEqual(5000, copy_engine.bytes_read - 1000)
+
+    def test_write_file_replaces_file(self):
+        copy_engine = CopyEngine(self.logger)
+        path = os.path.join(self.folder, 'backup')
+        with open(path, 'wb') as f:
+            f.write(b'old content that is longer')
+        copy_engine.reserve(4)
+        copy_engine.buffer[0:4] = b'new!'
+
+        copy_engine.write_file(path, 4)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'new!', f.read())
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def test_buffer_reused(self):
+        copy_engine = CopyEngine(self.logger)
+        copy_engine.reserve(10)
+        copy_engine.buffer[0:4] = b'keep'
+        copy_engine.reserve(100000)
+        buffer_before = copy_engine.buffer
+        copy_engine.reserve(4096)
+        self.assertTrue(buffer_before is copy_engine.buffer)
+        self.assertEqual(0, copy_engine.buffer_size % 4096)
+        self.assertEqual(b'keep', copy_engine.buffer[0:4])
+        copy_engine.release()
+        self.assertEqual(None, copy_engine.buffer)